@@ -0,0 +1,252 @@
+"""Times the matchmaking algorithms on synthetic queues so changes to them can be judged on numbers.
+
+Queues are generated from a seeded random number generator, so every run times the same queues. Each lounge has its
+own profile (MMR distribution, room size, room MMR threshold, placement MMR and matchmaking MMR clamp). The bot's
+config.json must be in the working directory, as for the bot itself, but the benchmark patches common.SERVER and the
+matchmaking settings it needs for each lounge, so any lounge's config will do. Each lounge is timed with its server's
+default matchmaking strategies (see matchmaking.DEFAULTS), whatever strategies the config selects.
+
+Usage:
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import common
+import matchmaking
+from cogs import SquadQueue
+from mogi_objects import Mogi, Team, Player, PlayersAllowedCheck
+
+DEFAULT_SIZES = [12, 24, 48, 96, 192, 500, 1000, 2000, 5000]
+
+
+@dataclass
+class LoungeProfile:
+    server: common.Server
+    players_per_room: int
+    room_mmr_threshold: int
+    mmr_mean: int
+    mmr_stdev: int
+    placement_mmr: int
+    matchmaking_bottom_mmr: int | None
+    matchmaking_top_mmr: int | None
+    players_allowed: Callable[[List[Player], int], bool]
+
+
+PROFILES = {
+    common.Server.MKW: LoungeProfile(
+        server=common.Server.MKW,
+        players_per_room=12,
+        room_mmr_threshold=8000,
+        mmr_mean=5000,
+        mmr_stdev=3000,
+        placement_mmr=750,
+        matchmaking_bottom_mmr=-2000,
+        matchmaking_top_mmr=11000,
+        players_allowed=SquadQueue.mkw_players_allowed),
+    common.Server.MK8DX: LoungeProfile(
+        server=common.Server.MK8DX,
+        players_per_room=12,
+        room_mmr_threshold=9999999,
+        mmr_mean=7000,
+        mmr_stdev=3500,
+        placement_mmr=1500,
+        matchmaking_bottom_mmr=None,
+        matchmaking_top_mmr=None,
+        players_allowed=SquadQueue.mk8dx_players_allowed),
+    common.Server.MKWorld: LoungeProfile(
+        server=common.Server.MKWorld,
+        players_per_room=24,
+        room_mmr_threshold=9999999,
+        mmr_mean=5500,
+        mmr_stdev=2500,
+        placement_mmr=5000,
+        matchmaking_bottom_mmr=None,
+        matchmaking_top_mmr=None,
+        players_allowed=SquadQueue.mkworld_players_allowed),
+}
+
+
+def generate_players(profile: LoungeProfile, num_players: int, rng: random.Random,
+                     placement_ratio: float) -> List[Player]:
+    """Returns num_players confirmed players with MMRs drawn from the lounge's distribution. placement_ratio of them
+    are placement players, who have the lounge's placement MMR."""
+    players = []
+    for i in range(num_players):
+        if rng.random() < placement_ratio:
+            mmr = profile.placement_mmr
+        else:
+            mmr = max(0, int(rng.gauss(profile.mmr_mean, profile.mmr_stdev)))
+        member = SimpleNamespace(id=100000 + i, mention=f"<@{100000 + i}>")
+        players.append(Player(member, f"Player {i}", mmr, confirmed=True))
+    return players
+
+
+def generate_queue(profile: LoungeProfile, num_players: int, seed: int, late_ratio: float = 0.5,
+                   placement_ratio: float = 0.05) -> Mogi:
+    """Returns a Mogi with a queue of about num_players confirmed players for the given lounge.
+
+    The queue is num_players rounded down to full rooms, followed by late players: late_ratio of a room's worth of
+    players, at most one less than a full room (there would be another room otherwise). Queues of fewer than one room
+    are not rounded down."""
+    rng = random.Random(f"{profile.server.name}-{num_players}-{seed}")
+    room_size = profile.players_per_room
+    if num_players >= room_size:
+        num_late = min(room_size - 1, round(room_size * late_ratio))
+        num_players = (num_players // room_size) * room_size + num_late
+    mogi = Mogi(sq_id=1, max_players_per_team=1, players_per_room=room_size,
+                buttons=[], mogi_channel=None)
+    mogi.teams = [Team([player]) for player in generate_players(
+        profile, num_players, rng, placement_ratio)]
+    return mogi
+
+
+def time_call(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Calls func repeat times and returns the best and median time in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {"best_ms": round(min(timings), 4),
+            "median_ms": round(statistics.median(timings), 4)}
+
+
+def benchmark_lounge(profile: LoungeProfile, sizes: List[int], repeat: int, seed: int, late_ratio: float,
+                     placement_ratio: float) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Times every algorithm on queues of each size for the given lounge. Returns algorithm -> size -> timings."""
+    old_server = common.SERVER
+    old_config = {key: common.CONFIG.get(key) for key in
+                  ("MATCHMAKING_BOTTOM_MMR", "MATCHMAKING_TOP_MMR", "PLACEMENT_PLAYER_MMR",
+                   *matchmaking.CONFIG_KEYS.values())}
+    common.SERVER = profile.server
+    # Unset strategy keys select the server's default strategies
+    for key in matchmaking.CONFIG_KEYS.values():
+        common.CONFIG[key] = None
+    common.set_matchmaking_mmr_bounds(
+        profile.matchmaking_bottom_mmr, profile.matchmaking_top_mmr)
+    common.CONFIG["PLACEMENT_PLAYER_MMR"] = profile.placement_mmr
+    check = PlayersAllowedCheck(
+        profile.players_allowed, profile.room_mmr_threshold, range_only=True)
+    results = {}
+    try:
+        for size in sizes:
+            mogi = generate_queue(profile, size, seed,
+                                  late_ratio, placement_ratio)
+            players = mogi.players_on_confirmed_teams()
+
+            # The proposed list and cancellation verdict are cached per roster
+            # version, so the roster is marked as changed before each call to
+            # time the uncached path
+            def proposed_list():
+                mogi.roster_changed()
+                mogi.generate_proposed_list(check)
+
+            def any_cancelled():
+                mogi.roster_changed()
+                mogi.any_room_cancelled(check)
+
+            calls = {
+                "_minimize_range": lambda: Mogi._minimize_range(players, profile.players_per_room),
+                "_all_room_final_list_algorithm": lambda: mogi._all_room_final_list_algorithm(check),
+                "_one_room_final_list_algorithm": lambda: mogi._one_room_final_list_algorithm(check),
+                "generate_proposed_list": proposed_list,
+                "any_room_cancelled": any_cancelled,
+            }
+            if profile.server is common.Server.MKW:
+                calls["_partition_final_list_algorithm"] = lambda: mogi._partition_final_list_algorithm(
+                    check, float("inf"))
+            for name, call in calls.items():
+                results.setdefault(name, {})[str(size)] = time_call(call, repeat)
+            print(f"{profile.server.name}: {len(players)} players done", flush=True)
+    finally:
+        common.SERVER = old_server
+        common.CONFIG.update(old_config)
+        common.settings_changed()
+    return results
+
+
+def run(sizes: List[int], repeat: int, seed: int, late_ratio: float, placement_ratio: float) -> dict:
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "matchmaking_backend": common.CONFIG.get("MATCHMAKING_BACKEND", "python"),
+            "matchmaking_strategies": {server.name: strategies for server, strategies in matchmaking.DEFAULTS.items()},
+            "repeat": repeat,
+            "seed": seed,
+            "late_ratio": late_ratio,
+            "placement_ratio": placement_ratio,
+        },
+        "results": {server.name: benchmark_lounge(profile, sizes, repeat, seed, late_ratio, placement_ratio)
+                    for server, profile in PROFILES.items()},
+    }
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """Prints the best time of every benchmark in the current run against the baseline. Returns a description of each
+    benchmark that is slower than the baseline by more than the tolerance (0.2 means 20% slower)."""
+    regressions = []
+    for server, algorithms in current["results"].items():
+        for algorithm, sizes in algorithms.items():
+            for size, timings in sizes.items():
+                old = baseline["results"].get(server, {}).get(
+                    algorithm, {}).get(size)
+                if old is None:
+                    print(f"{server} {algorithm} {size}: {timings['best_ms']:.3f}ms (new)")
+                    continue
+                ratio = timings["best_ms"] / old["best_ms"] if old["best_ms"] > 0 else 1.0
+                line = f"{server} {algorithm} {size}: {old['best_ms']:.3f}ms -> {timings['best_ms']:.3f}ms ({ratio:.2f}x)"
+                if ratio > 1 + tolerance:
+                    line += " REGRESSION"
+                    regressions.append(line)
+                print(line)
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Times the matchmaking algorithms on synthetic queues.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Queue sizes (number of players) to time.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of times to time each call.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the queue generator.")
+    parser.add_argument("--late-ratio", type=float, default=0.5,
+                        help="Late players in each queue, as a fraction of a room.")
+    parser.add_argument("--placement-ratio", type=float, default=0.05,
+                        help="Fraction of players in each queue who are placement players.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare the results against this JSON baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="How much slower than the baseline a benchmark can be before it is a regression.")
+    args = parser.parse_args(argv)
+
+    current = run(args.sizes, args.repeat, args.seed, args.late_ratio, args.placement_ratio)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=4)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if baseline["meta"] != current["meta"]:
+            print("Warning: the baseline was run with different settings:")
+            print(json.dumps(baseline["meta"], indent=4))
+        regressions = compare(baseline, current, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than the baseline by more than {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(regression)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,10 +12,14 @@ import time
 import json
 
 import common
+import http_client
+import matchmaking
 import mogi_objects
 from common import divide_chunks
 import mmr
-from mogi_objects import Mogi, Team, Player, Room, VoteView, JoinView
+from mogi_objects import Mogi, Team, Player, Room, VoteView, JoinView, PlayersAllowedCheck, RoomRegistry, player_sort_key
+import numpy_backend
+import tiers
 import asyncio
 from collections import defaultdict
 from typing import Optional, Dict, List, Tuple
@@ -43,21 +47,23 @@ def basic_threshold_players_allowed(
         players: List[Player],
         threshold: int) -> bool:
     """Returns True if the highest player's rating minus the lowest player's rating is below the given threshold"""
-    sorted_players = sorted(players, key=lambda p: p.mmr)
-    return (sorted_players[-1].adjusted_mmr -
-            sorted_players[0].adjusted_mmr) <= threshold
+    adjusted_mmrs = [p.adjusted_mmr for p in players]
+    return (max(adjusted_mmrs) - min(adjusted_mmrs)) <= threshold
 
 
+@matchmaking.register(matchmaking.VALIDITY, "mkw", range_only=True)
 def mkw_players_allowed(players: List[Player], threshold: int) -> bool:
     """Returns true if the given list of players would be allowed to play together"""
     return basic_threshold_players_allowed(players, threshold)
 
 
+@matchmaking.register(matchmaking.VALIDITY, "mk8dx", range_only=True)
 def mk8dx_players_allowed(players: List[Player], threshold: int) -> bool:
     """Returns true if the given list of players would be allowed to play together"""
     return basic_threshold_players_allowed(players, threshold)
 
 
+@matchmaking.register(matchmaking.VALIDITY, "mkworld", range_only=True)
 def mkworld_players_allowed(players: List[Player], threshold: int) -> bool:
     """Returns true if the given list of players would be allowed to play together"""
     return basic_threshold_players_allowed(players, threshold)
@@ -101,7 +107,8 @@ class SettingsGroup(app_commands.Group):
     @app_commands.describe(
         rating="Players below this rating will be considered this rating for matchmaking/sub purposes.")
     async def low_mmr_floor(self, interaction: discord.Interaction, rating: int):
-        common.CONFIG["MATCHMAKING_BOTTOM_MMR"] = rating
+        common.set_matchmaking_mmr_bounds(
+            rating, common.CONFIG["MATCHMAKING_TOP_MMR"])
         self.squad_queue.dump_staff_settings()
         await interaction.response.send_message(f"Players below {rating} MMR will be considered {rating} MMR for matchmaking and subbing in purposes.")
 
@@ -112,7 +119,8 @@ class SettingsGroup(app_commands.Group):
     @app_commands.describe(
         rating="Players above this rating will be considered this rating for matchmaking/sub purposes.")
     async def high_mmr_ceiling(self, interaction: discord.Interaction, rating: int):
-        common.CONFIG["MATCHMAKING_TOP_MMR"] = rating
+        common.set_matchmaking_mmr_bounds(
+            common.CONFIG["MATCHMAKING_BOTTOM_MMR"], rating)
         self.squad_queue.dump_staff_settings()
         await interaction.response.send_message(f"Players above {rating} MMR will be considered {rating} MMR for matchmaking and subbing in purposes.")
 
@@ -169,6 +177,9 @@ class SquadQueue(commands.Cog):
 
         self.old_events: List[Mogi] = []
 
+        # Room channel id -> (event, room) for the ongoing and old events
+        self.room_registry = RoomRegistry()
+
         self.sq_times: List[datetime] = []
 
         self.specific_player_amount_queue_times: List[Tuple[datetime, int]] = [
@@ -232,6 +243,9 @@ class SquadQueue(commands.Cog):
 
         self.room_mmr_threshold = bot.config["ROOM_MMR_THRESHOLD"]
 
+        matchmaking.check_config()
+        numpy_backend.check_config()
+
         self.TRACK_TYPE = bot.config["track_type"]
 
         self.TIER_INFO = []
@@ -283,8 +297,20 @@ class SquadQueue(commands.Cog):
         self.helper_staff_roles: Dict[str, discord.Role] = {}
 
         self.ratings = mmr.Ratings()
-
-        self.last_refreshed_rating_time: datetime = datetime.now(timezone.utc)
+        # The ratings saved before a restart can be looked up until the first
+        # pull finishes
+        self.ratings.load_snapshot()
+
+        self.last_refreshed_rating_time: datetime = self.ratings.last_pull or datetime.now(
+            timezone.utc)
+        self.ratings_schedule = mmr.RefreshSchedule()
+        # Held while the ratings are being refreshed, so only one refresh runs
+        # at a time. Rooms never wait on it: the new table is swapped in under
+        # self.ratings.publish_lock, which is only held briefly.
+        # The first refresh is made by ratings_scheduler as soon as the bot is
+        # ready, since ratings can already be looked up if they were loaded
+        # from the snapshot.
+        self.ratings_refresh_lock = asyncio.Lock()
 
         self.load_staff_settings()
 
@@ -320,6 +346,7 @@ class SquadQueue(commands.Cog):
                         common.CONFIG["PLAYERS_PER_ROOM"] = settings_dict["PLAYERS_PER_ROOM"]
                     if "ALLOWED_VOTE_BUTTONS" in settings_dict and len(settings_dict["ALLOWED_VOTE_BUTTONS"]) > 0:
                         self.ALLOWED_VOTE_BUTTONS = settings_dict["ALLOWED_VOTE_BUTTONS"]
+                    common.settings_changed()
             except BaseException:
                 print(traceback.format_exc())
 
@@ -345,6 +372,7 @@ class SquadQueue(commands.Cog):
     @commands.Cog.listener()
     async def on_ready(self):
         self.GUILD = self.bot.get_guild(self.bot.config["guild_id"])
+        mogi_objects.set_member_resolver(self.GUILD.get_member)
         self.MOGI_CHANNEL = self.bot.get_channel(
             self.bot.config["queue_join_channel"])
         self.SUB_CHANNEL = self.bot.get_channel(
@@ -403,17 +431,10 @@ class SquadQueue(commands.Cog):
         print(f"General Channel - {self.GENERAL_CHANNEL}", flush=True)
         print(f"Schedule Channel - {self.SCHEDULE_CHANNEL}", flush=True)
         print("Ready!", flush=True)
-        self.refresh_ratings.start()
+        self.ratings_scheduler.start()
         self.refresh_helper_roles.start()
         self.check_room_threads_task.start()
 
-        try:
-            await self.ratings.update_ratings()
-            self.last_refreshed_rating_time: datetime = datetime.now(
-                timezone.utc)
-        except Exception as e:
-            print(traceback.format_exc())
-
         if not common.CONFIG["USE_THREADS"]:
             self.maintain_roles.start()
 
@@ -450,17 +471,15 @@ class SquadQueue(commands.Cog):
             if delay > 0:
                 await sendmsg.delete(delay=delay)
 
-    # Support for both server to implement their own algorithm for a player list being allowed
-    # For now, both servers have a simple rating range check that a list of players must meet,
-    # but each server could implement more complex checks on a given list of
-    # players.
-    def allowed_players_check(self, players: List[Player]):
-        if common.SERVER is common.Server.MKW:
-            return mkw_players_allowed(players, self.room_mmr_threshold)
-        elif common.SERVER is common.Server.MK8DX:
-            return mk8dx_players_allowed(players, self.room_mmr_threshold)
-        elif common.SERVER is common.Server.MKWorld:
-            return mkworld_players_allowed(players, self.room_mmr_threshold)
+    # Each server selects the algorithm for a player list being allowed by name in the config (ROOM_VALIDITY_CHECK).
+    # For now, every server's check is a simple rating range check that a list of players must meet, but a server
+    # could register a more complex check on a given list of players. If a check is not a plain range check,
+    # register it without range_only.
+    @property
+    def allowed_players_check(self) -> PlayersAllowedCheck:
+        strategy = matchmaking.get(matchmaking.VALIDITY)
+        return PlayersAllowedCheck(
+            strategy, self.room_mmr_threshold, range_only=strategy.attributes.get("range_only", False))
 
     # goes thru the msg queue for each channel and combines them
     # into as few messsages as possible, then sends them
@@ -582,9 +601,7 @@ class SquadQueue(commands.Cog):
             await interaction.response.send_message("Queue has not started yet.")
             return
 
-        player_team = mogi.check_player(member)
-        player = None if player_team is None else player_team.get_player(
-            member)
+        player = mogi.get_player(member)
 
         if player is not None:
             original_host_status = player.host
@@ -606,9 +623,28 @@ class SquadQueue(commands.Cog):
                 await interaction.response.send_message(f"{interaction.user.mention} is already signed up.")
             return
 
+        # A player who isn't in the ratings table is looked up on the lounge
+        # API, which can take longer than Discord allows to respond
+        await interaction.response.defer()
+
         # FIRST look up the player - sometimes MK8DX bots add placement role to non placement players,
         # so this will check the leaderboard first
-        players = self.ratings.get_rating([member])
+        try:
+            players = await self.ratings.get_rating([member])
+        except mmr.RatingsNotReady:
+            await interaction.followup.send(
+                f"{interaction.user.mention} the bot is still loading player ratings, so joining the queue was "
+                f"unsuccessful.  Please try again in a minute.")
+            return
+
+        # The queue may have closed, or the player may have joined with
+        # another command, while their rating was being looked up
+        if not mogi.gathering:
+            await interaction.followup.send("Queue has closed.")
+            return
+        if mogi.get_player(member) is not None:
+            await interaction.followup.send(f"{interaction.user.mention} is already signed up.")
+            return
 
         msg = ""
         # If the no rating was found...
@@ -627,7 +663,7 @@ class SquadQueue(commands.Cog):
                 msg = f"{interaction.user.mention} fetch for MMR has failed and joining the queue was " \
                       f"unsuccessful.  Please try again.  If the problem continues then contact a staff member " \
                       f"for help."
-                await interaction.response.send_message(msg)
+                await interaction.followup.send(msg)
                 return
 
         players[0].confirmed = True
@@ -636,7 +672,7 @@ class SquadQueue(commands.Cog):
         mogi.teams.append(squad)
         host_str = " as a host " if host else " "
         format_str = f"__**{mogi.format}**__ " if mogi.format else ""
-        player_amount_str = f"{self.ongoing_event.players_per_room} player " if common.SERVER is common.Server.MKWorld else ""
+        player_amount_str = f"{mogi.players_per_room} player " if common.SERVER is common.Server.MKWorld else ""
         msg += f"{discord.utils.escape_markdown(players[0].lounge_name)} joined the {player_amount_str}{format_str}queue{host_str}closing at {discord.utils.format_dt(mogi.start_time)}, `[{mogi.count_registered()} players]`"
         if common.SERVER is common.Server.MKW:
             if players[0].is_matchmaking_mmr_adjusted:
@@ -644,7 +680,7 @@ class SquadQueue(commands.Cog):
 
         event_status_launched = await self.check_close_event_change()
         try:
-            await interaction.response.send_message(msg)
+            await interaction.followup.send(msg)
         finally:
             if event_status_launched:
                 await self.launch_mogi()
@@ -726,15 +762,10 @@ class SquadQueue(commands.Cog):
         """Given an interaction, returns the Room and room number associated with the interaction.
         Searches current and old, undeleted events. If the interaction is not associated with a Room,
         (None, 1) is returned."""
-        all_mogis = list(self.old_events)
-        if self.ongoing_event is not None:
-            all_mogis.insert(0, self.ongoing_event)
-        for mogi in all_mogis:
-            if mogi.channel_id_in_rooms(interaction.channel.id):
-                room = mogi.get_room_from_channel_id(interaction.channel.id)
-                bottom_room_num = len(mogi.rooms)
-                return room, bottom_room_num
-        return None, 1
+        mogi, room = self.room_registry.get(interaction.channel.id)
+        if room is None:
+            return None, 1
+        return room, len(mogi.rooms)
 
     @app_commands.command(name="sub")
     @app_commands.guild_only()
@@ -797,7 +828,7 @@ class SquadQueue(commands.Cog):
             first_late_player_index = (
                 mogi.num_players // mogi.players_per_room) * mogi.players_per_room
             on_time_players = sorted(
-                all_confirmed_players[:first_late_player_index], reverse=True)
+                all_confirmed_players[:first_late_player_index], key=player_sort_key, reverse=True)
             late_players = all_confirmed_players[first_late_player_index:]
 
             msg = f"**Queue Closing: {discord.utils.format_dt(mogi.start_time)}**\n"
@@ -817,14 +848,14 @@ class SquadQueue(commands.Cog):
                     adjusted_mmr_text = f"MMR -> {player.adjusted_mmr} " if player.is_matchmaking_mmr_adjusted else ""
                     msg += f"`{i}.` {discord.utils.escape_markdown(player.lounge_name)} ({player.mmr} {adjusted_mmr_text}MMR)\n"
             elif common.SERVER is common.Server.MK8DX:
-                all_confirmed_players.sort(reverse=True)
+                all_confirmed_players.sort(key=player_sort_key, reverse=True)
                 for i, player in enumerate(all_confirmed_players, 1):
                     late_str = " `*`" if player in late_players else ""
                     msg += f"`{i}.` {discord.utils.escape_markdown(player.lounge_name)} ({player.mmr} MMR){late_str}\n"
                     if i % mogi.players_per_room == 0:
                         msg += "ㅤ\n"
             elif common.SERVER is common.Server.MKWorld:
-                all_confirmed_players.sort(reverse=True)
+                all_confirmed_players.sort(key=player_sort_key, reverse=True)
                 for i, player in enumerate(all_confirmed_players, 1):
                     late_str = " `*`" if player in late_players else ""
                     msg += f"`{i}.` {discord.utils.escape_markdown(player.lounge_name)} ({player.mmr} MMR){late_str}\n"
@@ -966,31 +997,19 @@ class SquadQueue(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        if message.author.bot or not (
-            message.content.isdecimal() and 12 <= int(
-                message.content) <= 180):
+        # Most messages aren't in a room channel, so reject them before
+        # looking at the message at all
+        if message.channel.id not in self.room_registry.active_channel_ids:
             return
-        mogi = None
-        if self.ongoing_event is not None:
-            mogi = self.ongoing_event if self.ongoing_event.channel_id_in_rooms(
-                message.channel.id) else None
-        if mogi is None:
-            mogi = discord.utils.find(lambda m: m.channel_id_in_rooms(
-                message.channel.id), self.old_events)
-        if mogi is None:
+        if message.author.bot or not message.content.isdecimal():
             return
-        room = discord.utils.find(
-            lambda r: r.channel.id == message.channel.id, mogi.rooms)
-        if room is None or not room.teams:
+        score = int(message.content)
+        if not 12 <= score <= 180:
             return
-        team = discord.utils.find(
-            lambda t: t.has_player(message.author), room.teams)
-        if team is None:
+        _, room = self.room_registry.get(message.channel.id)
+        if room is None or room.check_player(message.author) is None:
             return
-        player = discord.utils.find(
-            lambda p: p.member.id == message.author.id, team.players)
-        if player is not None:
-            player.score = int(message.content)
+        room.scores.record(message.author.id, score, message.created_at)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
@@ -1015,27 +1034,19 @@ class SquadQueue(commands.Cog):
             await interaction.response.send_message(f"Cannot use this command here.", ephemeral=True)
             return
 
-        mogi = discord.utils.find(lambda mogi: mogi.channel_id_in_rooms(
-            interaction.channel_id), self.old_events)
-        if not mogi:
+        mogi, room = self.room_registry.get(interaction.channel_id)
+        # The scoreboard is only available once the event has finished
+        # gathering and moved to the old events
+        if mogi is None or mogi is self.ongoing_event:
             await interaction.response.send_message(f"The Mogi object cannot be found.", ephemeral=True)
             return
 
-        room = discord.utils.find(
-            lambda room: room.channel.id == interaction.channel_id, mogi.rooms)
         if not room:
             await interaction.response.send_message(f"The Thread object cannot be found.", ephemeral=True)
             return
 
         format_ = round(mogi.players_per_room / len(room.teams))
-
-        msg = f"!submit {format_} {room.tier}\n"
-        for team in room.teams:
-            for player in team.players:
-                msg += f"{discord.utils.escape_markdown(player.lounge_name)} {player.score}\n"
-            if format_ != 1:
-                msg += "\n"
-        await interaction.response.send_message(msg)
+        await interaction.response.send_message(room.scores.scoreboard(format_))
 
     @app_commands.command(name="remove_player")
     @app_commands.guild_only()
@@ -1094,6 +1105,7 @@ class SquadQueue(commands.Cog):
     async def annul_current_mogi(self, interaction: discord.Interaction, resume_mogis_after: bool):
         """The mogi currently gathering will be deleted.  resume_mogis_after determines whether future mogis will be scheduled.  Staff use only."""
         self.next_event = None
+        self.room_registry.remove_mogi(self.ongoing_event)
         self.ongoing_event = None
         self.LAUNCH_NEW_EVENTS = False
         msg = "The current mogi has been cancelled, "
@@ -1183,6 +1195,45 @@ class SquadQueue(commands.Cog):
         msg += f"MATCHMAKING TOP MMR: {common.CONFIG['MATCHMAKING_TOP_MMR']}"
         await interaction.response.send_message(msg)
 
+    @app_commands.command(name="matchmaking_stats")
+    @app_commands.guild_only()
+    async def matchmaking_stats(self, interaction: discord.Interaction, reset: bool = False):
+        """View the selected matchmaking strategies and how long they have taken.  Staff use only."""
+        msg = matchmaking.stats_str()
+        if reset:
+            matchmaking.reset_stats()
+            msg += "Matchmaking stats have been reset."
+        await interaction.response.send_message(msg)
+
+    @app_commands.command(name="ratings_stats")
+    @app_commands.guild_only()
+    async def ratings_stats(self, interaction: discord.Interaction, reset: bool = False):
+        """View how ratings pulls and lounge API requests have gone.  Staff use only."""
+        msg = ""
+        if self.ratings.last_pull is not None:
+            msg += f"Last ratings pull: {discord.utils.format_dt(self.ratings.last_pull, style='R')} ({self.ratings.last_pull_result})\n"
+        if self.ratings.last_parse_seconds is not None:
+            msg += f"Last parse: {self.ratings.last_parse_seconds * 1000:.1f}ms ({self.ratings.parse_executor})\n"
+        if self.ratings_schedule.failures > 0:
+            msg += f"Failed pulls in a row: {self.ratings_schedule.failures}, trying again {discord.utils.format_dt(self.ratings_schedule.retry_at, style='R')}\n"
+        msg += http_client.stats_str()
+        if reset:
+            http_client.reset_stats()
+            msg += "Request stats have been reset."
+        await interaction.response.send_message(msg)
+
+    @app_commands.command(name="reload_tier_tables")
+    @app_commands.guild_only()
+    async def reload_tier_tables(self, interaction: discord.Interaction):
+        """Reload the room tier tables from the config file.  Staff use only."""
+        try:
+            tiers.reload_tables()
+        except Exception as e:
+            print(traceback.format_exc(), flush=True)
+            await interaction.response.send_message(f"Failed to reload the tier tables, the current tables were kept: {e}")
+            return
+        await interaction.response.send_message(f"Reloaded the tier tables:\n{tiers.tables_str()}")
+
     @app_commands.command(name="reset_bot")
     @app_commands.guild_only()
     async def reset_bot(self, interaction: discord.Interaction):
@@ -1676,7 +1727,7 @@ class SquadQueue(commands.Cog):
         num_created_rooms = len(mogi.rooms)
         for i in range(num_created_rooms, mogi.max_possible_rooms):
             if not common.CONFIG["USE_THREADS"]:
-                mogi.rooms.append(Room(None, i + 1, None, self.TIER_INFO))
+                mogi.add_room(Room(None, i + 1, None, self.TIER_INFO))
                 continue
             display_time = mogi.display_time
             minute = display_time.minute
@@ -1698,7 +1749,7 @@ class SquadQueue(commands.Cog):
                 err_msg = f"\nAn error has occurred while creating a room channel:\n{e}"
                 await mogi.mogi_channel.send(err_msg)
                 return
-            mogi.rooms.append(Room(None, i + 1, room_channel, self.TIER_INFO))
+            mogi.add_room(Room(None, i + 1, room_channel, self.TIER_INFO))
 
     @staticmethod
     async def handle_voting_and_history(mogi: Mogi, history_channel: discord.TextChannel):
@@ -1717,8 +1768,17 @@ class SquadQueue(commands.Cog):
         if mogi.making_rooms_run and started_automatically:
             return
 
+        # Players' MMRs were looked up when they joined, so they are brought up
+        # to date with the ratings pulled shortly before the queue closed
+        if self.ratings.first_run_complete:
+            async with self.ratings.publish_lock:
+                num_changed = mogi.update_player_mmrs(
+                    self.ratings.get_rating_from_discord_id)
+            print(f"Updated the MMR of {num_changed} queued players before making rooms.", flush=True)
+
         await self.lockdown(mogi.mogi_channel)
         if mogi.max_possible_rooms == 0:
+            self.room_registry.remove_mogi(mogi)
             self.ongoing_event = None
             await mogi.mogi_channel.send(f"Not enough players to fill a single room! This mogi will be cancelled.")
             format_str = f"{mogi.format} " if mogi.format else ""
@@ -1795,7 +1855,7 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
                 # The below try/except clause around Room.prepare_room_channel
                 # only runs if the config's USE_THREADS is set to false
                 try:
-                    await curr_room.prepare_room_channel(self.GUILD, all_events=([self.ongoing_event] + self.old_events))
+                    await curr_room.prepare_room_channel(self.GUILD, self.room_registry)
                 # Non-fatal error, message already sent to room channel,
                 # continue with room creation
                 except mogi_objects.RoleAddFailure:
@@ -1863,6 +1923,7 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
         if mogi.format or mogi.players_per_room != self.PLAYERS_PER_ROOM:
             if self.SCHEDULE_CHANNEL:
                 await self.update_schedule_channel()
+        self.ongoing_event.release_members()
         self.old_events.append(self.ongoing_event)
         self.ongoing_event = None
 
@@ -1972,6 +2033,7 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
             # This is potentially an issue - we should be checking if make
             # rooms has been run, not if it's started...?
             if self.ongoing_event is not None and self.ongoing_event.started:
+                self.ongoing_event.release_members()
                 self.old_events.append(self.ongoing_event)
 
             # Put the next mogi as the current event and launch it
@@ -2073,6 +2135,7 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
                     self.sq_times) > 0 and next_event_open_time + self.JOINING_TIME + self.DISPLAY_OFFSET_MINUTES == self.sq_times[0]:
                 self.sq_times.pop(0)
                 self.next_event = None
+                self.room_registry.remove_mogi(self.ongoing_event)
                 self.ongoing_event = None
                 self.LAUNCH_NEW_EVENTS = False
                 next_event_start_time = next_event_open_time + self.QUEUE_OPEN_TIME
@@ -2093,7 +2156,8 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
                                    is_automated=True,
                                    start_time=next_event_start_time,
                                    display_time=next_event_display_time,
-                                   format=format)
+                                   format=format,
+                                   room_registry=self.room_registry)
 
             print(f"Started Queue for {next_event_start_time}", flush=True)
 
@@ -2110,6 +2174,7 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
                     f"Deleting {mogi.start_time} Mogi at {curr_time}",
                     flush=True)
                 self.old_events.remove(mogi)
+                self.room_registry.remove_mogi(mogi)
         except Exception as e:
             print(traceback.format_exc())
 
@@ -2207,37 +2272,64 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
         interaction: discord.Interaction
     ):
         await interaction.response.defer(ephemeral=True, thinking=True)
-        try:
-            await self.ratings.update_ratings()
-            self.last_refreshed_rating_time = datetime.now(timezone.utc)
+        if await self.refresh_ratings():
             await interaction.followup.send("Successfully refreshed internal mmr list.")
-        except Exception:
-            print(traceback.format_exc(), flush=True)
-            await interaction.followup.send("Failed to refresh internal mmr list.")
+        else:
+            await interaction.followup.send(
+                f"Failed to refresh internal mmr list. It will be tried again {discord.utils.format_dt(self.ratings_schedule.retry_at, style='R')}.")
 
-    @tasks.loop(minutes=30)
-    async def refresh_ratings(self):
-        """Refreshes the ratings"""
+    async def refresh_ratings(self) -> bool:
+        """Refreshes the ratings, waiting for any refresh already running to finish first. A failed refresh is tried
+        again by the ratings scheduler. Returns whether the ratings were refreshed."""
+        async with self.ratings_refresh_lock:
+            try:
+                success = await self.ratings.update_ratings()
+            except http_client.EndpointUnavailable as e:
+                print(f"Failed to refresh ratings: {e}", flush=True)
+                success = False
+            except Exception:
+                print(traceback.format_exc(), flush=True)
+                success = False
+        now = datetime.now(timezone.utc)
+        if success:
+            self.last_refreshed_rating_time = now
+            self.ratings_schedule.record_success()
+        else:
+            self.ratings_schedule.record_failure(now)
+        return success
+
+    def next_queue_close_time(self) -> datetime | None:
+        """Returns when the next queue that hasn't had its rooms made closes, or None if no queue is scheduled."""
+        mogi = self.ongoing_event
+        if mogi is not None and mogi.gathering and not mogi.making_rooms_run:
+            return mogi.start_time
+        if self.next_event is not None:
+            return self.next_event.start_time
+        if not self.LAUNCH_NEW_EVENTS:
+            return None
+        next_event_start_time = self.compute_next_event_open_time() + self.JOINING_TIME
+        if next_event_start_time < datetime.now(timezone.utc):
+            next_event_start_time += self.QUEUE_OPEN_TIME
+        return next_event_start_time
+
+    @tasks.loop(seconds=30)
+    async def ratings_scheduler(self):
+        """Refreshes the ratings shortly before each queue closes, and now and then between queues"""
         try:
-            await self.ratings.update_ratings()
-            self.last_refreshed_rating_time = datetime.now(
-                timezone.utc)
+            # The ratings are already being refreshed
+            if self.ratings_refresh_lock.locked():
+                return
+            now = datetime.now(timezone.utc)
+            next_refresh = self.ratings_schedule.next_refresh(
+                now, self.ratings.last_pull, self.next_queue_close_time())
+            if next_refresh is not None and next_refresh <= now:
+                await self.refresh_ratings()
         except Exception as e:
             print(traceback.format_exc(), flush=True)
 
-    @refresh_ratings.before_loop
-    async def before_refresh_ratings(self):
+    @ratings_scheduler.before_loop
+    async def before_ratings_scheduler(self):
         await self.bot.wait_until_ready()
-        now = datetime.now(timezone.utc)
-        next_run = now.replace(second=0, microsecond=0)
-
-        if now.minute < 30:
-            next_run = next_run.replace(minute=30)
-        else:
-            next_run = (next_run + timedelta(hours=1)).replace(minute=0)
-
-        sleep_seconds = (next_run - now).total_seconds()
-        await asyncio.sleep(sleep_seconds)
 
     def get_event_str(self, mogi: Mogi):
         mogi_time = discord.utils.format_dt(mogi.start_time, style="F")
@@ -2393,7 +2485,7 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
                 member = await self.bot.fetch_user(318637887597969419)
         check_players = [member]
         check_players.extend(members)
-        players = self.ratings.get_rating(check_players)
+        players = await self.ratings.get_rating(check_players)
         player_member = member
         player_name = member.display_name
         player_mmr = 5000
@@ -2462,7 +2554,7 @@ If you need staff's assistance, use the `/ping_staff` command in this channel.""
                 member = await self.bot.fetch_user(318637887597969419)
         check_players = [member]
         check_players.extend(members)
-        players = self.ratings.get_rating(check_players)
+        players = await self.ratings.get_rating(check_players)
         for i in range(0, num_times):
             player = Player(players[0].member,
                             f"{players[0].lounge_name}{i + 1}",
@@ -26,6 +26,24 @@ else:
         f"{CONFIG['lounge']} is not a valid option for the 'lounge' attribute in the config.")
 
 
+# Incremented whenever a setting that matchmaking depends on changes while the bot is running. Values computed from
+# those settings (such as each Player's clamped MMR) are cached against it.
+SETTINGS_GENERATION = 0
+
+
+def settings_changed():
+    """Marks values computed from the matchmaking settings as out of date. Call this after changing any of them."""
+    global SETTINGS_GENERATION
+    SETTINGS_GENERATION += 1
+
+
+def set_matchmaking_mmr_bounds(bottom_mmr: int | None, top_mmr: int | None):
+    """Sets the ratings that players below and above are considered for matchmaking purposes."""
+    CONFIG["MATCHMAKING_BOTTOM_MMR"] = bottom_mmr
+    CONFIG["MATCHMAKING_TOP_MMR"] = top_mmr
+    settings_changed()
+
+
 def divide_chunks(list_: list, chunk_size: int):
     # looping till length l
     for i in range(0, len(list_), chunk_size):
@@ -0,0 +1,215 @@
+"""The bot's shared HTTP client.
+
+Every request to an external API goes through one aiohttp session, so connections (and their DNS lookups, TCP and
+TLS handshakes) are pooled and kept alive between requests instead of being made again for every request. The
+session is created when the bot starts (setup_hook) and closed when it shuts down.
+
+Requests are made to a named endpoint (see ENDPOINTS). Each endpoint has its own timeout and limit on how many of
+its requests can be in flight at once, so a slow endpoint can't use up the whole connection pool.
+
+Each endpoint also has a circuit breaker. After failure_threshold failed requests in a row, requests to the endpoint
+fail straight away with EndpointUnavailable instead of waiting for the API to time out again. After a while (which
+doubles, with jitter, each time the breaker opens again), one request is let through to check if the API is back.
+Every endpoint counts its requests, failures and latency for staff to read (see stats_str)."""
+import asyncio
+import contextlib
+import random
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict
+
+import aiohttp
+
+# Connections kept open per host, and for how long an idle connection is kept
+CONNECTIONS_PER_HOST = 8
+KEEPALIVE_SECONDS = 60
+DNS_CACHE_SECONDS = 300
+
+
+class EndpointUnavailable(aiohttp.ClientError):
+    """Raised instead of making a request while an endpoint's circuit breaker is open."""
+    pass
+
+
+@dataclass
+class Endpoint:
+    timeout: aiohttp.ClientTimeout
+    max_concurrent_requests: int
+    # Failed requests in a row before the circuit breaker opens
+    failure_threshold: int = 3
+    # How long the breaker stays open the first time, and at most
+    open_seconds: float = 30
+    max_open_seconds: float = 600
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Returns how many seconds to wait before the given retry (0 for the first), doubling from base up to maximum.
+    The delay is picked at random from the upper half of that, so retries from many callers don't line up."""
+    delay = min(base * 2 ** attempt, maximum)
+    return random.uniform(delay / 2, delay)
+
+
+class CircuitBreaker:
+    """Tracks whether an endpoint is failing, and its request, failure and latency counters."""
+
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        self.consecutive_failures = 0
+        # How many times the breaker has opened since the last success
+        self.times_opened = 0
+        # time.monotonic() until which requests are rejected
+        self.open_until: float | None = None
+        # Whether a request has been let through to check if the API is back
+        self.probing = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests = 0
+        self.responses = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+        self.last_error: str | None = None
+
+    @property
+    def average_ms(self) -> float:
+        return self.total_ms / self.responses if self.responses > 0 else 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self.open_until is not None
+
+    def open_seconds_left(self) -> float:
+        return 0.0 if self.open_until is None else max(self.open_until - time.monotonic(), 0.0)
+
+    def before_request(self):
+        """Raises EndpointUnavailable if the breaker is open, unless it is time to let one request through."""
+        if self.open_until is None:
+            return
+        if self.probing or time.monotonic() < self.open_until:
+            self.rejected += 1
+            raise EndpointUnavailable(
+                f"Not making the request, the API has failed {self.consecutive_failures} times in a row. Trying again in {self.open_seconds_left():.0f}s.")
+        self.probing = True
+
+    def record_latency(self, elapsed_ms: float):
+        """Records how long a request took to get a response."""
+        self.responses += 1
+        self.total_ms += elapsed_ms
+        self.last_ms = elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.times_opened = 0
+        self.open_until = None
+        self.probing = False
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        self.probing = False
+        if self.open_until is not None or self.consecutive_failures >= self.endpoint.failure_threshold:
+            open_seconds = backoff_delay(self.times_opened, self.endpoint.open_seconds,
+                                         self.endpoint.max_open_seconds)
+            self.times_opened += 1
+            self.open_until = time.monotonic() + open_seconds
+            print(f"Circuit breaker opened for {open_seconds:.0f}s after {self.consecutive_failures} failed requests in a row: {error}",
+                  flush=True)
+
+
+RATINGS = "ratings"
+RATING_LOOKUP = "rating_lookup"
+HOST_FCS = "host_fcs"
+
+ENDPOINTS: Dict[str, Endpoint] = {
+    # The full player list can take a while to download, but a stalled
+    # connection shouldn't hold up the refresh
+    RATINGS: Endpoint(aiohttp.ClientTimeout(total=300, sock_connect=10, sock_read=60), max_concurrent_requests=1),
+    # Players missing from the ratings are looked up while they wait to join
+    # the queue, and the interaction has to be answered within 3 seconds
+    RATING_LOOKUP: Endpoint(aiohttp.ClientTimeout(total=2), max_concurrent_requests=4),
+    # Host friend codes are looked up while rooms are being made
+    HOST_FCS: Endpoint(aiohttp.ClientTimeout(total=5), max_concurrent_requests=4),
+}
+
+SESSION: aiohttp.ClientSession | None = None
+_SEMAPHORES: Dict[str, asyncio.Semaphore] = {}
+BREAKERS: Dict[str, CircuitBreaker] = {name: CircuitBreaker(endpoint) for name, endpoint in ENDPOINTS.items()}
+
+
+async def start():
+    """Creates the shared session. Must be called from the event loop the bot runs on."""
+    global SESSION
+    if SESSION is not None and not SESSION.closed:
+        return
+    connector = aiohttp.TCPConnector(limit_per_host=CONNECTIONS_PER_HOST, keepalive_timeout=KEEPALIVE_SECONDS,
+                                     ttl_dns_cache=DNS_CACHE_SECONDS)
+    SESSION = aiohttp.ClientSession(connector=connector)
+    _SEMAPHORES.clear()
+    for name, endpoint in ENDPOINTS.items():
+        _SEMAPHORES[name] = asyncio.Semaphore(endpoint.max_concurrent_requests)
+
+
+async def close():
+    global SESSION
+    if SESSION is not None:
+        await SESSION.close()
+    SESSION = None
+
+
+@contextlib.asynccontextmanager
+async def request(endpoint: str, method: str, url: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+    """Makes a request to the given endpoint with the shared session, waiting if the endpoint already has as many
+    requests in flight as it allows. Use as an async context manager, like aiohttp's session.request. The session is
+    started if it hasn't been, for code that runs outside the bot (tests, scripts).
+
+    Raises EndpointUnavailable straight away if the endpoint's circuit breaker is open. Whether the request failed is
+    decided before the response is handed over, from connection errors, timeouts and 429 or 5xx responses only, so
+    what the caller does with the body never affects the breaker."""
+    if SESSION is None or SESSION.closed:
+        await start()
+    breaker = BREAKERS[endpoint]
+    breaker.before_request()
+    breaker.requests += 1
+    async with _SEMAPHORES[endpoint], contextlib.AsyncExitStack() as stack:
+        start_time = time.perf_counter()
+        try:
+            response = await stack.enter_async_context(
+                SESSION.request(method, url, timeout=ENDPOINTS[endpoint].timeout, **kwargs))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.record_failure(f"{url}: {type(e).__name__} {e}")
+            raise
+        except BaseException:
+            # The request was cancelled before the API answered, which
+            # doesn't say anything about the API
+            breaker.probing = False
+            raise
+        breaker.record_latency((time.perf_counter() - start_time) * 1000)
+        if response.status == 429 or response.status >= 500:
+            breaker.record_failure(f"{url} returned status {response.status}")
+        else:
+            breaker.record_success()
+        yield response
+
+
+def reset_stats():
+    for breaker in BREAKERS.values():
+        breaker.reset_stats()
+
+
+def stats_str() -> str:
+    """Returns each endpoint's circuit breaker state and request counters, for staff to read."""
+    msg = ""
+    for name, breaker in BREAKERS.items():
+        state = f"open for {breaker.open_seconds_left():.0f}s" if breaker.is_open else "closed"
+        msg += (f"{name}: {breaker.requests} requests, {breaker.failures} failed, {breaker.rejected} rejected, "
+                f"avg {breaker.average_ms:.1f}ms, max {breaker.max_ms:.1f}ms, last {breaker.last_ms:.1f}ms, "
+                f"breaker {state}\n")
+        if breaker.last_error is not None:
+            msg += f"  Last error: {breaker.last_error}\n"
+    return msg
@@ -1,5 +1,6 @@
 import common
 import discord
+import http_client
 from discord.ext import commands
 import json
 import asyncio
@@ -7,8 +8,16 @@ import asyncio
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
-bot = commands.Bot(command_prefix=['!', '^'],
-                   case_insensitive=True, intents=intents, help_command=None)
+
+
+class QueueBot(commands.Bot):
+    async def close(self):
+        await super().close()
+        await http_client.close()
+
+
+bot = QueueBot(command_prefix=['!', '^'],
+               case_insensitive=True, intents=intents, help_command=None)
 
 initial_extensions = ['cogs.SquadQueue']
 bot.config = common.CONFIG
@@ -59,6 +68,7 @@ async def on_app_command_error(interaction: discord.Interaction, error: discord.
 
 @bot.event
 async def setup_hook():
+    await http_client.start()
     for extension in initial_extensions:
         await bot.load_extension(extension)
 
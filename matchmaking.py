@@ -0,0 +1,142 @@
+"""Registry of the matchmaking strategies each lounge can use.
+
+There are three kinds of strategy:
+- proposal: given a Mogi and a room validity check, returns the proposed list of players who will play
+- validity: given a list of players and a room MMR threshold, returns True if they are allowed to play together
+- tier: given a Room, returns the room's tier
+
+Modules register their own strategies by name with the register decorator, so this module does not import any of
+them. Each lounge selects a strategy of each kind by name in the config (see CONFIG_KEYS), and uses its server's
+default when the key is not set.
+
+Every call to a strategy is timed, so staff can see how long matchmaking takes with each strategy."""
+import time
+from typing import Callable, Dict, List
+
+import common
+
+PROPOSAL = "proposal"
+VALIDITY = "validity"
+TIER = "tier"
+
+CONFIG_KEYS = {
+    PROPOSAL: "MATCHMAKING_ALGORITHM",
+    VALIDITY: "ROOM_VALIDITY_CHECK",
+    TIER: "ROOM_TIER_FUNCTION",
+}
+
+DEFAULTS = {
+    common.Server.MKW: {PROPOSAL: "greedy", VALIDITY: "mkw", TIER: "mkw"},
+    common.Server.MK8DX: {PROPOSAL: "join_order", VALIDITY: "mk8dx", TIER: "mk8dx"},
+    common.Server.MKWorld: {PROPOSAL: "join_order", VALIDITY: "mkworld", TIER: "mkworld"},
+}
+
+
+class UnknownStrategy(ValueError):
+    pass
+
+
+class Strategy:
+    """A registered strategy. Calling it calls the strategy's function and records how long the call took."""
+
+    def __init__(self, kind: str, name: str, func: Callable, **attributes):
+        self.kind = kind
+        self.name = name
+        self.func = func
+        self.attributes = attributes
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.calls += 1
+            self.total_ms += elapsed_ms
+            self.last_ms = elapsed_ms
+            if elapsed_ms > self.max_ms:
+                self.max_ms = elapsed_ms
+
+    def reset_stats(self):
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+
+    @property
+    def average_ms(self) -> float:
+        return self.total_ms / self.calls if self.calls > 0 else 0.0
+
+    def __repr__(self):
+        return f"{__class__.__name__}(kind={self.kind}, name={self.name})"
+
+
+_STRATEGIES: Dict[str, Dict[str, Strategy]] = {
+    PROPOSAL: {}, VALIDITY: {}, TIER: {}}
+
+
+def register(kind: str, name: str, **attributes):
+    """Decorator that registers the decorated function as the strategy of the given kind with the given name. Any
+    keyword arguments are stored on the strategy's attributes (for example, range_only for validity checks). The
+    function itself is returned unchanged."""
+    if kind not in _STRATEGIES:
+        raise ValueError(f"Unknown matchmaking strategy kind: {kind}")
+
+    def decorator(func: Callable) -> Callable:
+        _STRATEGIES[kind][name] = Strategy(kind, name, func, **attributes)
+        return func
+    return decorator
+
+
+def selected_name(kind: str) -> str:
+    """Returns the name of the strategy of the given kind selected in the config, or the server's default."""
+    return common.CONFIG.get(CONFIG_KEYS[kind]) or DEFAULTS[common.SERVER][kind]
+
+
+def get(kind: str, name: str | None = None) -> Strategy:
+    """Returns the registered strategy of the given kind with the given name, or the one selected in the config if no
+    name is given. The same Strategy object is returned every time."""
+    if name is None:
+        name = selected_name(kind)
+    try:
+        return _STRATEGIES[kind][name]
+    except KeyError:
+        raise UnknownStrategy(
+            f"{name} is not a registered {kind} strategy. Registered {kind} strategies: {', '.join(registered(kind))}")
+
+
+def registered(kind: str) -> List[str]:
+    return sorted(_STRATEGIES[kind])
+
+
+def check_config():
+    """Raises UnknownStrategy if the config selects a strategy that has not been registered."""
+    for kind in _STRATEGIES:
+        get(kind)
+
+
+def all_strategies() -> List[Strategy]:
+    return [strategy for strategies in _STRATEGIES.values()
+            for strategy in strategies.values()]
+
+
+def reset_stats():
+    for strategy in all_strategies():
+        strategy.reset_stats()
+
+
+def stats_str() -> str:
+    """Returns the selected strategies and the timing of every strategy that has been called, for staff to read."""
+    msg = ""
+    for kind in _STRATEGIES:
+        msg += f"{kind.upper()} STRATEGY: {selected_name(kind)}\n"
+    for strategy in all_strategies():
+        if strategy.calls == 0:
+            continue
+        msg += (f"{strategy.kind} {strategy.name}: {strategy.calls} calls, avg {strategy.average_ms:.3f}ms, "
+                f"max {strategy.max_ms:.3f}ms, last {strategy.last_ms:.3f}ms, total {strategy.total_ms:.1f}ms\n")
+    return msg
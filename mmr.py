@@ -1,10 +1,25 @@
-import aiohttp
+from __future__ import annotations
+
+import http_client
 from mogi_objects import Player
 import common
 import discord
-from typing import List
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Tuple
 import asyncio
+import codecs
+import concurrent.futures
+import dill
+import functools
+import hashlib
+import json
+import os
+import re
+import time
 import traceback
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
 
 headers = {'Content-type': 'application/json'}
 
@@ -29,12 +44,467 @@ class BadPlayerData(BadRatingData):
     pass
 
 
-class Ratings:
+STREAM_CHUNK_SIZE = 64 * 1024
+
+RATINGS_SNAPSHOT_PKL = "./settings_data/ratings_snapshot.pkl"
+SNAPSHOT_VERSION = 2
+
+# How long to wait for other players to look up before sending a batch of
+# lookups for players who aren't in the table
+LOOKUP_BATCH_SECONDS = 0.05
+
+# Where rating responses are parsed: on the event loop as each chunk arrives,
+# in a worker thread as each chunk arrives, or in a worker process once the
+# whole response has arrived
+PARSE_INLINE = "inline"
+PARSE_THREAD = "thread"
+PARSE_PROCESS = "process"
+PARSE_EXECUTORS = (PARSE_INLINE, PARSE_THREAD, PARSE_PROCESS)
+
+# How long the refresh scheduler waits before trying a failed pull again.
+# The wait doubles after each failure in a row, up to the maximum, and is
+# jittered (see http_client.backoff_delay).
+REFRESH_RETRY_SECONDS = 60
+REFRESH_MAX_RETRY_SECONDS = 15 * 60
+
+# What a successful pull did
+PULL_FULL = "full"
+PULL_DELTA = "delta"
+# The API answered 304 Not Modified to a conditional full pull
+PULL_NOT_MODIFIED = "not modified"
+# A full pull's body was identical to the last full pull's
+PULL_UNCHANGED = "unchanged"
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_PLAYER_SEPARATOR = re.compile(r"[ \t\n\r]*,[ \t\n\r]*")
+_JSON_DECODER = json.JSONDecoder()
+
+
+class PlayerListStream:
+    """Incrementally parses a JSON object containing a list of players, fed to it in chunks of bytes as they arrive.
+
+    Each player in the list under list_key is passed to on_player as soon as it has been parsed and is not kept, so
+    the list is never held in memory all at once. The object's other top level values, which are small, are kept in
+    fields. Call close() after the last chunk; malformed JSON raises BadRatingData."""
+    # Parser states
+    _OBJECT_START, _FIRST_KEY, _KEY, _COLON, _VALUE, _AFTER_VALUE, _FIRST_PLAYER, _PLAYER, _AFTER_PLAYER, _END = range(
+        10)
+
+    def __init__(self, list_key: str, on_player: Callable[[dict], None]):
+        self.list_key = list_key
+        self.on_player = on_player
+        self.fields = {}
+        self.list_found = False
+        self.num_players = 0
+        self._utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._state = self._OBJECT_START
+        self._key = None
+        self._eof = False
+
+    def feed(self, chunk: bytes):
+        self._append(chunk, final=False)
+        self._parse()
+
+    def close(self):
+        self._append(b"", final=True)
+        self._eof = True
+        self._parse()
+        if self._state != self._END:
+            raise BadRatingData("JSON response ended unexpectedly.")
+        if self._skip_whitespace():
+            raise BadRatingData(
+                f"Unexpected data after the JSON response: {self._buffer[self._pos:self._pos + 50]!r}")
+
+    def _append(self, chunk: bytes, final: bool):
+        try:
+            text = self._utf8_decoder.decode(chunk, final)
+        except UnicodeDecodeError as e:
+            raise BadRatingData(f"JSON response is not valid UTF-8: {e}")
+        # Only the unparsed end of the buffer is kept
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+
+    def _skip_whitespace(self) -> bool:
+        """Skips whitespace in the buffer. Returns False if the end of the buffer was reached."""
+        self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+        return self._pos < len(self._buffer)
+
+    def _next_char(self, expected: str) -> str | None:
+        """Consumes and returns the next character, which must be one of the expected characters, or returns None if
+        more data is needed."""
+        if not self._skip_whitespace():
+            return None
+        char = self._buffer[self._pos]
+        if char not in expected:
+            if self._state == self._OBJECT_START:
+                raise BadRatingData("Response is not a dictionary")
+            raise BadRatingData(
+                f"Expected one of {expected!r} in JSON response, found {self._buffer[self._pos:self._pos + 50]!r}")
+        self._pos += 1
+        return char
+
+    def _next_value(self) -> Tuple[bool, object]:
+        """Decodes the next JSON value. Returns (False, None) if more data is needed."""
+        if not self._skip_whitespace():
+            return False, None
+        try:
+            value, end = _JSON_DECODER.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError as e:
+            if self._eof:
+                raise BadRatingData(f"Invalid JSON in response: {e}")
+            return False, None
+        if end == len(self._buffer) and not self._eof:
+            # A number at the end of the buffer may continue in the next chunk
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _parse_players(self) -> bool:
+        """Parses players until one is not followed by a comma, which is left for the _AFTER_PLAYER state. This is
+        where almost all of the response is parsed, so it avoids the per value overhead of the state machine. Returns
+        False if more data is needed."""
+        if not self._skip_whitespace():
+            return False
+        buffer = self._buffer
+        buffer_end = len(buffer) if self._eof else len(buffer) - 1
+        raw_decode = _JSON_DECODER.raw_decode
+        next_separator = _PLAYER_SEPARATOR.match
+        on_player = self.on_player
+        pos = self._pos
+        num_players = self.num_players
+        try:
+            while True:
+                try:
+                    player, end = raw_decode(buffer, pos)
+                except json.JSONDecodeError as e:
+                    if self._eof:
+                        raise BadRatingData(f"Invalid JSON in response: {e}")
+                    return False
+                # A player must be followed by something, or more data is
+                # needed to be sure it is complete
+                if end > buffer_end:
+                    return False
+                on_player(player)
+                num_players += 1
+                separator = next_separator(buffer, end)
+                if separator is None:
+                    pos = end
+                    return True
+                pos = separator.end()
+        finally:
+            self._pos = pos
+            self.num_players = num_players
+
+    def _parse(self):
+        """Parses as much of the buffer as possible."""
+        while self._state != self._END:
+            state = self._state
+            if state == self._OBJECT_START:
+                if self._next_char("{") is None:
+                    return
+                self._state = self._FIRST_KEY
+            elif state == self._FIRST_KEY:
+                if not self._skip_whitespace():
+                    return
+                if self._buffer[self._pos] == "}":
+                    self._pos += 1
+                    self._state = self._END
+                else:
+                    self._state = self._KEY
+            elif state == self._KEY:
+                complete, key = self._next_value()
+                if not complete:
+                    return
+                if not isinstance(key, str):
+                    raise BadRatingData(
+                        f"Expected a key in JSON response, found {key!r}")
+                self._key = key
+                self._state = self._COLON
+            elif state == self._COLON:
+                if self._next_char(":") is None:
+                    return
+                self._state = self._VALUE
+            elif state == self._VALUE:
+                if self._key == self.list_key:
+                    if not self._skip_whitespace():
+                        return
+                    if self._buffer[self._pos] != "[":
+                        raise BadRatingData(
+                            f"Key word '{self.list_key}' in JSON response is not a list.")
+                    self._pos += 1
+                    self.list_found = True
+                    self._state = self._FIRST_PLAYER
+                else:
+                    complete, value = self._next_value()
+                    if not complete:
+                        return
+                    self.fields[self._key] = value
+                    self._state = self._AFTER_VALUE
+            elif state == self._AFTER_VALUE:
+                char = self._next_char(",}")
+                if char is None:
+                    return
+                self._state = self._KEY if char == "," else self._END
+            elif state == self._FIRST_PLAYER:
+                if not self._skip_whitespace():
+                    return
+                if self._buffer[self._pos] == "]":
+                    self._pos += 1
+                    self._state = self._AFTER_VALUE
+                else:
+                    self._state = self._PLAYER
+            elif state == self._PLAYER:
+                if not self._parse_players():
+                    return
+                self._state = self._AFTER_PLAYER
+            elif state == self._AFTER_PLAYER:
+                char = self._next_char(",]")
+                if char is None:
+                    return
+                self._state = self._PLAYER if char == "," else self._AFTER_VALUE
+
+
+class RatingTable:
+    """A compact table of players' ratings and names, keyed by integer Discord ID.
+
+    Each player is a position in parallel arrays: their rating in an array of C ints and their name in a list. A dict
+    maps each Discord ID to the position. A table is filled by a single pull and never modified once it is published.
+    Names that haven't changed since the previous table are shared with it rather than stored again."""
+    __slots__ = ("_positions", "_mmrs", "_names")
+
     def __init__(self):
+        self._positions: Dict[int, int] = {}
+        self._mmrs = array("i")
+        self._names: List[str] = []
+
+    def add(self, discord_id: str, mmr: int, name: str, previous: RatingTable | None = None):
+        """Adds a player, replacing any player with the same Discord ID. Players whose Discord ID isn't a number are
+        skipped, since no member could be looked up with it. If the player has the same name in the previous table,
+        the previous table's name is stored."""
+        try:
+            discord_id = int(discord_id)
+        except ValueError:
+            return
+        if previous is not None:
+            previous_position = previous._positions.get(discord_id)
+            if previous_position is not None and previous._names[previous_position] == name:
+                name = previous._names[previous_position]
+        position = self._positions.get(discord_id)
+        try:
+            if position is None:
+                self._positions[discord_id] = len(self._mmrs)
+                self._mmrs.append(mmr)
+                self._names.append(name)
+            else:
+                self._mmrs[position] = mmr
+                self._names[position] = name
+        except OverflowError:
+            raise BadPlayerData(
+                f"Rating {mmr} for Discord ID {discord_id} is out of range")
+
+    def copy(self) -> RatingTable:
+        table = RatingTable()
+        table._positions = self._positions.copy()
+        table._mmrs = array("i", self._mmrs)
+        table._names = self._names.copy()
+        return table
+
+    def update(self, other: RatingTable):
+        """Adds every player in the other table, replacing any player with the same Discord ID."""
+        for discord_id, (mmr, name) in other.items():
+            position = self._positions.get(discord_id)
+            if position is None:
+                self._positions[discord_id] = len(self._mmrs)
+                self._mmrs.append(mmr)
+                self._names.append(name)
+            else:
+                self._mmrs[position] = mmr
+                self._names[position] = name
+
+    def get(self, discord_id: int) -> Tuple[int, str] | None:
+        """Returns (rating, name) for the player with the given Discord ID, or None if they aren't in the table."""
+        position = self._positions.get(discord_id)
+        if position is None:
+            return None
+        return self._mmrs[position], self._names[position]
+
+    def get_mmr(self, discord_id: int) -> int | None:
+        position = self._positions.get(discord_id)
+        if position is None:
+            return None
+        return self._mmrs[position]
+
+    def items(self) -> Iterator[Tuple[int, Tuple[int, str]]]:
+        """Yields (Discord ID, (rating, name)) for every player in the table."""
+        mmrs = self._mmrs
+        names = self._names
+        for discord_id, position in self._positions.items():
+            yield discord_id, (mmrs[position], names[position])
+
+    def __contains__(self, discord_id: int) -> bool:
+        return discord_id in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getstate__(self):
+        return self._positions, self._mmrs, self._names
+
+    def __setstate__(self, state):
+        self._positions, self._mmrs, self._names = state
+
+
+@dataclass
+class ParsedRatings:
+    """A parsed ratings response: a ready to publish table, the response's other top level fields and how long parsing
+    took. Returned from worker processes, so it only holds picklable data. The hash of the body is filled in by
+    whoever read it."""
+    table: RatingTable
+    fields: dict
+    list_found: bool
+    num_players: int
+    parse_seconds: float
+    content_hash: bytes | None = None
+
+
+class RatingsParser:
+    """Parses a ratings response body, fed to it in chunks, into a new RatingTable. The time spent parsing is
+    measured, wherever the parser runs."""
+
+    def __init__(self, list_key: str, player_adder: Callable[[RatingTable, RatingTable], Callable[[dict], None]],
+                 previous: RatingTable | None = None):
+        self.table = RatingTable()
+        self.stream = PlayerListStream(
+            list_key, player_adder(self.table, previous))
+        self.parse_seconds = 0.0
+
+    def feed(self, chunk: bytes):
+        start = time.perf_counter()
+        try:
+            self.stream.feed(chunk)
+        finally:
+            self.parse_seconds += time.perf_counter() - start
+
+    def close(self) -> ParsedRatings:
+        start = time.perf_counter()
+        try:
+            self.stream.close()
+        finally:
+            self.parse_seconds += time.perf_counter() - start
+        return ParsedRatings(self.table, self.stream.fields, self.stream.list_found, self.stream.num_players,
+                             self.parse_seconds)
+
+
+def parse_ratings_body(body: bytes, list_key: str,
+                       player_adder: Callable[[RatingTable, RatingTable], Callable[[dict], None]]) -> ParsedRatings:
+    """Parses a whole ratings response body. Runs in a worker process when RATINGS_PARSE_EXECUTOR is process."""
+    parser = RatingsParser(list_key, player_adder)
+    parser.feed(body)
+    return parser.close()
+
+
+class RefreshSchedule:
+    """Decides when the ratings should next be pulled.
+
+    A pull is aimed RATINGS_REFRESH_LEAD_MINUTES before each queue closes, so rooms are made with ratings that are at
+    most that old. Between queues, and when no queue is scheduled, the ratings are pulled every
+    RATINGS_IDLE_REFRESH_MINUTES, except during the UTC hours in RATINGS_IDLE_HOURS. Failed pulls are tried again
+    after a jittered wait that doubles with each failure in a row."""
+
+    def __init__(self):
+        self.lead = timedelta(
+            minutes=common.CONFIG.get("RATINGS_REFRESH_LEAD_MINUTES", 3))
+        self.idle_interval = timedelta(
+            minutes=common.CONFIG.get("RATINGS_IDLE_REFRESH_MINUTES", 120))
+        self.idle_hours = frozenset(common.CONFIG.get("RATINGS_IDLE_HOURS") or [])
+        # Failed pulls in a row, and when to try again after the last one
+        self.failures = 0
+        self.retry_at: datetime | None = None
+
+    def record_success(self):
+        self.failures = 0
+        self.retry_at = None
+
+    def record_failure(self, now: datetime):
+        self.retry_at = now + timedelta(seconds=http_client.backoff_delay(
+            self.failures, REFRESH_RETRY_SECONDS, REFRESH_MAX_RETRY_SECONDS))
+        self.failures += 1
+
+    def _skip_idle_hours(self, when: datetime) -> datetime | None:
+        """Returns the first time at or after when that isn't in an idle hour, or None if every hour is idle."""
+        for _ in range(24):
+            if when.hour not in self.idle_hours:
+                return when
+            when = when.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        return None
+
+    def next_refresh(self, now: datetime, last_pull: datetime | None,
+                     queue_close: datetime | None) -> datetime | None:
+        """Returns when the ratings should next be pulled, given when the last successful pull was started and when
+        the next queue closes (None if no queue is scheduled). Returns None if no pull should be scheduled."""
+        if last_pull is None:
+            due = now
+        else:
+            due = self._skip_idle_hours(max(last_pull + self.idle_interval, now))
+            if queue_close is not None:
+                target = queue_close - self.lead
+                # The pull for this queue has already been done
+                if last_pull < target:
+                    due = target if due is None else min(due, target)
+        if due is not None and self.retry_at is not None:
+            due = max(due, self.retry_at)
+        return due
+
+
+class Ratings:
+    def __init__(self, snapshot_path: str = RATINGS_SNAPSHOT_PKL):
         self.first_run_complete = False
-        self.ratings = {}
+        # Every pulled table is saved here, so it can be loaded straight away
+        # after a restart instead of waiting for the first pull
+        self.snapshot_path = snapshot_path
+        # Tables are never modified once they are published: a refresh builds
+        # a new table and swaps it in.
+        self.ratings = RatingTable()
+        # The table that was published before the current one
+        self.previous_ratings = RatingTable()
+        self.generation = 0
+        # Held while a pulled table is swapped in, and by anyone who must not
+        # see the table change, e.g. while queued players' MMRs are updated.
+        # It is never held during the download itself.
+        self.publish_lock = asyncio.Lock()
+        # When the last successful pull and full pull were started, and what
+        # the last successful pull did (one of the PULL_ constants)
+        self.last_pull: datetime | None = None
+        self.last_full_pull: datetime | None = None
+        self.last_pull_result: str | None = None
+        # The ETag, Last-Modified and body hash of the last full pull
+        self.etag: str | None = None
+        self.last_modified: str | None = None
+        self.content_hash: bytes | None = None
+        # Players who weren't in the table but were found by looking them up
+        # on their own, until the next table is published
+        self.looked_up_ratings: Dict[int, Tuple[int, str]] = {}
+        # Discord ID -> when a lookup that didn't find them expires
+        self._not_found: Dict[int, float] = {}
+        # Discord ID -> the result of the lookup they are waiting on
+        self._pending_lookups: Dict[int, asyncio.Future] = {}
+        # Discord IDs waiting for the next batch of lookups to be sent
+        self._lookup_batch: List[int] = []
+        self._lookup_task: asyncio.Task | None = None
+        # Where the last pull's response was parsed, and how long it took
+        self.parse_executor = common.CONFIG.get(
+            "RATINGS_PARSE_EXECUTOR") or PARSE_INLINE
+        if self.parse_executor not in PARSE_EXECUTORS:
+            raise ValueError(
+                f"RATINGS_PARSE_EXECUTOR must be one of {', '.join(PARSE_EXECUTORS)}, not {self.parse_executor}")
+        self._executor: concurrent.futures.Executor | None = None
+        self.last_parse_seconds: float | None = None
 
-    async def update_ratings(self):
+    async def update_ratings(self) -> bool:
+        """Pulls the ratings once. Returns whether the ratings were pulled; failed pulls are tried again by the
+        caller's RefreshSchedule, not here, so nothing waits on a retry."""
         if common.SERVER is common.Server.MK8DX:
             rating_func = self._pull_mk8dx_ratings
         elif common.SERVER is common.Server.MKW:
@@ -44,139 +514,331 @@ class Ratings:
         else:
             raise Exception("Unreachable code.")
 
+        generation = self.generation
         status = await rating_func()
-        # If we failed to pull ratings, wait 60 seconds and try again
         if not status:
-            print(
-                f"Failed to pull ratings for {common.SERVER.name}. Waiting 60 seconds and trying again.")
-            await asyncio.sleep(60)
-            status = await rating_func()
-            # If we failed to pull ratings again, fail.
-            if not status:
-                print(
-                    f"Failed to pull ratings for {common.SERVER.name} on 2nd attempt. Skipping.")
-                return
+            print(f"Failed to pull ratings for {common.SERVER.name}.")
+            return False
         self.first_run_complete = True
+        # Only a newly published table is worth saving. 304 and unchanged
+        # pulls keep the table that was already saved.
+        if self.generation != generation:
+            await self.save_snapshot()
+        return True
+
+    def age(self) -> timedelta | None:
+        """Returns how long ago the current table was pulled, or None if no table has been pulled or loaded."""
+        if self.last_pull is None:
+            return None
+        return datetime.now(timezone.utc) - self.last_pull
+
+    def _snapshot(self) -> dict:
+        return {
+            "version": SNAPSHOT_VERSION,
+            "url": Ratings._ratings_url(),
+            "ratings": self.ratings,
+            "last_pull": self.last_pull,
+            "last_full_pull": self.last_full_pull,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "content_hash": self.content_hash,
+        }
+
+    def _write_snapshot(self, snapshot: dict):
+        """Writes the snapshot to a temporary file and renames it over the snapshot file, so a crash while writing
+        never leaves a partly written snapshot."""
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            dill.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+    async def save_snapshot(self):
+        """Saves the current table and how it was pulled. Published tables are never modified, so the snapshot is
+        written from a thread while lookups carry on."""
+        try:
+            await asyncio.to_thread(self._write_snapshot, self._snapshot())
+        except Exception:
+            print("Failed to save the ratings snapshot.")
+            print(traceback.format_exc())
+
+    def load_snapshot(self) -> bool:
+        """Loads the table saved by the last successful pull, so ratings can be looked up before the first pull after
+        a restart finishes. The snapshot is ignored if it was pulled from a different URL or is older than
+        RATINGS_SNAPSHOT_MAX_AGE_MINUTES. Returns True if the snapshot was loaded."""
+        if not os.path.isfile(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = dill.load(f)
+            if snapshot.get("version") != SNAPSHOT_VERSION or snapshot["url"] != Ratings._ratings_url():
+                print("Ignoring the ratings snapshot, since it was saved for a different lounge or version.")
+                return False
+            max_age = timedelta(
+                minutes=common.CONFIG.get("RATINGS_SNAPSHOT_MAX_AGE_MINUTES", 1440))
+            age = datetime.now(timezone.utc) - snapshot["last_pull"]
+            if age > max_age:
+                print(f"Ignoring the ratings snapshot, since it is {age} old.")
+                return False
+        except Exception:
+            print("Failed to load the ratings snapshot.")
+            print(traceback.format_exc())
+            return False
+        self._publish(snapshot["ratings"])
+        self.last_pull = snapshot["last_pull"]
+        self.last_full_pull = snapshot["last_full_pull"]
+        self.etag = snapshot["etag"]
+        self.last_modified = snapshot["last_modified"]
+        self.content_hash = snapshot["content_hash"]
+        self.first_run_complete = True
+        print(f"Loaded {len(self.ratings)} ratings from a snapshot pulled {age} ago.", flush=True)
+        return True
+
+    @staticmethod
+    def _ratings_url() -> str:
+        """Returns the URL of the full player list for this lounge."""
+        if common.SERVER is common.Server.MK8DX:
+            return f"""{common.CONFIG["url"]}/api/player/list?game=mk8dx"""
+        elif common.SERVER is common.Server.MKW:
+            return f"""{common.CONFIG["url"]}/api/ladderplayer.php?ladder_type={common.CONFIG["track_type"]}&all&fields=discord_user_id,current_mmr,player_name"""
+        elif common.SERVER is common.Server.MKWorld:
+            return f"""{common.CONFIG["url"]}/api/player/list?game=mkworld{common.CONFIG["PLAYERS_PER_ROOM"]}p"""
+        else:
+            raise Exception("Unreachable code.")
+
+    @staticmethod
+    def _current_lounge_player_adder() -> Callable[[RatingTable, RatingTable], Callable[[dict], None]]:
+        """Returns the lounge player adder with the current placement MMR bound, since a worker process has its own
+        copy of the config."""
+        return functools.partial(Ratings._lounge_player_adder, placement_mmr=common.CONFIG["PLACEMENT_PLAYER_MMR"])
 
     async def _pull_mk8dx_ratings(self) -> bool:
-        url = f"""{common.CONFIG["url"]}/api/player/list?game=mk8dx"""
-        return await Ratings._pull_ratings(url, self._parse_mk8dx_ratings, self._validate_mk8dx_response)
+        return await self._pull_ratings(Ratings._ratings_url(), "players", 10000,
+                                        Ratings._current_lounge_player_adder())
 
     async def _pull_mkw_ratings(self) -> bool:
-        url = f"""{common.CONFIG["url"]}/api/ladderplayer.php?ladder_type={common.CONFIG["track_type"]}&all&fields=discord_user_id,current_mmr,player_name"""
-        return await Ratings._pull_ratings(url, self._parse_mkw_ratings, self._validate_mkw_response)
+        return await self._pull_ratings(Ratings._ratings_url(), "results", 1000, Ratings._mkw_player_adder,
+                                        Ratings._validate_mkw_fields)
 
     async def _pull_mkworld_ratings(self) -> bool:
-        url = f"""{common.CONFIG["url"]}/api/player/list?game=mkworld{common.CONFIG["PLAYERS_PER_ROOM"]}p"""
-        return await Ratings._pull_ratings(url, self._parse_mk8dx_ratings, self._validate_mkworld_response)
+        return await self._pull_ratings(Ratings._ratings_url(), "players", 100,
+                                        Ratings._current_lounge_player_adder())
 
-    @staticmethod
-    async def _pull_ratings(url, parser, validator) -> bool:
-        """Returns True if the ratings were pulled and successfully stored."""
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    print(f"{common.SERVER.name} returned status {response.status}")
-                    return False
-                data = await response.json()
-                try:
-                    validator(data)
-                except RatingRequestFailure:
-                    print(
-                        f"{common.SERVER.name}'s data from API was formatted incorrectly.")
-                    print(traceback.format_exc())
-                    return False
-                parser(data)
+    def _delta_since(self) -> datetime | None:
+        """Returns the time to request changed ratings since, or None if the next pull should be a full pull. Delta
+        pulls are only made if RATINGS_DELTA_PARAMETER is set, and a full pull is still made every
+        RATINGS_FULL_REFRESH_MINUTES, since a delta can't remove players from the table."""
+        if not common.CONFIG.get("RATINGS_DELTA_PARAMETER") or self.last_full_pull is None:
+            return None
+        full_refresh_interval = timedelta(
+            minutes=common.CONFIG.get("RATINGS_FULL_REFRESH_MINUTES", 360))
+        if datetime.now(timezone.utc) - self.last_full_pull >= full_refresh_interval:
+            return None
+        return self.last_pull
+
+    def _forget_pull_validators(self):
+        """Forgets the ETag, Last-Modified and content hash of the last full pull, so the next full pull is parsed
+        and published even if the API's player list hasn't changed since then."""
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+
+    async def _pull_ratings(self, url: str, list_key: str, required_player_amount: int,
+                            player_adder: Callable[[RatingTable, RatingTable], Callable[[dict], None]],
+                            validate_fields: Callable[[dict], None] | None = None) -> bool:
+        """Returns True if the ratings were pulled and successfully stored.
+
+        Each player in the list under list_key is validated and added to a new ratings table in a single pass, so the
+        parsed player list is never held in memory all at once (see _parse_response). The new table is only published
+        if the whole response was valid; until then, lookups use the current table.
+
+        Refreshes are made as cheap as the API allows:
+        - Full pulls are conditional on the ETag and Last-Modified of the last full pull, if the API sent them. If the
+        API answers 304 Not Modified, the current table is kept.
+        - A hash of the body of each full pull is computed while it is read. If it matches the last full pull's, the
+        body is not parsed and the current table is kept.
+        - If RATINGS_DELTA_PARAMETER is set, pulls between full pulls only request the players whose ratings changed
+        since the last pull, and merge them into a copy of the current table."""
+        delta_since = self._delta_since()
+        request_headers = {}
+        if delta_since is None:
+            request_url = url
+            if self.etag is not None:
+                request_headers["If-None-Match"] = self.etag
+            if self.last_modified is not None:
+                request_headers["If-Modified-Since"] = self.last_modified
+        else:
+            request_url = f"{url}&{common.CONFIG['RATINGS_DELTA_PARAMETER']}={quote(delta_since.isoformat())}"
+        pull_started = datetime.now(timezone.utc)
+        async with http_client.request(http_client.RATINGS, "GET", request_url, headers=request_headers) as response:
+            if response.status == 304 and request_headers:
+                self.last_pull = self.last_full_pull = pull_started
+                self.last_pull_result = PULL_NOT_MODIFIED
                 return True
+            if response.status != 200:
+                print(f"{common.SERVER.name} returned status {response.status}")
+                return False
+            try:
+                parsed = await self._parse_response(response, list_key, player_adder,
+                                                    self.content_hash if delta_since is None else None)
+                if parsed is None:
+                    self.last_pull = self.last_full_pull = pull_started
+                    self.last_pull_result = PULL_UNCHANGED
+                    return True
+                if validate_fields is not None:
+                    validate_fields(parsed.fields)
+                if not parsed.list_found:
+                    raise BadRatingData(
+                        f"Key word '{list_key}' not found in JSON response.")
+                if delta_since is None and parsed.num_players < required_player_amount:
+                    raise BadPlayerDataLength(
+                        f"Not enough players found in the JSON response. Required {required_player_amount} players in JSON response, only found {parsed.num_players} players in JSON response."
+                        "")
+            except RatingRequestFailure:
+                print(
+                    f"{common.SERVER.name}'s data from API was formatted incorrectly.")
+                print(traceback.format_exc())
+                return False
+            self.last_pull = pull_started
+            if delta_since is not None:
+                if parsed.num_players > 0:
+                    new_ratings = self.ratings.copy()
+                    new_ratings.update(parsed.table)
+                    async with self.publish_lock:
+                        self._publish(new_ratings)
+                    # The table no longer matches the last full pull
+                    self._forget_pull_validators()
+                self.last_pull_result = PULL_DELTA
+                return True
+            self.last_full_pull = pull_started
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+            self.content_hash = parsed.content_hash
+            async with self.publish_lock:
+                self._publish(parsed.table)
+            self.last_pull_result = PULL_FULL
+            return True
         return False  # Didn't run request successfully, so we return it was a failure
 
-    def _validate_mk8dx_response(self, results: dict):
-        if not isinstance(results, dict):
-            raise BadRatingData("Response is not a dictionary")
-        all_players = results.get("players")
-        if all_players is None:
-            raise BadRatingData(
-                "Key word 'players' not found in JSON response.")
-        #
-        required_player_amount = 10000
-        if len(all_players) < required_player_amount:
-            raise BadPlayerDataLength(
-                f"Not enough players found in the JSON response. Required {required_player_amount} players in JSON response, only found {len(all_players)} players in JSON response."
-                "")
-
-        strongly_required_fields = [("name", str)]
-        weakly_required_fields = [("discordId", str), ("mmr", int)]
-        for player in all_players:
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self.parse_executor == PARSE_PROCESS:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="ratings-parser")
+        return self._executor
+
+    async def _parse_response(self, response, list_key: str,
+                              player_adder: Callable[[RatingTable, RatingTable], Callable[[dict], None]],
+                              unchanged_hash: bytes | None = None) -> ParsedRatings | None:
+        """Parses the response body with the executor chosen by RATINGS_PARSE_EXECUTOR:
+        - inline: each chunk is parsed on the event loop as it arrives.
+        - thread: each chunk is parsed in a worker thread as it arrives, so the event loop only waits for the network.
+        - process: the whole body is read, then parsed in a worker process, so parsing doesn't hold the GIL either.
+        The process executor can't share names with the current table, since the table stays in this process.
+
+        The body is hashed as it is read. If unchanged_hash is given, the whole body is read and hashed before any of
+        it is parsed, and None is returned without parsing it if its hash is unchanged_hash.
+
+        The time spent parsing is reported, along with where it was spent."""
+        content_hash = hashlib.sha256()
+        chunks = None
+        if unchanged_hash is not None or self.parse_executor == PARSE_PROCESS:
+            chunks = []
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                content_hash.update(chunk)
+                chunks.append(chunk)
+            if content_hash.digest() == unchanged_hash:
+                print(f"{common.SERVER.name} ratings are unchanged, not parsing them.", flush=True)
+                return None
+        if self.parse_executor == PARSE_PROCESS:
+            body = b"".join(chunks)
+            chunks = None
+            parsed = await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(), parse_ratings_body, body, list_key, player_adder)
+        else:
+            parser = RatingsParser(list_key, player_adder, self.ratings)
+            if self.parse_executor == PARSE_THREAD:
+                loop = asyncio.get_running_loop()
+                executor = self._get_executor()
+                async for chunk in self._body_chunks(response, chunks, content_hash):
+                    await loop.run_in_executor(executor, parser.feed, chunk)
+                parsed = await loop.run_in_executor(executor, parser.close)
+            else:
+                async for chunk in self._body_chunks(response, chunks, content_hash):
+                    parser.feed(chunk)
+                parsed = parser.close()
+        parsed.content_hash = content_hash.digest()
+        self.last_parse_seconds = parsed.parse_seconds
+        where = "on the event loop" if self.parse_executor == PARSE_INLINE else f"in a worker {self.parse_executor}"
+        print(f"Parsed {parsed.num_players} {common.SERVER.name} ratings in {parsed.parse_seconds * 1000:.1f}ms "
+              f"{where}.", flush=True)
+        return parsed
+
+    @staticmethod
+    async def _body_chunks(response, chunks: List[bytes] | None, content_hash) -> AsyncIterator[bytes]:
+        """Yields the chunks of the body that have already been read, or else each chunk as it arrives, adding it to
+        the hash."""
+        if chunks is not None:
+            for chunk in chunks:
+                yield chunk
+                # Let other tasks run between chunks, as they would while
+                # waiting for the network
+                await asyncio.sleep(0)
+            return
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            content_hash.update(chunk)
+            yield chunk
+
+    def _publish(self, new_ratings: RatingTable):
+        """Publishes a complete, validated ratings table with a single reference swap, so a lookup sees either the
+        whole previous table or the whole new one, never a partly filled table. The previous table is kept as
+        previous_ratings."""
+        self.previous_ratings, self.ratings = self.ratings, new_ratings
+        self.generation += 1
+        self.looked_up_ratings = {}
+
+    @staticmethod
+    def _lounge_player_adder(ratings: RatingTable, previous: RatingTable | None = None,
+                             placement_mmr: int | None = None) -> Callable[[dict], None]:
+        """Returns a function that validates a player from the MK8DX or MKWorld lounge API and adds them to the given
+        ratings table, sharing unchanged names with the previous table. Players without a rating get the given
+        placement MMR, or the configured one at the time of the pull."""
+        if placement_mmr is None:
+            placement_mmr = common.CONFIG["PLACEMENT_PLAYER_MMR"]
+        add = ratings.add
+
+        def add_player(player: dict):
             # Ensure all strongly required fields are in the player JSON and
             # that the type is correct
-            for strongly_req_field_name, strongly_req_field_type in strongly_required_fields:
-                if strongly_req_field_name not in player:
-                    raise BadPlayerData(
-                        f"Missing required field '{strongly_req_field_name}' in the following player: {player}")
-                field_data = player[strongly_req_field_name]
-                if not isinstance(field_data, strongly_req_field_type):
-                    raise BadPlayerData(
-                        f"For field '{strongly_req_field_name}', expected type '{strongly_req_field_type}' received {type(field_data)} for player: {player}")
-            # Ensure that if the weakly required field is in the JSON, the type
-            # is correct
-            for weakly_req_field_name, weakly_req_field_type in weakly_required_fields:
-                if weakly_req_field_name in player:
-                    field_data = player[weakly_req_field_name]
-                    if not isinstance(field_data, weakly_req_field_type):
-                        raise BadPlayerData(
-                            f"For field '{weakly_req_field_name}', expected type '{weakly_req_field_type}' received {type(field_data)} for player: {player}")
-
-    def _parse_mk8dx_ratings(self, results: dict):
-        self.ratings.clear()
-        all_players = results.get("players")
-        for player in all_players:
+            if not isinstance(player, dict) or "name" not in player:
+                raise BadPlayerData(
+                    f"Missing required field 'name' in the following player: {player}")
+            name = player["name"]
             discord_id = player.get("discordId")
-            if discord_id is None:
-                continue
-            rating = common.CONFIG["PLACEMENT_PLAYER_MMR"] if player.get(
-                "mmr") is None else player.get("mmr")
-            self.ratings[discord_id] = (rating, player["name"])
-
-    def _validate_mkworld_response(self, results: dict):
-        if not isinstance(results, dict):
-            raise BadRatingData("Response is not a dictionary")
-        all_players = results.get("players")
-        if all_players is None:
-            raise BadRatingData(
-                "Key word 'players' not found in JSON response.")
-        #
-        required_player_amount = 100
-        if len(all_players) < required_player_amount:
-            raise BadPlayerDataLength(
-                f"Not enough players found in the JSON response. Required {required_player_amount} players in JSON response, only found {len(all_players)} players in JSON response."
-                "")
-
-        strongly_required_fields = [("name", str)]
-        weakly_required_fields = [("discordId", str), ("mmr", int)]
-        for player in all_players:
-            # Ensure all strongly required fields are in the player JSON and
-            # that the type is correct
-            for strongly_req_field_name, strongly_req_field_type in strongly_required_fields:
-                if strongly_req_field_name not in player:
-                    raise BadPlayerData(
-                        f"Missing required field '{strongly_req_field_name}' in the following player: {player}")
-                field_data = player[strongly_req_field_name]
-                if not isinstance(field_data, strongly_req_field_type):
-                    raise BadPlayerData(
-                        f"For field '{strongly_req_field_name}', expected type '{strongly_req_field_type}' received {type(field_data)} for player: {player}")
-            # Ensure that if the weakly required field is in the JSON, the type
-            # is correct
-            for weakly_req_field_name, weakly_req_field_type in weakly_required_fields:
-                if weakly_req_field_name in player:
-                    field_data = player[weakly_req_field_name]
-                    if not isinstance(field_data, weakly_req_field_type):
-                        raise BadPlayerData(
-                            f"For field '{weakly_req_field_name}', expected type '{weakly_req_field_type}' received {type(field_data)} for player: {player}")
-
-    def _validate_mkw_response(self, results: dict):
-        if not isinstance(results, dict):
-            raise BadRatingData("Response is not a dictionary")
-        mkw_status = results.get("status")
+            rating = player.get("mmr")
+            if not isinstance(name, str):
+                raise BadPlayerData(
+                    f"For field 'name', expected type '{str}' received {type(name)} for player: {player}")
+            # Ensure that if the weakly required fields are in the JSON, their
+            # types are correct
+            if not isinstance(discord_id, str) and "discordId" in player:
+                raise BadPlayerData(
+                    f"For field 'discordId', expected type '{str}' received {type(discord_id)} for player: {player}")
+            if not isinstance(rating, int) and "mmr" in player:
+                raise BadPlayerData(
+                    f"For field 'mmr', expected type '{int}' received {type(rating)} for player: {player}")
+            if discord_id is not None:
+                add(discord_id, placement_mmr if rating is None else rating, name, previous)
+        return add_player
+
+    @staticmethod
+    def _validate_mkw_fields(fields: dict):
+        mkw_status = fields.get("status")
         if mkw_status is None:
             raise BadRatingData(
                 "Key word 'status' not found in JSON response.")
@@ -184,19 +846,12 @@ class Ratings:
             raise BadRatingData(
                 f"'status' had value of {mkw_status} in JSON response.")
 
-        all_players = results.get("results")
-        if all_players is None:
-            raise BadRatingData(
-                "Key word 'results' not found in JSON response.")
-        #
-        required_player_amount = 1000
-        if len(all_players) < required_player_amount:
-            raise BadPlayerDataLength(
-                f"Not enough players found in the JSON response. Required {required_player_amount} players in JSON response, only found {len(all_players)} players in JSON response."
-                "")
-
-        for player in all_players:
-            if "player_name" not in player:
+    @staticmethod
+    def _mkw_player_adder(ratings: RatingTable, previous: RatingTable | None = None) -> Callable[[dict], None]:
+        """Returns a function that validates a player from the MKW lounge API and adds them to the given ratings
+        table, sharing unchanged names with the previous table."""
+        def add_player(player: dict):
+            if not isinstance(player, dict) or "player_name" not in player:
                 raise BadPlayerData(
                     f"Missing required field 'player_name' in the following player: {player}")
             if "discord_user_id" not in player:
@@ -205,9 +860,9 @@ class Ratings:
             if "current_mmr" not in player:
                 raise BadPlayerData(
                     f"Missing required field 'current_mmr' in the following player: {player}")
-            player_name = player.get("player_name")
-            discord_user_id = player.get("discord_user_id")
-            current_mmr = player.get("current_mmr")
+            player_name = player["player_name"]
+            discord_user_id = player["discord_user_id"]
+            current_mmr = player["current_mmr"]
             if not (
                 isinstance(
                     discord_user_id,
@@ -220,36 +875,132 @@ class Ratings:
             if not isinstance(player_name, str):
                 raise BadPlayerData(
                     f"For field 'player_name', expected type 'str' received {type(player_name)} for player: {player}")
-
-    def _parse_mkw_ratings(self, results: dict):
-        self.ratings.clear()
-        all_players = results.get("results")
-        for player in all_players:
-            discord_user_id = player.get("discord_user_id")
             if discord_user_id is not None:
-                self.ratings[player["discord_user_id"]] = (
-                    player["current_mmr"], player["player_name"])
+                ratings.add(discord_user_id, current_mmr, player_name, previous)
+        return add_player
 
-    def get_rating_from_discord_id(self, discord_id: int | str) -> int | None:
-        discord_id = str(discord_id)
+    def get_rating_from_discord_id(self, discord_id: int) -> int | None:
         if not self.first_run_complete:
             raise RatingsNotReady("Ratings not pulled yet.")
-        if discord_id in self.ratings:
-            return self.ratings.get(discord_id)[0]
-        # Make clear that we intend to return None by explicitly doing so
-        else:
-            return None
+        rating = self.ratings.get_mmr(discord_id)
+        if rating is None:
+            entry = self.looked_up_ratings.get(discord_id)
+            if entry is not None:
+                return entry[0]
+        return rating
 
-    def get_rating(
+    async def get_rating(
             self, members: List[discord.User | discord.Member]) -> List[Player]:
+        """Returns a Player for each member with a rating, in the same order. Members who aren't in the table are
+        looked up on their own, in case they placed after the last pull."""
         if not self.first_run_complete:
             raise RatingsNotReady("Ratings not pulled yet.")
+        # Every member is looked up in the same table, even if a new one is
+        # published meanwhile
+        ratings = self.ratings
+        entries = [ratings.get(member.id) or self.looked_up_ratings.get(member.id) for member in members]
+        missing_ids = [member.id for member, entry in zip(
+            members, entries) if entry is None]
+        if missing_ids:
+            looked_up = await self.look_up_ratings(missing_ids)
+            entries = [looked_up.get(member.id) if entry is None else entry
+                       for member, entry in zip(members, entries)]
         all_players = []
-        for member in members:
-            # Are discord member IDs already strings...?
-            member_id = str(member.id)
-            if member_id not in self.ratings:
+        for member, entry in zip(members, entries):
+            if entry is None:
                 continue
-            rating, name = self.ratings[member_id]
-            all_players.append(Player(member, name, rating))
+            rating, name = entry
+            all_players.append(Player(member, name, rating, from_ratings=True))
         return all_players
+
+    async def look_up_ratings(self, discord_ids: List[int]) -> Dict[int, Tuple[int, str]]:
+        """Looks up the given players on their own, rather than in the full list, and returns Discord ID -> (rating,
+        name) for the ones that were found.
+
+        Lookups that arrive within LOOKUP_BATCH_SECONDS of each other are sent together, and a player who is already
+        being looked up isn't looked up again: the callers share the result. Players who weren't found aren't looked
+        up again for RATING_LOOKUP_NEGATIVE_TTL_SECONDS. If a lookup fails, its players are treated as not found but
+        can be looked up again straight away."""
+        now = time.monotonic()
+        futures = {}
+        for discord_id in discord_ids:
+            if self._not_found.get(discord_id, 0) > now:
+                continue
+            future = self._pending_lookups.get(discord_id)
+            if future is None:
+                future = asyncio.get_running_loop().create_future()
+                self._pending_lookups[discord_id] = future
+                self._lookup_batch.append(discord_id)
+            futures[discord_id] = future
+        if self._lookup_batch and self._lookup_task is None:
+            self._lookup_task = asyncio.create_task(self._send_lookup_batch())
+        # Shielded, since other callers may be waiting on the same lookup
+        entries = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+        return {discord_id: entry for discord_id, entry in zip(futures, entries) if entry is not None}
+
+    async def _send_lookup_batch(self):
+        batch = []
+        found = None
+        try:
+            try:
+                await asyncio.sleep(LOOKUP_BATCH_SECONDS)
+            finally:
+                # Lookups from now on go in the next batch
+                batch, self._lookup_batch = self._lookup_batch, []
+                self._lookup_task = None
+            found = await self._fetch_players(batch)
+        except http_client.EndpointUnavailable as e:
+            print(f"Failed to look up the ratings of {len(batch)} players: {e}")
+        except Exception:
+            print(f"Failed to look up the ratings of {len(batch)} players.")
+            print(traceback.format_exc())
+        finally:
+            # Callers are never left waiting, even if the lookup was cancelled
+            now = time.monotonic()
+            self._not_found = {discord_id: expiry for discord_id, expiry in self._not_found.items()
+                               if expiry > now}
+            expiry = now + common.CONFIG.get("RATING_LOOKUP_NEGATIVE_TTL_SECONDS", 60)
+            for discord_id in batch:
+                entry = None if found is None else found.get(discord_id)
+                if entry is not None:
+                    self.looked_up_ratings[discord_id] = entry
+                elif found is not None:
+                    self._not_found[discord_id] = expiry
+                self._pending_lookups.pop(discord_id).set_result(entry)
+
+    async def _fetch_players(self, discord_ids: List[int]) -> Dict[int, Tuple[int, str]]:
+        """Fetches the given players from the lounge API. Returns Discord ID -> (rating, name) for the ones that were
+        found."""
+        found = RatingTable()
+        if common.SERVER is common.Server.MKW:
+            # The MKW ladder can filter the player list by Discord ID, so the
+            # whole batch is a single request
+            url = f"""{common.CONFIG["url"]}/api/ladderplayer.php?ladder_type={common.CONFIG["track_type"]}&discord_user_id={",".join(map(str, discord_ids))}&fields=discord_user_id,current_mmr,player_name"""
+            async with http_client.request(http_client.RATING_LOOKUP, "GET", url) as response:
+                if response.status != 200:
+                    raise RatingRequestFailure(
+                        f"{common.SERVER.name} returned status {response.status}")
+                results = await response.json()
+            if not isinstance(results, dict):
+                raise BadRatingData("Response is not a dictionary")
+            Ratings._validate_mkw_fields(results)
+            add_player = Ratings._mkw_player_adder(found)
+            for player in results.get("results") or []:
+                add_player(player)
+        else:
+            game = "mk8dx" if common.SERVER is common.Server.MK8DX else f"""mkworld{common.CONFIG["PLAYERS_PER_ROOM"]}p"""
+            add_player = Ratings._lounge_player_adder(found)
+
+            # The MK8DX and MKWorld lounge API looks up one player per
+            # request, so the batch is sent as concurrent requests
+            async def fetch_player(discord_id: int):
+                url = f"""{common.CONFIG["url"]}/api/player?game={game}&discordId={discord_id}"""
+                async with http_client.request(http_client.RATING_LOOKUP, "GET", url) as response:
+                    if response.status == 404:
+                        return
+                    if response.status != 200:
+                        raise RatingRequestFailure(
+                            f"{common.SERVER.name} returned status {response.status}")
+                    add_player(await response.json())
+            await asyncio.gather(*(fetch_player(discord_id) for discord_id in discord_ids))
+        return dict(found.items())
@@ -1,15 +1,21 @@
 from __future__ import annotations
 
 import traceback
+import bisect
+import time
 import common
-from contextlib import suppress
+from operator import attrgetter
 from common import flatten
 import random
 import discord
 from datetime import datetime, timezone, timedelta
 from discord.ui import View
-from typing import List, Tuple, Callable, Set
+from typing import List, Tuple, Callable, Set, Dict
 import host_fcs
+import matchmaking
+import numpy_backend
+# Registers the room tier strategies
+import tiers
 
 
 class PrepFailure(Exception):
@@ -40,6 +46,195 @@ def average(list_: List[int | float]) -> float:
     return sum(list_) / len(list_)
 
 
+class PlayersAllowedCheck:
+    """Room validity check bound to the room MMR threshold. Calling it with a list of players returns True if the
+    players are allowed to play together.
+
+    range_only should only be True if players_allowed does nothing more than compare the gap between the highest and
+    lowest adjusted MMR against the threshold. That lets the matchmaking backend evaluate the check in bulk instead of
+    calling it once per room."""
+
+    def __init__(self,
+                 players_allowed: Callable[[List[Player], int], bool],
+                 threshold: int,
+                 range_only=False):
+        self.players_allowed = players_allowed
+        self.threshold = threshold
+        self.range_only = range_only
+
+    def __call__(self, players: List[Player]) -> bool:
+        return self.players_allowed(players, self.threshold)
+
+    @property
+    def cache_key(self):
+        """Two checks with the same cache key always give the same result for the same players."""
+        return self.players_allowed, self.threshold
+
+
+class SortedPlayerWindow:
+    """Keeps a pool of players sorted by MMR so that the collection of window_size players with the smallest
+    adjusted MMR spread can be found without re-sorting the pool. Players are added one at a time with bisect,
+    and the best window is updated incrementally: only the windows that contain the new player need to be checked,
+    unless the new player splits the previous best window.
+
+    Ties are broken the same way as a stable sort followed by a scan from the lowest rated player, so the result is
+    identical to sorting the pool and picking the first window with the smallest spread."""
+
+    def __init__(self, window_size: int, players: List[Player] = ()):
+        self.window_size = window_size
+        self._players: List[Player] = sorted(players, key=player_sort_key)
+        self._keys: List[int] = [p.mmr for p in self._players]
+        self._mmrs: List[int] = [p.adjusted_mmr for p in self._players]
+        self._best_start: int | None = None
+        self._best_range: int | None = None
+        self._rescan()
+
+    def __len__(self):
+        return len(self._players)
+
+    def _window_range(self, start: int) -> int:
+        return self._mmrs[start + self.window_size - 1] - self._mmrs[start]
+
+    def _rescan(self):
+        self._best_start = None
+        self._best_range = None
+        if self.window_size > 1 and numpy_backend.use_for(len(self._mmrs)):
+            self._best_start = numpy_backend.best_window_start(
+                numpy_backend.to_array(self._mmrs), self.window_size)
+            if self._best_start is not None:
+                self._best_range = self._window_range(self._best_start)
+            return
+        self._check_windows(0, len(self._players) - self.window_size)
+
+    def _check_windows(self, first_start: int, last_start: int):
+        """Checks every window starting between first_start and last_start (inclusive), keeping the first window
+        with the smallest range found so far."""
+        if self.window_size <= 1:
+            return
+        for start in range(max(first_start, 0), last_start + 1):
+            cur_range = self._window_range(start)
+            if self._best_range is None or cur_range < self._best_range or (
+                    cur_range == self._best_range and start < self._best_start):
+                self._best_start = start
+                self._best_range = cur_range
+
+    def insert(self, player: Player):
+        """Adds the player to the pool and updates the best window."""
+        index = bisect.bisect_right(self._keys, player.mmr)
+        self._players.insert(index, player)
+        self._keys.insert(index, player.mmr)
+        self._mmrs.insert(index, player.adjusted_mmr)
+        if self._best_start is None:
+            self._rescan()
+            return
+        # Windows that do not contain the new player are unchanged, so the previous best window is still the best
+        # among them as long as the new player did not land inside of it
+        if self._best_start >= index:
+            self._best_start += 1
+        elif self._best_start + self.window_size - 1 >= index:
+            self._rescan()
+            return
+        self._check_windows(index - self.window_size + 1,
+                            min(index, len(self._players) - self.window_size))
+
+    def best_window(self) -> List[Player] | None:
+        """Returns the window_size players (sorted lowest to highest) with the smallest MMR spread, or None if there
+        are not enough players in the pool or the window size is less than 2."""
+        if self._best_start is None:
+            return None
+        return self._players[self._best_start:
+                             self._best_start + self.window_size]
+
+
+class TeamList(list):
+    """The list of teams queued for a Mogi. Adding or removing teams tells the Mogi that its roster has changed, so
+    anything the Mogi has computed from the roster is recomputed the next time it is needed."""
+
+    def __init__(self, mogi: Mogi, teams=()):
+        super().__init__(teams)
+        self._mogi = mogi
+
+    def append(self, team: Team):
+        super().append(team)
+        self._mogi._team_added(team)
+
+    def extend(self, teams):
+        super().extend(teams)
+        self._mogi.roster_changed()
+
+    def insert(self, index, team: Team):
+        super().insert(index, team)
+        self._mogi.roster_changed()
+
+    def remove(self, team: Team):
+        super().remove(team)
+        self._mogi._team_removed(team)
+
+    def pop(self, index=-1) -> Team:
+        team = super().pop(index)
+        self._mogi.roster_changed()
+        return team
+
+    def clear(self):
+        super().clear()
+        self._mogi.roster_changed()
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._mogi.roster_changed()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._mogi.roster_changed()
+
+    def __iadd__(self, teams):
+        self.extend(teams)
+        return self
+
+
+class RoomRegistry:
+    """Maps the channel (or thread) id of every room in the ongoing and old events to the room and its event, so room
+    channels can be looked up without searching every event. Rooms are added through Mogi.add_room and follow their
+    channel when it changes. Events must be removed with remove_mogi when they are discarded."""
+
+    def __init__(self):
+        self._rooms: Dict[int, Tuple[Mogi, Room]] = {}
+        # The ids of every room channel, rebuilt only when rooms are added, removed or change channel. Cheap to check
+        # for every message in the guild.
+        self.active_channel_ids: frozenset = frozenset()
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._rooms
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def get(self, channel_id: int) -> Tuple[Mogi, Room] | Tuple[None, None]:
+        """Returns the event and room whose channel has the given id, or (None, None) if there isn't one."""
+        return self._rooms.get(channel_id, (None, None))
+
+    def channel_ids(self) -> Set[int]:
+        return set(self._rooms)
+
+    def room_channel_changed(self, mogi: Mogi, room: Room, old_channel):
+        if old_channel is not None and self._rooms.get(old_channel.id, (None, None))[1] is room:
+            del self._rooms[old_channel.id]
+        if room.channel is not None:
+            self._rooms[room.channel.id] = (mogi, room)
+        self.active_channel_ids = frozenset(self._rooms)
+
+    def remove_mogi(self, mogi: Mogi | None):
+        """Removes every room of the given event."""
+        if mogi is None:
+            return
+        for room in mogi.rooms:
+            if room is None or room.channel is None:
+                continue
+            if self._rooms.get(room.channel.id, (None, None))[0] is mogi:
+                del self._rooms[room.channel.id]
+        self.active_channel_ids = frozenset(self._rooms)
+
+
 class Mogi:
     ALGORITHM_STATUS_INSUFFICIENT_PLAYERS = 1
     ALGORITHM_STATUS_2_OR_MORE_ROOMS = 2
@@ -58,7 +253,8 @@ class Mogi:
             start_time=None,
             display_time=None,
             additional_extension_minutes=0,
-            format=None):
+            format=None,
+            room_registry: RoomRegistry | None = None):
         self.started = False
         self.gathering = False
         self.making_rooms_run = False
@@ -68,8 +264,24 @@ class Mogi:
         self.players_per_room = players_per_room
         self.buttons = buttons
         self.mogi_channel = mogi_channel
-        self.teams: List[Team] = []
+        # Incremented every time a team is added, removed or confirmed. Results
+        # computed from the roster are cached against it.
+        self.roster_version = 0
+        self._proposed_list_cache = None
+        self._any_cancelled_cache = None
+        # Teams where all players have confirmed, and their players, in the
+        # order they joined. Kept up to date as teams are added and removed.
+        self._confirmed_teams: List[Team] = []
+        self._confirmed_players: List[Player] = []
+        # Discord member id -> (team, player) for every queued player, in the
+        # order they joined
+        self._players_by_member_id: Dict[int,
+                                         List[Tuple[Team, Player]]] = {}
+        self._teams = TeamList(self)
         self.rooms: List[Room] = []
+        # Channel id -> room, for this event's rooms that have a channel
+        self._rooms_by_channel_id: Dict[int, Room] = {}
+        self.room_registry = room_registry
         self.is_automated = is_automated
         self.start_time = start_time if is_automated else None
         self.display_time = display_time if is_automated else None
@@ -79,10 +291,97 @@ class Mogi:
         self.has_checked_auto_extend = False
         self.final_amount_good_rooms = 0
 
+    @property
+    def teams(self) -> TeamList:
+        return self._teams
+
+    @teams.setter
+    def teams(self, teams: List[Team]):
+        self._teams = TeamList(self, teams)
+        self.roster_changed()
+
+    def roster_changed(self):
+        """Marks anything computed from the roster as out of date. Adding or removing teams calls this automatically,
+        but it must be called after confirming players on a team that is already in the Mogi."""
+        self.roster_version += 1
+        self._confirmed_teams = [
+            team for team in self._teams if team.all_registered()]
+        self._confirmed_players = flatten(
+            [team.players for team in self._confirmed_teams])
+        self._players_by_member_id = {}
+        for team in self._teams:
+            self._index_team(team)
+
+    def _index_team(self, team: Team):
+        for player in team.players:
+            if player.member_id is not None:
+                self._players_by_member_id.setdefault(
+                    player.member_id, []).append((team, player))
+
+    def _unindex_team(self, team: Team):
+        for player in team.players:
+            if player.member_id is None:
+                continue
+            entries = self._players_by_member_id.get(player.member_id, [])
+            entries = [entry for entry in entries if entry[0] is not team]
+            if entries:
+                self._players_by_member_id[player.member_id] = entries
+            else:
+                self._players_by_member_id.pop(player.member_id, None)
+
+    def _team_added(self, team: Team):
+        self.roster_version += 1
+        self._index_team(team)
+        if team.all_registered():
+            self._confirmed_teams.append(team)
+            self._confirmed_players.extend(team.players)
+
+    def _team_removed(self, team: Team):
+        self.roster_version += 1
+        self._unindex_team(team)
+        for i, confirmed_team in enumerate(self._confirmed_teams):
+            if confirmed_team is team:
+                del self._confirmed_teams[i]
+                removed_ids = {id(p) for p in team.players}
+                self._confirmed_players = [
+                    p for p in self._confirmed_players if id(p) not in removed_ids]
+                break
+
+    def update_player_mmrs(self, get_mmr: Callable[[int], int | None]) -> int:
+        """Updates the MMR of every queued player whose MMR came from the ratings table to the MMR get_mmr returns for
+        their Discord member id, if it returns one. Returns the number of players whose MMR changed."""
+        num_changed = 0
+        for team in self._teams:
+            for player in team.players:
+                if not player.from_ratings or player.member_id is None:
+                    continue
+                mmr = get_mmr(player.member_id)
+                if mmr is not None and mmr != player.mmr:
+                    player.update_mmr(mmr)
+                    num_changed += 1
+        if num_changed > 0:
+            # Results computed from the roster used the old MMRs
+            self.roster_version += 1
+        return num_changed
+
+    def _roster_cache_key(self, valid_players_check) -> tuple | None:
+        """Returns the key that results computed from the roster and the given valid players check are cached against,
+        or None if results for this check can't be cached."""
+        check_key = None
+        if valid_players_check is not None:
+            check_key = getattr(valid_players_check, "cache_key", None)
+            if check_key is None:
+                return None
+        return (self.roster_version,
+                self.players_per_room,
+                check_key,
+                common.SETTINGS_GENERATION,
+                matchmaking.selected_name(matchmaking.PROPOSAL))
+
     @property
     def num_players(self):
         """Returns the total number of players in teams where all players have confirmed"""
-        return sum(len(t.players) for t in self.teams if t.all_registered())
+        return len(self._confirmed_players)
 
     @property
     def num_teams(self):
@@ -107,24 +406,7 @@ class Mogi:
             return None
         if num_players <= 1:
             return None
-        # Sort the players so we easily know the player with the lowest rating
-        # and highest rating in any given collection
-        sorted_players = sorted(players)
-        # In the beginning, the best found collection of players is the first
-        # 12
-        best_collection = sorted_players[0:num_players]
-        cur_min = best_collection[-1].adjusted_mmr - \
-            best_collection[0].adjusted_mmr
-        # Find the collection of players with the least rating spread
-        for lowest_player_index, highest_player in enumerate(
-                sorted_players[num_players:], 1):
-            lowest_player = sorted_players[lowest_player_index]
-            cur_range = highest_player.adjusted_mmr - lowest_player.adjusted_mmr
-            if cur_range < cur_min:
-                cur_min = cur_range
-                best_collection = sorted_players[lowest_player_index:
-                                                 lowest_player_index + num_players]
-        return best_collection
+        return SortedPlayerWindow(num_players, players).best_window()
 
     def _all_room_final_list_algorithm(self, valid_players_check: Callable[[
                                        List[Player]], bool]) -> Tuple[List[List[Player]], int]:
@@ -134,28 +416,29 @@ class Mogi:
         first_late_player_index = (
             self.num_players // self.players_per_room) * self.players_per_room
         on_time_players = sorted(
-            all_confirmed_players[:first_late_player_index], reverse=True)
+            all_confirmed_players[:first_late_player_index], key=player_sort_key, reverse=True)
         late_players = all_confirmed_players[first_late_player_index:]
         player_rooms: List[List[Player]] = list(
             common.divide_chunks(on_time_players, self.players_per_room))
 
         any_invalid = False
         for pr_index, player_room in enumerate(player_rooms, 0):
+            # Late players are added to the room's pool one at a time, so the
+            # pool is only sorted once per room
+            window = SortedPlayerWindow(self.players_per_room, player_room)
             for lp_index in range(len(late_players) + 1):
-                current_late_check_players = late_players[0:lp_index]
-                best_collection = Mogi._minimize_range(
-                    player_room + current_late_check_players, self.players_per_room)
+                if lp_index > 0:
+                    window.insert(late_players[lp_index - 1])
+                best_collection = window.best_window()
                 if valid_players_check(best_collection):
-                    best_collection.sort(reverse=True)
+                    best_collection.sort(key=player_sort_key, reverse=True)
                     # Get all the players who were swapped out of the room and
                     # put them at the front of the late player list
+                    best_collection_ids = {id(p) for p in best_collection}
                     swapped_out_players = [
-                        p for p in player_room if p not in best_collection]
-                    swapped_in_players = [
-                        p for p in best_collection if p not in player_room]
-                    late_players = swapped_out_players + \
-                        list(
-                            filter(lambda p: p not in swapped_in_players, late_players))
+                        p for p in player_room if id(p) not in best_collection_ids]
+                    late_players = swapped_out_players + [
+                        p for p in late_players if id(p) not in best_collection_ids]
                     player_rooms[pr_index] = best_collection
                     break
             else:
@@ -173,31 +456,123 @@ class Mogi:
         if self.max_possible_rooms > 1:
             confirmed_players = self.players_on_confirmed_teams()
             return sorted(confirmed_players[0:self.players_per_room *
-                                            self.max_possible_rooms], reverse=True), Mogi.ALGORITHM_STATUS_2_OR_MORE_ROOMS
+                                            self.max_possible_rooms], key=player_sort_key, reverse=True), Mogi.ALGORITHM_STATUS_2_OR_MORE_ROOMS
         # At this point, we can only make one possible room, so our algorithm
         # will be used
         confirmed_players = self.players_on_confirmed_teams()
-        cur_check_list = list(confirmed_players[0:self.players_per_room])
+        window = SortedPlayerWindow(
+            self.players_per_room, confirmed_players[0:self.players_per_room])
         late_players = list(confirmed_players[self.players_per_room:])
 
         while True:
-            best_collection = Mogi._minimize_range(
-                cur_check_list, self.players_per_room)
+            best_collection = window.best_window()
             if valid_players_check(best_collection):
                 return sorted(
-                    best_collection, reverse=True), Mogi.ALGORITHM_STATUS_SUCCESS_FOUND
+                    best_collection, key=player_sort_key, reverse=True), Mogi.ALGORITHM_STATUS_SUCCESS_FOUND
             if len(late_players) == 0:
                 break
-            cur_check_list.append(late_players.pop(0))
+            window.insert(late_players.pop(0))
         # Even after checking the late players, we did not find
         return best_collection, Mogi.ALGORITHM_STATUS_SUCCESS_EMPTY
 
+    def _partition_final_list_algorithm(self, valid_players_check: Callable[[
+                                        List[Player]], bool], time_budget_ms: float) -> Tuple[List[List[Player]], int] | None:
+        """Partitions the confirmed players into rooms for the whole event at once rather than room by room.
+
+        Rooms never overlap in MMR: each room is made from a span of the MMR-sorted confirmed players, taking the
+        lowest and highest player of the span and filling the rest of the room from inside the span, on-time players
+        first. Players left out of every room sit out. Dynamic programming over (players considered, rooms made) finds
+        the partition that, in order of priority:
+        1. cancels the fewest rooms
+        2. uses the fewest late players (in other words, removes the fewest on-time players)
+        3. has the smallest total MMR range across all rooms
+        4. uses the earliest late players
+
+        Returns None if the partition could not be computed within the given time budget."""
+        num_rooms = self.max_possible_rooms
+        if num_rooms == 0:
+            return [], Mogi.ALGORITHM_STATUS_INSUFFICIENT_PLAYERS
+        deadline = time.perf_counter() + (time_budget_ms / 1000)
+        room_size = self.players_per_room
+        all_confirmed_players = self.players_on_confirmed_teams()
+        first_late_player_index = num_rooms * room_size
+        # On time players have a rank of 0, late players are ranked by when
+        # they joined
+        late_ranks = {id(p): rank for rank, p in enumerate(
+            all_confirmed_players[first_late_player_index:], 1)}
+        sorted_players = sorted(all_confirmed_players, key=player_sort_key)
+        ranks = [late_ranks.get(id(p), 0) for p in sorted_players]
+        mmrs = [p.adjusted_mmr for p in sorted_players]
+        num_players = len(sorted_players)
+        # Every player that sits out of a span makes room for one late player,
+        # so no span can be longer than this
+        max_span = room_size + num_players - first_late_player_index
+
+        def span_room(start: int, end: int) -> List[int]:
+            """Indices of the players that make up the room for the span start to end (inclusive)."""
+            inner = sorted(range(start + 1, end), key=lambda j: ranks[j])
+            return [start] + sorted(inner[:room_size - 2]) + [end]
+
+        # best[i][r] is the lowest cost (cancelled, late players, range, late
+        # player ranks) of making r rooms out of the first i sorted players.
+        # span_start[i][r] is where the span of the last room starts if player
+        # i - 1 is the highest player of that room, otherwise None.
+        best = [[None] * (num_rooms + 1) for _ in range(num_players + 1)]
+        span_start = [[None] * (num_rooms + 1)
+                      for _ in range(num_players + 1)]
+        best[0][0] = (0, 0, 0, 0)
+        for i in range(1, num_players + 1):
+            span_costs = {}
+            # Only consider room counts that are reachable with i players and
+            # can still be completed with the remaining players
+            for r in range(max(0, num_rooms - (num_players - i) // room_size),
+                           min(num_rooms, i // room_size) + 1):
+                cur_best = best[i - 1][r]
+                cur_start = None
+                for start in range(max(0, i - max_span), i - room_size + 1):
+                    if r == 0 or best[start][r - 1] is None:
+                        continue
+                    if start not in span_costs:
+                        room = span_room(start, i - 1)
+                        room_players = [sorted_players[j] for j in room]
+                        cancelled = 0 if valid_players_check is None or valid_players_check(
+                            room_players) else 1
+                        room_ranks = [ranks[j] for j in room if ranks[j] > 0]
+                        span_costs[start] = (cancelled, len(room_ranks),
+                                             mmrs[i - 1] - mmrs[start], sum(room_ranks))
+                    prev = best[start][r - 1]
+                    cost = span_costs[start]
+                    with_room = (prev[0] + cost[0], prev[1] + cost[1],
+                                 prev[2] + cost[2], prev[3] + cost[3])
+                    if cur_best is None or with_room < cur_best:
+                        cur_best = with_room
+                        cur_start = start
+                best[i][r] = cur_best
+                span_start[i][r] = cur_start
+            if time.perf_counter() > deadline:
+                return None
+
+        player_rooms: List[List[Player]] = []
+        i, r = num_players, num_rooms
+        while r > 0:
+            start = span_start[i][r]
+            if start is None:
+                i -= 1
+                continue
+            player_rooms.append(sorted((sorted_players[j] for j in span_room(
+                start, i - 1)), key=player_sort_key, reverse=True))
+            i = start
+            r -= 1
+        any_invalid = best[num_players][num_rooms][0] > 0
+        return player_rooms, (
+            Mogi.ALGORITHM_STATUS_SUCCESS_SOME_INVALID if any_invalid else Mogi.ALGORITHM_STATUS_SUCCESS_FOUND)
+
     def _mk8dx_generate_final_list(self) -> List[Player]:
         confirmed_players = self.players_on_confirmed_teams()
         if self.max_possible_rooms == 0:
             return confirmed_players
         return sorted(
-            confirmed_players[0:self.players_per_room * self.max_possible_rooms], reverse=True)
+            confirmed_players[0:self.players_per_room * self.max_possible_rooms], key=player_sort_key, reverse=True)
 
     def _mkw_generate_final_list(self, valid_players_check: Callable[[
                                  List[Player]], bool]) -> List[Player]:
@@ -206,7 +581,24 @@ class Mogi:
         if status is Mogi.ALGORITHM_STATUS_INSUFFICIENT_PLAYERS:
             return self.players_on_confirmed_teams()
         # I do not want to formally prove that sorting here is correct
-        return sorted(common.flatten(result), reverse=True)
+        return sorted(common.flatten(result), key=player_sort_key, reverse=True)
+
+    def _partition_generate_final_list(self, valid_players_check: Callable[[
+                                       List[Player]], bool]) -> List[Player]:
+        time_budget_ms = common.CONFIG.get("PARTITION_TIME_BUDGET_MS", 250)
+        partition = self._partition_final_list_algorithm(
+            valid_players_check, time_budget_ms)
+        if partition is None:
+            print(
+                f"Room partitioning took longer than {time_budget_ms}ms, using the room by room algorithm instead.",
+                flush=True)
+            return self._mkw_generate_final_list(valid_players_check)
+        result, status = partition
+        if status is Mogi.ALGORITHM_STATUS_INSUFFICIENT_PLAYERS:
+            return self.players_on_confirmed_teams()
+        # Rooms are disjoint windows of the sorted players, so sorting keeps
+        # each room together
+        return sorted(common.flatten(result), key=player_sort_key, reverse=True)
 
     def generate_proposed_list(self,
                                valid_players_check: Callable[[List[Player]],
@@ -217,15 +609,17 @@ class Mogi:
         and more.
 
         The algorithm may or may not enforce a hard check of the valid players. That is up to the implemented
-        algorithm."""
-        if common.SERVER is common.Server.MK8DX:
-            return self._mk8dx_generate_final_list()
-        elif common.SERVER is common.Server.MKW:
-            return self._mkw_generate_final_list(valid_players_check)
-        elif common.SERVER is common.Server.MKWorld:
-            return self._mk8dx_generate_final_list()
-        else:
-            raise ValueError(f"Unknown server in config: {common.Server}")
+        algorithm.
+
+        The result is cached until the roster or matchmaking settings change."""
+        cache_key = self._roster_cache_key(valid_players_check)
+        if cache_key is not None and self._proposed_list_cache is not None and self._proposed_list_cache[0] == cache_key:
+            return list(self._proposed_list_cache[1])
+        proposed_list = matchmaking.get(matchmaking.PROPOSAL)(
+            self, valid_players_check)
+        if cache_key is not None:
+            self._proposed_list_cache = (cache_key, list(proposed_list))
+        return proposed_list
 
     def _count_cancelled(self,
                          player_list: List[Player],
@@ -234,6 +628,10 @@ class Mogi:
         """Using the provided valid players check function and player list, returns the number of rooms that would be cancelled."""
         if valid_players_check is None:
             return 0
+        if numpy_backend.use_for(len(player_list)) and getattr(
+                valid_players_check, "range_only", False):
+            return numpy_backend.count_cancelled(numpy_backend.pack_mmrs(
+                player_list), self.players_per_room, valid_players_check.threshold)
         return sum(
             1 for room_players in common.divide_chunks(
                 player_list,
@@ -247,45 +645,64 @@ class Mogi:
 
     def any_room_cancelled(self, valid_players_check: Callable[[
                            List[Player]], bool] = None) -> bool:
-        """Using the provided valid players check function, returns if any of the rooms will be cancelled."""
+        """Using the provided valid players check function, returns if any of the rooms will be cancelled. The result is
+        cached until the roster or matchmaking settings change."""
         if valid_players_check is None:
             return False
+        cache_key = self._roster_cache_key(valid_players_check)
+        if cache_key is not None and self._any_cancelled_cache is not None and self._any_cancelled_cache[0] == cache_key:
+            return self._any_cancelled_cache[1]
         proposed_list = self.generate_proposed_list(valid_players_check)
-        return self._any_cancelled(proposed_list, valid_players_check)
+        any_cancelled = self._any_cancelled(proposed_list, valid_players_check)
+        if cache_key is not None:
+            self._any_cancelled_cache = (cache_key, any_cancelled)
+        return any_cancelled
+
+    def check_player(self, member) -> Team | None:
+        """Returns the team the member is queued on, or None if they are not queued."""
+        entries = self._players_by_member_id.get(member.id)
+        return entries[0][0] if entries else None
 
-    def check_player(self, member):
-        for team in self.teams:
-            if team.has_player(member):
-                return team
-        return None
+    def get_player(self, member) -> Player | None:
+        """Returns the queued player for the member, or None if they are not queued."""
+        entries = self._players_by_member_id.get(member.id)
+        return entries[0][1] if entries else None
 
     def count_registered(self) -> int:
         """Returns the number of teams that are registered"""
-        return sum(1 for team in self.teams if team.all_registered())
+        return len(self._confirmed_teams)
 
     def confirmed_teams(self) -> List["Team"]:
-        return [team for team in self.teams if team.all_registered()]
+        return list(self._confirmed_teams)
 
     def players_on_confirmed_teams(self) -> List[Player]:
-        return flatten([team.players for team in self.confirmed_teams()])
+        return list(self._confirmed_players)
+
+    def add_room(self, room: Room):
+        """Adds the room to the event, so it can be found by its channel id."""
+        room._mogi = self
+        self.rooms.append(room)
+        self._room_channel_changed(room, None)
+
+    def _room_channel_changed(self, room: Room, old_channel):
+        if old_channel is not None and self._rooms_by_channel_id.get(old_channel.id) is room:
+            del self._rooms_by_channel_id[old_channel.id]
+        if room.channel is not None:
+            self._rooms_by_channel_id[room.channel.id] = room
+        if self.room_registry is not None:
+            self.room_registry.room_channel_changed(self, room, old_channel)
 
     def all_room_channel_ids(self) -> Set[int]:
-        return {
-            r.channel.id for r in self.rooms if r is not None and r.channel is not None}
+        return set(self._rooms_by_channel_id)
 
     def channel_id_in_rooms(self, channel_id: int):
-        return channel_id in self.all_room_channel_ids()
+        return channel_id in self._rooms_by_channel_id
 
     def get_room_from_channel_id(self, channel_id: int):
-        for room in self.rooms:
-            if room is None or room.channel is None:
-                continue
-            if room.channel.id == channel_id:
-                return room
-        return None
+        return self._rooms_by_channel_id.get(channel_id)
 
     async def populate_host_fcs(self):
-        all_hosts = {str(plr.member.id): plr for plr in filter(
+        all_hosts = {str(plr.member_id): plr for plr in filter(
             lambda p: p.host, self.players_on_confirmed_teams())}
         hosts = await host_fcs.get_hosts(all_hosts)
         for host_discord_id, host_fc in hosts.items():
@@ -293,6 +710,16 @@ class Mogi:
             if player is not None:
                 player.host_fc = host_fc
 
+    def release_members(self):
+        """Drops the Discord member references held by the event's players. They are looked up from the guild again
+        when needed. Called when the event is finished gathering, so old events hold less memory."""
+        for team in self._teams:
+            for player in team.players:
+                player.release_member()
+        for room in self.rooms:
+            for player in room.players:
+                player.release_member()
+
     async def assign_roles(self, guild: discord.Guild):
         for room in self.rooms:
             try:
@@ -304,15 +731,22 @@ class Mogi:
 
 
 class Room:
+    __slots__ = ("_teams", "_players_by_member_id", "_players", "_mmr_low", "_mmr_high", "_avg_mmr", "_tier",
+                 "_stats_generation", "_channel", "_mogi", "scores", "room_num", "view", "finished", "host_list",
+                 "subs", "tier_info", "room_role")
+
     def __init__(
             self,
             teams,
             room_num: int,
             channel: discord.Thread | discord.TextChannel,
             tier_info):
+        self.scores = ScoreLedger(self)
         self.teams: List["Team"] = teams
         self.room_num = room_num
-        self.channel = channel
+        # The event the room was added to with Mogi.add_room
+        self._mogi: Mogi | None = None
+        self._channel = channel
         self.view = None
         self.finished = False
         self.host_list: List["Player"] = []
@@ -320,17 +754,59 @@ class Room:
         self.tier_info = tier_info
         self.room_role = None
 
+    @property
+    def channel(self) -> discord.Thread | discord.TextChannel | None:
+        return self._channel
+
+    @channel.setter
+    def channel(self, channel: discord.Thread | discord.TextChannel | None):
+        old_channel = self._channel
+        self._channel = channel
+        if self._mogi is not None:
+            self._mogi._room_channel_changed(self, old_channel)
+
+    @property
+    def teams(self) -> List["Team"] | None:
+        return self._teams
+
+    @teams.setter
+    def teams(self, teams: List["Team"] | None):
+        self._teams = teams
+        self._players: List[Player] = [] if teams is None else flatten(
+            [t.players for t in teams])
+        # Discord member id -> (team, player) for the players in the room
+        self._players_by_member_id: Dict[int, Tuple[Team, Player]] = {}
+        for team in teams or []:
+            for player in team.players:
+                if player.member_id is not None:
+                    self._players_by_member_id.setdefault(
+                        player.member_id, (team, player))
+        # The room's statistics are computed the next time one is needed
+        self._stats_generation = None
+        self.scores.teams_changed()
+
+    def _refresh_stats(self):
+        """Computes the room's MMR range, average and tier. They are cached until the teams or the matchmaking
+        settings change."""
+        if self.teams is None or len(self._players) == 0:
+            self._mmr_high = None
+            self._mmr_low = None
+            self._avg_mmr = 0
+        else:
+            self._mmr_high = max(self._players, key=player_sort_key).adjusted_mmr
+            self._mmr_low = min(self._players, key=player_sort_key).adjusted_mmr
+            self._avg_mmr = int(average([p.mmr for p in self._players]))
+        self._stats_generation = common.SETTINGS_GENERATION
+        self._tier = matchmaking.get(matchmaking.TIER)(self)
+
+    def _check_stats(self):
+        if self._stats_generation != common.SETTINGS_GENERATION:
+            self._refresh_stats()
+
     @property
     def tier(self) -> str:
-        if common.SERVER is common.Server.MK8DX:
-            return get_tier_mk8dx(round(self.avg_mmr) - 500)
-        elif common.SERVER is common.Server.MKW:
-            return str(get_tier_mkw(self.avg_mmr, self.players))
-        elif common.SERVER is common.Server.MKWorld:
-            if len(self.players) == 12:
-                return get_tier_mkworld_12(round(self.avg_mmr))
-            else:
-                return get_tier_mkworld_24(round(self.avg_mmr))
+        self._check_stats()
+        return self._tier
 
     @property
     def tier_collection(self) -> str:
@@ -351,30 +827,25 @@ class Room:
 
     @property
     def mmr_high(self) -> int:
-        if self.teams is None:
-            return None
-        return max(self.players).adjusted_mmr
+        self._check_stats()
+        return self._mmr_high
 
     @property
     def mmr_low(self) -> int:
-        if self.teams is None:
-            return None
-        return min(self.players).adjusted_mmr
+        self._check_stats()
+        return self._mmr_low
 
     @property
     def avg_mmr(self) -> int:
-        if self.teams is None:
-            return 0
-        return int(average([p.mmr for p in self.players]))
+        self._check_stats()
+        return self._avg_mmr
 
     @property
     def players(self) -> List[Player]:
-        if self.teams is None:
-            return []
-        return flatten([t.players for t in self.teams])
+        return list(self._players)
 
     def get_player_list(self):
-        return [player.member.id for team in self.teams for player in team.players]
+        return [player.member_id for team in self.teams for player in team.players]
 
     def create_host_list(self):
         all_hosts = list(filter(lambda p: p.host, self.players))
@@ -387,22 +858,28 @@ class Room:
             return ""
         host_strs = []
         for i, player in enumerate(self.host_list, 1):
-            host_strs.append(f"{i}. {player.member.display_name}")
+            host_strs.append(f"{i}. {player.display_name}")
             # First player on the list should be bold
             if i == 1:
                 host_strs[0] = f"**{host_strs[0]}**"
         result = f"Host: {', '.join(host_strs)}"
         if common.SERVER is common.Server.MKW and self.host_list[0].host_fc is not None:
-            result += f"\n**Host ({self.host_list[0].member.display_name}) Friend Code: {self.host_list[0].host_fc}**"
+            result += f"\n**Host ({self.host_list[0].display_name}) Friend Code: {self.host_list[0].host_fc}**"
         return result
 
-    def check_player(self, member):
-        if self.teams is None:
-            return None
-        for team in self.teams:
-            if team.has_player(member):
-                return team
-        return None
+    def check_player(self, member) -> Team | None:
+        """Returns the team the member is playing on in this room, or None if they are not playing in this room."""
+        entry = self._players_by_member_id.get(member.id)
+        return None if entry is None else entry[0]
+
+    def get_player(self, member) -> Player | None:
+        """Returns the player for the member in this room, or None if they are not playing in this room."""
+        return self.get_player_by_id(member.id)
+
+    def get_player_by_id(self, member_id: int) -> Player | None:
+        """Returns the player with the given member id in this room, or None if they are not playing in this room."""
+        entry = self._players_by_member_id.get(member_id)
+        return None if entry is None else entry[1]
 
     async def assign_member_room_role(self, member: discord.Member):
         if self.room_role is None:
@@ -417,7 +894,7 @@ class Room:
         role_add_fail_text = ""
         role_skip = set() if role_skip is None else set(role_skip)
         for player in self.players:
-            updated_member = guild.get_member(player.member.id)
+            updated_member = guild.get_member(player.member_id)
             if updated_member is not None:
                 member_role_ids = {r.id for r in updated_member.roles}
                 if len(role_skip.intersection(member_role_ids)) > 0:
@@ -432,20 +909,17 @@ class Room:
             await self.channel.send(role_add_fail_text)
             raise RoleAddFailure(role_add_fail_text)
 
-    async def prepare_room_channel(self, guild: discord.Guild, all_events: List[Mogi | None]):
+    async def prepare_room_channel(self, guild: discord.Guild, used_channel_ids: RoomRegistry | Set[int]):
+        """Gives the room a free channel for its tier. used_channel_ids holds the channel ids already used by rooms
+        in the ongoing and old events."""
         if common.CONFIG["USE_THREADS"]:
             return
 
         # Find the available tier channels for the tier (collection)
         tier_collection = self.tier_collection
         tier_data = common.CONFIG["TIER_CHANNELS"][tier_collection]
-        free_tier_channel_ids = list(tier_data["channel_ids"])
-        for event in all_events:
-            if event is None:
-                continue
-            for channel_id in event.all_room_channel_ids():
-                with suppress(ValueError):
-                    free_tier_channel_ids.remove(channel_id)
+        free_tier_channel_ids = [
+            channel_id for channel_id in tier_data["channel_ids"] if channel_id not in used_channel_ids]
         # If there are no available tier channels, raise an exception
         if len(free_tier_channel_ids) == 0:
             raise NoFreeChannels(
@@ -455,7 +929,7 @@ class Room:
         found_channel = guild.get_channel(free_tier_channel_ids[0])
         if not isinstance(found_channel, discord.TextChannel):
             raise WrongChannelType(
-                f"For tier {tier_collection}, channel id {channel_id} is of type {type(found_channel)}, expected discord.TextChannel")
+                f"For tier {tier_collection}, channel id {free_tier_channel_ids[0]} is of type {type(found_channel)}, expected discord.TextChannel")
         self.channel = found_channel
 
         # Assign the role for the tier collection to all players in the room so
@@ -468,13 +942,100 @@ class Room:
         await self.assign_roles(guild=guild, role_skip=tier_data["role_ids_can_see_already"] + [tier_role_id])
 
 
+class ScoreLedger:
+    """The scores reported in a room. Every update is recorded with the time it was reported, and the latest score of
+    each player is kept, so nothing needs to rescan the room's messages or players to find the scores.
+
+    The room's scoreboard is rendered line by line: each score update only re-renders its player's line, and the
+    scoreboard text is cached until the next update."""
+    __slots__ = ("updates", "_latest", "_room", "_lines", "_layout", "_scoreboard")
+
+    def __init__(self, room: Room):
+        # (time reported, member id, score) for every score update, oldest
+        # first
+        self.updates: List[Tuple[datetime, int, int]] = []
+        self._latest: Dict[int, int] = {}
+        self._room = room
+        # Member id -> the player's scoreboard line
+        self._lines: Dict[int, str] = {}
+        # Member ids of the room's players in scoreboard order, with None
+        # between teams
+        self._layout: List[int | None] | None = None
+        # ((format, tier), text) of the last scoreboard rendered
+        self._scoreboard: Tuple[Tuple[int, str], str] | None = None
+
+    def teams_changed(self):
+        self._lines.clear()
+        self._layout = None
+        self._scoreboard = None
+
+    def record(self, member_id: int, score: int, reported_at: datetime | None = None):
+        """Records a score reported by the player with the given member id."""
+        if reported_at is None:
+            reported_at = datetime.now(timezone.utc)
+        self.updates.append((reported_at, member_id, score))
+        self._latest[member_id] = score
+        player = self._room.get_player_by_id(member_id)
+        if player is not None:
+            self._lines[member_id] = self._render_line(player)
+        self._scoreboard = None
+
+    def latest(self, member_id: int) -> int:
+        """Returns the latest score reported by the player with the given member id, or 0 if they haven't reported
+        one."""
+        return self._latest.get(member_id, 0)
+
+    def latest_scores(self) -> Dict[int, int]:
+        """Returns member id -> latest score for every player who has reported a score."""
+        return dict(self._latest)
+
+    def _render_line(self, player: Player) -> str:
+        return f"{discord.utils.escape_markdown(player.lounge_name)} {self.latest(player.member_id)}\n"
+
+    def _build_layout(self):
+        self._layout = []
+        for team in self._room.teams or []:
+            for player in team.players:
+                self._layout.append(player.member_id)
+                self._lines[player.member_id] = self._render_line(player)
+            self._layout.append(None)
+
+    def scoreboard(self, format_: int) -> str:
+        """Returns the room's scoreboard as a !submit command for the given format."""
+        key = (format_, self._room.tier)
+        if self._scoreboard is not None and self._scoreboard[0] == key:
+            return self._scoreboard[1]
+        if self._layout is None:
+            self._build_layout()
+        team_separator = "\n" if format_ != 1 else ""
+        text = f"!submit {format_} {key[1]}\n" + "".join(
+            team_separator if member_id is None else self._lines[member_id] for member_id in self._layout)
+        self._scoreboard = (key, text)
+        return text
+
+
 class Team:
+    __slots__ = ("_players", "_players_by_member_id")
+
     def __init__(self, players: List["Player"]):
         self.players = players
 
+    @property
+    def players(self) -> List["Player"]:
+        return self._players
+
+    @players.setter
+    def players(self, players: List["Player"]):
+        self._players = players
+        self._players_by_member_id: Dict[int, Player] = {}
+        for player in players:
+            if player.member_id is not None:
+                self._players_by_member_id.setdefault(
+                    player.member_id, player)
+
     def get_mentions(self):
         """Return a string where all players on the team are discord @'d"""
-        return " ".join([p.member.mention for p in self.players])
+        return " ".join([p.mention for p in self.players])
 
     @property
     def avg_mmr(self):
@@ -485,13 +1046,10 @@ class Team:
         return all(player.confirmed for player in self.players)
 
     def has_player(self, member):
-        return any(player.member.id == member.id for player in self.players)
+        return member.id in self._players_by_member_id
 
     def get_player(self, member: discord.Member) -> Player | None:
-        for player in self.players:
-            if player.member.id == member.id:
-                return player
-        return None
+        return self._players_by_member_id.get(member.id)
 
     def num_confirmed(self):
         """Returns the number of confirmed players in the team"""
@@ -516,33 +1074,103 @@ class Team:
         return ", ".join([p.lounge_name for p in self.players])
 
 
+# Looks up a guild member from their id, e.g. discord.Guild.get_member. Set by the cog once the guild is available, so
+# players that have released their member reference can still resolve it.
+_member_resolver: Callable[[int], discord.Member | None] | None = None
+
+
+def set_member_resolver(resolver: Callable[[int], discord.Member | None] | None):
+    global _member_resolver
+    _member_resolver = resolver
+
+
 class Player:
+    __slots__ = ("member_id", "_member", "lounge_name", "mmr", "confirmed", "host", "host_fc", "from_ratings",
+                 "_adjusted_mmr", "_sort_key", "_settings_generation")
+
     def __init__(
             self,
             member: discord.Member,
             lounge_name: str,
             mmr: int,
             confirmed=False,
-            host=False):
+            host=False,
+            from_ratings=False):
         self.member = member
         self.lounge_name = lounge_name
         self.mmr = mmr
         self.confirmed = confirmed
-        self.score = 0
         self.host = host
         self.host_fc = None
+        # Whether the player's MMR came from the ratings table, rather than
+        # from staff, the placement MMR or a debug command
+        self.from_ratings = from_ratings
+        # The adjusted MMR and sort key are computed the first time they are
+        # needed, since players are also created without an MMR
+        self._settings_generation = None
 
     @property
-    def adjusted_mmr(self):
+    def member(self) -> discord.Member | None:
+        """The player's Discord member. If the player's member reference has been released, the member is looked up
+        from the guild, and is None if they are no longer in it."""
+        if self._member is None and self.member_id is not None and _member_resolver is not None:
+            return _member_resolver(self.member_id)
+        return self._member
+
+    @member.setter
+    def member(self, member: discord.Member | None):
+        self._member = member
+        self.member_id = None if member is None else member.id
+
+    def release_member(self):
+        """Drops the player's reference to their Discord member, keeping only their member id. Does nothing if
+        members can't be looked up again."""
+        if _member_resolver is not None:
+            self._member = None
+
+    @property
+    def display_name(self) -> str:
+        """The player's Discord display name, or their lounge name if their member can't be found."""
+        member = self.member
+        if member is None:
+            return self.lounge_name
+        return member.display_name
+
+    def _refresh_adjusted_mmr(self):
+        """Recomputes the player's MMR for matchmaking purposes from the current matchmaking floor and ceiling."""
         minimum_mmr = common.CONFIG["MATCHMAKING_BOTTOM_MMR"]
         maximum_mmr = common.CONFIG["MATCHMAKING_TOP_MMR"]
-        if minimum_mmr is None or maximum_mmr is None:
-            return self.mmr
-        if self.mmr < minimum_mmr:
-            return minimum_mmr
-        if self.mmr > maximum_mmr:
-            return maximum_mmr
-        return self.mmr
+        adjusted_mmr = self.mmr
+        if minimum_mmr is not None and maximum_mmr is not None:
+            if adjusted_mmr < minimum_mmr:
+                adjusted_mmr = minimum_mmr
+            elif adjusted_mmr > maximum_mmr:
+                adjusted_mmr = maximum_mmr
+        self._adjusted_mmr = adjusted_mmr
+        # Ties on adjusted MMR are broken by the real MMR, so sorting by this
+        # orders players exactly as sorting by their real MMR does
+        self._sort_key = (adjusted_mmr, self.mmr)
+        self._settings_generation = common.SETTINGS_GENERATION
+
+    def update_mmr(self, mmr: int):
+        """Changes the player's MMR. Their adjusted MMR and sort key are recomputed the next time they are needed."""
+        self.mmr = mmr
+        self._settings_generation = None
+
+    @property
+    def adjusted_mmr(self) -> int:
+        """The player's MMR, clamped to the matchmaking floor and ceiling. It is only recomputed when the settings
+        change, so the player's mmr must only be changed with update_mmr."""
+        if self._settings_generation != common.SETTINGS_GENERATION:
+            self._refresh_adjusted_mmr()
+        return self._adjusted_mmr
+
+    @property
+    def sort_key(self) -> Tuple[int, int]:
+        """Key to sort players by for matchmaking: their adjusted MMR, then their real MMR."""
+        if self._settings_generation != common.SETTINGS_GENERATION:
+            self._refresh_adjusted_mmr()
+        return self._sort_key
 
     @property
     def is_matchmaking_mmr_adjusted(self):
@@ -551,15 +1179,23 @@ class Player:
     @property
     def mention(self):
         """String that, when sent in a Discord message, will mention and ping the player."""
-        if self.member is None:
+        if self.member_id is None:
             return "<@!1>"
-        return self.member.mention
+        member = self.member
+        if member is None:
+            return f"<@{self.member_id}>"
+        return member.mention
 
     def __repr__(self):
         return f"{__class__.__name__}(member={self.member}, lounge_name={self.lounge_name}, mmr={self.mmr}, confirmed={self.confirmed})"
 
     def __lt__(self, other: Player):
-        return self.mmr < other.mmr
+        return self.sort_key < other.sort_key
+
+
+# Sorting players with this as the key orders them the same way as comparing them with Player.__lt__, but computes
+# each player's key once instead of on every comparison
+player_sort_key = attrgetter("sort_key")
 
 
 class VoteView(View):
@@ -644,7 +1280,7 @@ class VoteView(View):
         teams_per_room = self.mogi.players_per_room // players_per_team
         for j in range(teams_per_room):
             players = sorted(self.players[j * players_per_team:(j + 1) * players_per_team],
-                             key=lambda player: player.mmr, reverse=True)
+                             key=player_sort_key, reverse=True)
             team = Team(players)
             teams.append(team)
 
@@ -753,7 +1389,7 @@ class VoteView(View):
 
     async def general_vote_callback(self, interaction: discord.Interaction):
         if not self.found_winner:
-            if interaction.user.id not in [p.member.id for p in self.players]:
+            if self.room.check_player(interaction.user) is None:
                 await interaction.response.send_message("You are not a player in this event.", ephemeral=True)
                 return
             vote = interaction.data['custom_id']
@@ -802,7 +1438,8 @@ class JoinView(View):
             await interaction.response.send_message(
                 "Players with the muted or restricted role cannot use the sub button.", ephemeral=True)
             return
-        if interaction.user.id in self.room.get_player_list() + self.room.subs:
+        if self.room.check_player(
+                interaction.user) is not None or interaction.user.id in self.room.subs:
             await interaction.response.send_message(
                 "You are already in this room.", ephemeral=True)
             return
@@ -834,121 +1471,22 @@ class JoinView(View):
                 "You do not meet room requirements", ephemeral=True)
 
 
-def get_tier_mkw(mmr: int, players: List[Player]):
-    if mmr > 9999 and player_threshold_check(10000, players):
-        return '8'
-    if mmr > 8999 and player_threshold_check(9000, players):
-        return '7'
-    if mmr > 7999:
-        return '6'
-    if mmr > 6499:
-        return '5'
-    if mmr > 4999:
-        return '4'
-    if mmr > 3499:
-        return '3'
-    if mmr > 1999:
-        return '2'
-    if mmr > 499:
-        return '1'
-    else:
-        return '0'
-
-
-def player_threshold_check(mmr: int, players: List[Player]):
-    player_count = 0
-    for player in players:
-        if player.mmr >= mmr:
-            player_count += 1
-    return player_count >= 10
-
-
-def get_tier_mk8dx(mmr: int):
-    if mmr > 14000:
-        return 'X'
-    if mmr > 13000:
-        return 'S'
-    if mmr > 12000:
-        return 'A'
-    if mmr > 11000:
-        return 'AB'
-    if mmr > 10000:
-        return 'B'
-    if mmr > 9000:
-        return 'BC'
-    if mmr > 8000:
-        return 'C'
-    if mmr > 7000:
-        return 'CD'
-    if mmr > 6000:
-        return 'D'
-    if mmr > 5000:
-        return 'DE'
-    if mmr > 4000:
-        return 'E'
-    if mmr > 3000:
-        return 'EF'
-    if mmr > 2000:
-        return 'F'
-    if mmr > 1000:
-        return 'FG'
-    else:
-        return 'G'
-
-
-def get_tier_mkworld_12(mmr: int):
-    if mmr >= 13000:
-        return 'X'
-    if mmr >= 12500:
-        return 'S'
-    if mmr >= 10000:
-        return 'A'
-    if mmr >= 8500:
-        return 'B'
-    if mmr >= 7000:
-        return 'C'
-    if mmr >= 6000:
-        return 'CD'
-    if mmr >= 5000:
-        return 'D'
-    if mmr >= 4000:
-        return 'DE'
-    if mmr >= 3000:
-        return 'E'
-    if mmr >= 2000:
-        return 'EF'
-    if mmr >= 1000:
-        return 'F'
-    else:
-        return 'G'
-
-
-def get_tier_mkworld_24(mmr: int):
-    if mmr >= 13500:
-        return 'X'
-    if mmr >= 12000:
-        return 'S'
-    if mmr >= 10500:
-        return 'A'
-    if mmr >= 9500:
-        return 'B'
-    if mmr >= 8500:
-        return 'BC'
-    if mmr >= 7500:
-        return 'C'
-    if mmr >= 6500:
-        return 'CD'
-    if mmr >= 5500:
-        return 'D'
-    if mmr >= 4500:
-        return 'DE'
-    if mmr >= 3500:
-        return 'E'
-    if mmr >= 2500:
-        return 'EF'
-    if mmr >= 1500:
-        return 'F'
-    if mmr >= 500:
-        return 'FG'
-    else:
-        return 'G'
+@matchmaking.register(matchmaking.PROPOSAL, "join_order")
+def join_order_proposal(mogi: Mogi, valid_players_check: Callable[[
+                        List[Player]], bool] = None) -> List[Player]:
+    """Players who joined first fill as many rooms as possible, sorted by MMR. Room validity is not checked."""
+    return mogi._mk8dx_generate_final_list()
+
+
+@matchmaking.register(matchmaking.PROPOSAL, "greedy")
+def greedy_proposal(mogi: Mogi, valid_players_check: Callable[[
+                    List[Player]], bool] = None) -> List[Player]:
+    """Fills rooms one at a time from the top, swapping in late players when a room's range is too large."""
+    return mogi._mkw_generate_final_list(valid_players_check)
+
+
+@matchmaking.register(matchmaking.PROPOSAL, "partition")
+def partition_proposal(mogi: Mogi, valid_players_check: Callable[[
+                       List[Player]], bool] = None) -> List[Player]:
+    """Splits all players into rooms at once, cancelling as few rooms as possible."""
+    return mogi._partition_generate_final_list(valid_players_check)
@@ -0,0 +1,93 @@
+"""Vectorised versions of the matchmaking range calculations, used when the config's MATCHMAKING_BACKEND is set to
+"numpy". NumPy is an optional dependency - if it is not installed, the pure Python matchmaking code is used instead.
+
+The functions here work on adjusted MMRs that have been packed into an array once, rather than reading the
+adjusted_mmr property of each Player for every range check. They return the same results as the pure Python code.
+Building an array costs more than a pure Python scan of a few rooms' worth of players, so they are only used for lists
+of at least MIN_PLAYERS players (see use_for). Install numpy with `pip install numpy` to use this backend."""
+from __future__ import annotations
+
+import common
+from typing import List, TYPE_CHECKING
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if TYPE_CHECKING:
+    from mogi_objects import Player
+
+# The smallest list of players worth packing into an array. Below this, the
+# pure Python code is faster.
+MIN_PLAYERS = 96
+
+
+def check_config():
+    """Prints a warning if the config selects the numpy backend but numpy is not installed."""
+    if common.CONFIG.get("MATCHMAKING_BACKEND", "python") == "numpy" and np is None:
+        print("MATCHMAKING_BACKEND is set to numpy, but numpy is not installed. Using the python matchmaking backend "
+              "instead.", flush=True)
+
+
+def enabled() -> bool:
+    """Returns True if the config selects the numpy backend and numpy is installed."""
+    return np is not None and common.CONFIG.get(
+        "MATCHMAKING_BACKEND", "python") == "numpy"
+
+
+def use_for(num_players: int) -> bool:
+    """Returns True if the numpy backend is enabled and a list of num_players players is large enough to use it."""
+    return num_players >= MIN_PLAYERS and enabled()
+
+
+def pack_mmrs(players: List[Player]) -> np.ndarray:
+    """Returns the adjusted MMR of each of the given players, in the same order, as an array."""
+    return np.fromiter((p.adjusted_mmr for p in players),
+                       dtype=np.int64, count=len(players))
+
+
+def to_array(mmrs: List[int]) -> np.ndarray:
+    """Returns the given list of MMRs as an array."""
+    return np.array(mmrs, dtype=np.int64)
+
+
+def window_ranges(sorted_mmrs: np.ndarray, window_size: int) -> np.ndarray:
+    """Given MMRs sorted lowest to highest, returns the MMR range of every window of window_size consecutive MMRs.
+    Index i of the result is the range of the window starting at index i."""
+    if window_size < 1 or len(sorted_mmrs) < window_size:
+        return np.empty(0, dtype=np.int64)
+    return sorted_mmrs[window_size - 1:] - \
+        sorted_mmrs[:len(sorted_mmrs) - window_size + 1]
+
+
+def best_window_start(sorted_mmrs: np.ndarray,
+                      window_size: int) -> int | None:
+    """Given MMRs sorted lowest to highest, returns the start index of the first window of window_size MMRs with the
+    smallest range, or None if there is no such window."""
+    ranges = window_ranges(sorted_mmrs, window_size)
+    if len(ranges) == 0:
+        return None
+    # argmin returns the first occurrence of the minimum, which matches the
+    # tie-breaking of the pure Python scan
+    return int(np.argmin(ranges))
+
+
+def chunk_ranges(mmrs: np.ndarray, chunk_size: int) -> np.ndarray:
+    """Returns the MMR range of each chunk of chunk_size MMRs, in the same chunks as common.divide_chunks (the last
+    chunk may be smaller)."""
+    num_full_chunks = len(mmrs) // chunk_size
+    full_chunks = mmrs[:num_full_chunks * chunk_size].reshape(
+        num_full_chunks, chunk_size)
+    ranges = np.ptp(full_chunks, axis=1) if num_full_chunks > 0 else np.empty(
+        0, dtype=np.int64)
+    if len(mmrs) % chunk_size != 0:
+        ranges = np.append(ranges, np.ptp(mmrs[num_full_chunks * chunk_size:]))
+    return ranges
+
+
+def count_cancelled(mmrs: np.ndarray, chunk_size: int, threshold: int) -> int:
+    """Returns the number of chunks of chunk_size MMRs whose range is larger than the threshold."""
+    if len(mmrs) == 0:
+        return 0
+    return int(np.count_nonzero(chunk_ranges(mmrs, chunk_size) > threshold))
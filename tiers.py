@@ -0,0 +1,232 @@
+"""Table-driven room tiers.
+
+Each lounge's tiers are a table of MMR thresholds, sorted lowest to highest. A room's tier is the highest tier whose
+threshold its average MMR passes, found with a binary search. A tier can also require a minimum number of players in
+the room to be rated at or above a given MMR; if the room doesn't meet it, the next tier down is tried.
+
+The tables can be overridden in the config under TIER_TABLES, keyed by table name, for example:
+
+"TIER_TABLES": {
+    "mkw": {
+        "inclusive": false,
+        "offset": 0,
+        "default": "0",
+        "tiers": [
+            {"tier": "1", "mmr": 499},
+            ...
+            {"tier": "8", "mmr": 9999, "min_players": 10, "player_mmr": 10000}
+        ]
+    }
+}
+
+"inclusive" chooses whether a room's average MMR must be at least the threshold (true) or above it (false). "offset"
+is added to the room's average MMR before looking it up, and "default" is the tier of rooms below every threshold.
+Tables not in the config use the defaults below. Staff can reload the tables from the config without restarting."""
+import bisect
+import json
+from typing import Dict, List, Tuple
+
+import common
+import matchmaking
+
+DEFAULT_TIER_TABLES = {
+    "mkw": {
+        "inclusive": False,
+        "offset": 0,
+        "default": "0",
+        "tiers": [
+            {"tier": "1", "mmr": 499},
+            {"tier": "2", "mmr": 1999},
+            {"tier": "3", "mmr": 3499},
+            {"tier": "4", "mmr": 4999},
+            {"tier": "5", "mmr": 6499},
+            {"tier": "6", "mmr": 7999},
+            {"tier": "7", "mmr": 8999, "min_players": 10, "player_mmr": 9000},
+            {"tier": "8", "mmr": 9999, "min_players": 10, "player_mmr": 10000},
+        ],
+    },
+    "mk8dx": {
+        "inclusive": False,
+        "offset": -500,
+        "default": "G",
+        "tiers": [
+            {"tier": "FG", "mmr": 1000},
+            {"tier": "F", "mmr": 2000},
+            {"tier": "EF", "mmr": 3000},
+            {"tier": "E", "mmr": 4000},
+            {"tier": "DE", "mmr": 5000},
+            {"tier": "D", "mmr": 6000},
+            {"tier": "CD", "mmr": 7000},
+            {"tier": "C", "mmr": 8000},
+            {"tier": "BC", "mmr": 9000},
+            {"tier": "B", "mmr": 10000},
+            {"tier": "AB", "mmr": 11000},
+            {"tier": "A", "mmr": 12000},
+            {"tier": "S", "mmr": 13000},
+            {"tier": "X", "mmr": 14000},
+        ],
+    },
+    "mkworld_12": {
+        "inclusive": True,
+        "offset": 0,
+        "default": "G",
+        "tiers": [
+            {"tier": "F", "mmr": 1000},
+            {"tier": "EF", "mmr": 2000},
+            {"tier": "E", "mmr": 3000},
+            {"tier": "DE", "mmr": 4000},
+            {"tier": "D", "mmr": 5000},
+            {"tier": "CD", "mmr": 6000},
+            {"tier": "C", "mmr": 7000},
+            {"tier": "B", "mmr": 8500},
+            {"tier": "A", "mmr": 10000},
+            {"tier": "S", "mmr": 12500},
+            {"tier": "X", "mmr": 13000},
+        ],
+    },
+    "mkworld_24": {
+        "inclusive": True,
+        "offset": 0,
+        "default": "G",
+        "tiers": [
+            {"tier": "FG", "mmr": 500},
+            {"tier": "F", "mmr": 1500},
+            {"tier": "EF", "mmr": 2500},
+            {"tier": "E", "mmr": 3500},
+            {"tier": "DE", "mmr": 4500},
+            {"tier": "D", "mmr": 5500},
+            {"tier": "CD", "mmr": 6500},
+            {"tier": "C", "mmr": 7500},
+            {"tier": "BC", "mmr": 8500},
+            {"tier": "B", "mmr": 9500},
+            {"tier": "A", "mmr": 10500},
+            {"tier": "S", "mmr": 12000},
+            {"tier": "X", "mmr": 13500},
+        ],
+    },
+}
+
+
+class BadTierTable(ValueError):
+    pass
+
+
+class TierTable:
+    def __init__(self, name: str, table: dict):
+        self.name = name
+        try:
+            self.inclusive: bool = bool(table.get("inclusive", False))
+            self.offset: int = int(table.get("offset", 0))
+            self.default: str = str(table["default"])
+            tiers = sorted(table["tiers"], key=lambda t: t["mmr"])
+            self.thresholds: List[int] = [int(t["mmr"]) for t in tiers]
+            self.tiers: List[str] = [str(t["tier"]) for t in tiers]
+            # (minimum number of players, player MMR) for each tier, or None
+            # if the tier has no player requirement
+            self.requirements: List[Tuple[int, int] | None] = [
+                (int(t["min_players"]), int(t["player_mmr"])) if "min_players" in t else None for t in tiers]
+        except (KeyError, TypeError, ValueError) as e:
+            raise BadTierTable(f"Tier table {name} is invalid: {e!r}")
+        if len(set(self.thresholds)) != len(self.thresholds):
+            raise BadTierTable(
+                f"Tier table {name} has more than one tier with the same MMR threshold")
+        # The distinct player MMRs that tiers require players to be rated at
+        # or above, lowest to highest
+        self.requirement_mmrs: List[int] = sorted(
+            {r[1] for r in self.requirements if r is not None})
+
+    def _players_at_or_above(self, player_mmrs: List[int]) -> Dict[int, int]:
+        """In a single pass over the players, counts how many are rated at or above each required player MMR."""
+        counts = [0] * (len(self.requirement_mmrs) + 1)
+        for mmr in player_mmrs:
+            counts[bisect.bisect_right(self.requirement_mmrs, mmr)] += 1
+        result = {}
+        at_or_above = 0
+        for i in range(len(self.requirement_mmrs), 0, -1):
+            at_or_above += counts[i]
+            result[self.requirement_mmrs[i - 1]] = at_or_above
+        return result
+
+    def lookup(self, mmr: int, player_mmrs: List[int] = ()) -> str:
+        """Returns the tier of a room with the given average MMR and player MMRs."""
+        mmr += self.offset
+        if self.inclusive:
+            index = bisect.bisect_right(self.thresholds, mmr) - 1
+        else:
+            index = bisect.bisect_left(self.thresholds, mmr) - 1
+        counts = None
+        while index >= 0:
+            requirement = self.requirements[index]
+            if requirement is None:
+                return self.tiers[index]
+            if counts is None:
+                counts = self._players_at_or_above(player_mmrs)
+            min_players, player_mmr = requirement
+            if counts[player_mmr] >= min_players:
+                return self.tiers[index]
+            index -= 1
+        return self.default
+
+
+_TABLES: Dict[str, TierTable] = {}
+
+
+def load_tables(config: dict):
+    """Builds the tier tables from the defaults and the config's TIER_TABLES, then replaces the current tables. If
+    any table is invalid, BadTierTable is raised and the current tables are kept."""
+    global _TABLES
+    table_dicts = dict(DEFAULT_TIER_TABLES)
+    table_dicts.update(config.get("TIER_TABLES") or {})
+    tables = {name: TierTable(name, table)
+              for name, table in table_dicts.items()}
+    _TABLES = tables
+    # Rooms cache their tiers against the settings generation
+    common.settings_changed()
+
+
+def reload_tables(config_path: str = "./config.json"):
+    """Reloads the tier tables from the TIER_TABLES in the config file, so staff can change tiers without a
+    restart."""
+    with open(config_path, "r") as cjson:
+        tier_tables = json.load(cjson).get("TIER_TABLES")
+    load_tables({"TIER_TABLES": tier_tables})
+    common.CONFIG["TIER_TABLES"] = tier_tables
+
+
+def get_table(name: str) -> TierTable:
+    return _TABLES[name]
+
+
+def get_tier(name: str, mmr: int, player_mmrs: List[int] = ()) -> str:
+    """Returns the tier from the given table for a room with the given average MMR and player MMRs."""
+    return _TABLES[name].lookup(mmr, player_mmrs)
+
+
+def tables_str() -> str:
+    msg = ""
+    for name, table in _TABLES.items():
+        comparison = ">=" if table.inclusive else ">"
+        tiers = ", ".join(f"{tier} {comparison}{mmr}" for tier, mmr in zip(
+            table.tiers, table.thresholds))
+        msg += f"{name} (offset {table.offset}): {table.default}, {tiers}\n"
+    return msg
+
+
+@matchmaking.register(matchmaking.TIER, "mk8dx")
+def mk8dx_room_tier(room) -> str:
+    return get_tier("mk8dx", round(room.avg_mmr))
+
+
+@matchmaking.register(matchmaking.TIER, "mkw")
+def mkw_room_tier(room) -> str:
+    return get_tier("mkw", room.avg_mmr, [p.mmr for p in room.players])
+
+
+@matchmaking.register(matchmaking.TIER, "mkworld")
+def mkworld_room_tier(room) -> str:
+    if len(room.players) == 12:
+        return get_tier("mkworld_12", round(room.avg_mmr))
+    return get_tier("mkworld_24", round(room.avg_mmr))
+
+
+load_tables(common.CONFIG)
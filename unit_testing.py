@@ -1,9 +1,24 @@
 import unittest
 
+import asyncio
 import common
+import http_client
+import json
+import os
+import tempfile
+import matchmaking
+import mmr
+import mogi_objects
+import numpy_backend
+import tiers
 from cogs import SquadQueue
-from mogi_objects import Player, Mogi, Team
+from mogi_objects import Player, Mogi, Team, Room, RoomRegistry, SortedPlayerWindow, PlayersAllowedCheck
 import random
+import aiohttp
+from aiohttp import web
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
 
 
 class AlgorithmTests(unittest.TestCase):
@@ -159,6 +174,827 @@ class AlgorithmTests(unittest.TestCase):
         self.assertSetEqual(set(players), set(result))
 
 
+class SortedPlayerWindowTests(unittest.TestCase):
+
+    def test_too_few_players(self):
+        """Test that no window is returned until enough players are in the pool"""
+        window = SortedPlayerWindow(3, [Player(None, "1", 100)])
+        self.assertIsNone(window.best_window())
+        window.insert(Player(None, "2", 200))
+        self.assertIsNone(window.best_window())
+        window.insert(Player(None, "3", 300))
+        self.assertEqual(3, len(window.best_window()))
+
+    def test_insert_splits_best_window(self):
+        """Test when a new player lands inside of the current best window"""
+        p1 = Player(None, "1", 0)
+        p2 = Player(None, "2", 10)
+        p3 = Player(None, "3", 1000)
+        p4 = Player(None, "4", 5)
+        window = SortedPlayerWindow(2, [p1, p2, p3])
+        self.assertListEqual([p1, p2], window.best_window())
+        window.insert(p4)
+        self.assertListEqual([p1, p4], window.best_window())
+
+    def test_incremental_matches_full_sort(self):
+        """Test that inserting players one at a time gives the same window as sorting all of the players at once"""
+        rng = random.Random(12)
+        for _ in range(200):
+            window_size = rng.randint(2, 12)
+            players = [Player(None, f"{i}", rng.randint(0, 40) * 25)
+                       for i in range(rng.randint(window_size, 40))]
+            window = SortedPlayerWindow(window_size, players[:window_size])
+            for i in range(window_size, len(players)):
+                window.insert(players[i])
+                expected = SortedPlayerWindow(
+                    window_size, players[:i + 1]).best_window()
+                self.assertListEqual(expected, window.best_window())
+
+
+class PartitionAlgorithmTests(unittest.TestCase):
+
+    @staticmethod
+    def _range_check(threshold):
+        return lambda players: SquadQueue.basic_threshold_players_allowed(
+            players, threshold)
+
+    @staticmethod
+    def _mogi_with_ratings(players_per_room, ratings):
+        mogi = Mogi(sq_id=1, max_players_per_team=1,
+                    players_per_room=players_per_room, buttons=[], mogi_channel=None)
+        players = [Player(None, f"{i}", rating, True)
+                   for i, rating in enumerate(ratings)]
+        for p in players:
+            mogi.teams.append(Team([p]))
+        return mogi, players
+
+    def test_insufficient_players(self):
+        """Test when not enough players are queued for a room"""
+        mogi, _ = self._mogi_with_ratings(12, [1000, 2000])
+        results, status_code = mogi._partition_final_list_algorithm(
+            self._range_check(65), 1000)
+        self.assertListEqual([], results)
+        self.assertEqual(
+            Mogi.ALGORITHM_STATUS_INSUFFICIENT_PLAYERS,
+            status_code)
+
+    def test_avoids_cancelled_room(self):
+        """Test that a room the room by room algorithm would cancel is saved by removing an on time player"""
+        mogi, players = self._mogi_with_ratings(2, [50, 75, 75, 85, 95])
+        check = self._range_check(10)
+        greedy_list = mogi._mkw_generate_final_list(check)
+        self.assertEqual(1, mogi._count_cancelled(greedy_list, check))
+        results, status_code = mogi._partition_final_list_algorithm(
+            check, 1000)
+        self.assertEqual(Mogi.ALGORITHM_STATUS_SUCCESS_FOUND, status_code)
+        self.assertListEqual(
+            [[players[4], players[3]], [players[1], players[2]]], results)
+
+    def test_prefers_on_time_players(self):
+        """Test that late players are not swapped in only to lower the range"""
+        mogi, players = self._mogi_with_ratings(2, [0, 10, 5])
+        results, status_code = mogi._partition_final_list_algorithm(
+            self._range_check(10), 1000)
+        self.assertEqual(Mogi.ALGORITHM_STATUS_SUCCESS_FOUND, status_code)
+        self.assertListEqual([[players[1], players[0]]], results)
+
+
+@unittest.skipIf(numpy_backend.np is None, "numpy is not installed")
+class NumpyBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.original_backend = common.CONFIG.get("MATCHMAKING_BACKEND")
+        # Use numpy for every list, not only large ones, so small random
+        # queues test it
+        self.original_min_players = numpy_backend.MIN_PLAYERS
+        numpy_backend.MIN_PLAYERS = 0
+
+    def tearDown(self):
+        common.CONFIG["MATCHMAKING_BACKEND"] = self.original_backend
+        numpy_backend.MIN_PLAYERS = self.original_min_players
+
+    @staticmethod
+    def _run_algorithms(ratings, players_per_room, threshold):
+        mogi = Mogi(sq_id=1, max_players_per_team=1,
+                    players_per_room=players_per_room, buttons=[], mogi_channel=None)
+        for i, rating in enumerate(ratings):
+            mogi.teams.append(Team([Player(None, f"{i}", rating, True)]))
+        check = PlayersAllowedCheck(
+            SquadQueue.basic_threshold_players_allowed, threshold, range_only=True)
+        rooms, status = mogi._all_room_final_list_algorithm(check)
+        proposed_list = common.flatten(rooms)
+        return ([[p.lounge_name for p in room] for room in rooms], status,
+                mogi._count_cancelled(proposed_list, check))
+
+    def test_same_results_as_python(self):
+        """Test that the numpy backend makes the same rooms as the python backend"""
+        rng = random.Random(3)
+        for _ in range(100):
+            players_per_room = rng.choice([2, 4, 6, 12])
+            ratings = [rng.randint(0, 200) * 50
+                       for _ in range(rng.randint(0, 60))]
+            threshold = rng.randint(0, 3000)
+            common.CONFIG["MATCHMAKING_BACKEND"] = "python"
+            python_results = self._run_algorithms(
+                ratings, players_per_room, threshold)
+            common.CONFIG["MATCHMAKING_BACKEND"] = "numpy"
+            numpy_results = self._run_algorithms(
+                ratings, players_per_room, threshold)
+            self.assertEqual(python_results, numpy_results)
+
+    def test_count_cancelled_partial_last_room(self):
+        """Test that a smaller last room is counted the same way as common.divide_chunks"""
+        mmrs = numpy_backend.to_array([0, 10, 20, 30, 1000])
+        self.assertEqual(2, numpy_backend.count_cancelled(mmrs, 2, 5))
+        self.assertEqual(0, numpy_backend.count_cancelled(mmrs, 4, 30))
+        self.assertEqual(2, numpy_backend.count_cancelled(mmrs, 3, 10))
+
+
+class RosterCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.num_checks = 0
+
+    def _counting_check(self, players, threshold):
+        self.num_checks += 1
+        return SquadQueue.basic_threshold_players_allowed(players, threshold)
+
+    def _new_mogi(self):
+        mogi = Mogi(sq_id=1, max_players_per_team=1,
+                    players_per_room=2, buttons=[], mogi_channel=None)
+        for rating in (0, 100, 5000, 5100):
+            mogi.teams.append(Team([Player(None, f"{rating}", rating, True)]))
+        return mogi
+
+    def test_cancelled_verdict_is_cached(self):
+        """Test that checking for cancelled rooms again without roster changes does not rerun the checks"""
+        mogi = self._new_mogi()
+        check = PlayersAllowedCheck(self._counting_check, 100)
+        self.assertFalse(mogi.any_room_cancelled(check))
+        num_checks = self.num_checks
+        self.assertFalse(mogi.any_room_cancelled(
+            PlayersAllowedCheck(self._counting_check, 100)))
+        self.assertEqual(num_checks, self.num_checks)
+
+    def test_cache_invalidated_by_roster_and_threshold(self):
+        """Test that adding a team or changing the threshold recomputes the verdict"""
+        mogi = self._new_mogi()
+        self.assertFalse(mogi.any_room_cancelled(
+            PlayersAllowedCheck(self._counting_check, 100)))
+        self.assertTrue(mogi.any_room_cancelled(
+            PlayersAllowedCheck(self._counting_check, 50)))
+        mogi.teams.append(Team([Player(None, "2000", 2000, True)]))
+        mogi.teams.append(Team([Player(None, "9000", 9000, True)]))
+        self.assertTrue(mogi.any_room_cancelled(
+            PlayersAllowedCheck(self._counting_check, 100)))
+        mogi.teams.pop()
+        mogi.teams.pop()
+        self.assertFalse(mogi.any_room_cancelled(
+            PlayersAllowedCheck(self._counting_check, 100)))
+
+    def test_player_mmrs_updated_from_ratings(self):
+        """Test that queued players whose MMR came from the ratings get their new MMR and the cached verdict is
+        recomputed, and that other players keep theirs"""
+        mogi = Mogi(sq_id=1, max_players_per_team=1,
+                    players_per_room=2, buttons=[], mogi_channel=None)
+        rated = [Player(SimpleNamespace(id=member_id), f"{rating}", rating, True, from_ratings=True)
+                 for member_id, rating in ((1, 0), (2, 100), (3, 5000), (4, 5100))]
+        staff_added = Player(SimpleNamespace(id=5), "staff", 7000, True)
+        mogi.teams = [Team([p]) for p in rated + [staff_added]]
+        check = PlayersAllowedCheck(self._counting_check, 100)
+        self.assertFalse(mogi.any_room_cancelled(check))
+        new_ratings = {2: 4950, 3: 5000, 5: 0}
+        self.assertEqual(1, mogi.update_player_mmrs(new_ratings.get))
+        self.assertEqual((4950, 4950), (rated[1].mmr, rated[1].sort_key[0]))
+        self.assertEqual(7000, staff_added.mmr)
+        self.assertTrue(mogi.any_room_cancelled(check))
+
+
+class AdjustedMMRTests(unittest.TestCase):
+
+    def setUp(self):
+        self.old_bounds = (common.CONFIG["MATCHMAKING_BOTTOM_MMR"],
+                           common.CONFIG["MATCHMAKING_TOP_MMR"])
+
+    def tearDown(self):
+        common.set_matchmaking_mmr_bounds(*self.old_bounds)
+
+    def test_adjusted_mmr_follows_bounds(self):
+        """Test that existing players' adjusted MMR changes when the matchmaking floor and ceiling change"""
+        common.set_matchmaking_mmr_bounds(None, None)
+        low, high = Player(None, "low", 100), Player(None, "high", 9000)
+        self.assertEqual((100, 9000), (low.adjusted_mmr, high.adjusted_mmr))
+        common.set_matchmaking_mmr_bounds(500, 8000)
+        self.assertEqual((500, 8000), (low.adjusted_mmr, high.adjusted_mmr))
+        self.assertTrue(low.is_matchmaking_mmr_adjusted)
+
+    def test_clamped_players_sort_by_real_mmr(self):
+        """Test that players clamped to the same MMR still sort by their real MMR"""
+        common.set_matchmaking_mmr_bounds(500, 8000)
+        players = [Player(None, f"{rating}", rating)
+                   for rating in (9500, 100, 8500, 300)]
+        self.assertEqual([100, 300, 8500, 9500], [p.mmr for p in sorted(players)])
+
+    def test_bounds_change_invalidates_cache(self):
+        """Test that changing the matchmaking ceiling recomputes cached cancellation verdicts"""
+        common.set_matchmaking_mmr_bounds(None, None)
+        mogi = Mogi(sq_id=1, max_players_per_team=1,
+                    players_per_room=2, buttons=[], mogi_channel=None)
+        mogi.teams = [Team([Player(None, f"{rating}", rating, True)])
+                      for rating in (1000, 3000)]
+        check = PlayersAllowedCheck(
+            SquadQueue.basic_threshold_players_allowed, 1000)
+        self.assertTrue(mogi.any_room_cancelled(check))
+        common.set_matchmaking_mmr_bounds(0, 2000)
+        self.assertFalse(mogi.any_room_cancelled(check))
+
+
+class PlayerMemberTests(unittest.TestCase):
+
+    def tearDown(self):
+        mogi_objects.set_member_resolver(None)
+
+    def test_released_member_is_resolved_from_guild(self):
+        """Test that a player who released their member looks it up again by member id"""
+        member = SimpleNamespace(id=5, display_name="Five", mention="<@5>")
+        player = Player(member, "Lounge Five", 1000)
+        player.release_member()
+        self.assertIs(member, player.member)
+        mogi_objects.set_member_resolver({5: member}.get)
+        player.release_member()
+        self.assertIs(member, player.member)
+        self.assertEqual("Five", player.display_name)
+        mogi_objects.set_member_resolver({}.get)
+        self.assertIsNone(player.member)
+        self.assertEqual(5, player.member_id)
+        self.assertEqual("Lounge Five", player.display_name)
+        self.assertEqual("<@5>", player.mention)
+
+
+class MatchmakingRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.old_algorithm = common.CONFIG.get("MATCHMAKING_ALGORITHM")
+        # Strategies registered by a test are removed after it
+        registry = mock.patch.dict(matchmaking._STRATEGIES[matchmaking.PROPOSAL])
+        registry.start()
+        self.addCleanup(registry.stop)
+
+    def tearDown(self):
+        common.CONFIG["MATCHMAKING_ALGORITHM"] = self.old_algorithm
+
+    def test_proposal_selected_by_config(self):
+        """Test that the proposal strategy named in the config is used and its calls are counted"""
+        @matchmaking.register(matchmaking.PROPOSAL, "test_reversed")
+        def reversed_proposal(mogi, valid_players_check=None):
+            return list(reversed(mogi.players_on_confirmed_teams()))
+        common.CONFIG["MATCHMAKING_ALGORITHM"] = "test_reversed"
+        strategy = matchmaking.get(matchmaking.PROPOSAL)
+        strategy.reset_stats()
+        mogi = Mogi(sq_id=1, max_players_per_team=1,
+                    players_per_room=2, buttons=[], mogi_channel=None)
+        players = [Player(None, f"{rating}", rating, True)
+                   for rating in (100, 300, 200)]
+        mogi.teams = [Team([p]) for p in players]
+        self.assertEqual(players[::-1], mogi.generate_proposed_list())
+        self.assertEqual(1, strategy.calls)
+
+    def test_registry_patch_removes_strategies(self):
+        """Test that a strategy registered while the registry is patched is removed when the patch is stopped"""
+        with mock.patch.dict(matchmaking._STRATEGIES[matchmaking.PROPOSAL]):
+            @matchmaking.register(matchmaking.PROPOSAL, "test_temporary")
+            def temporary_proposal(mogi, valid_players_check=None):
+                return mogi.players_on_confirmed_teams()
+            self.assertIn("test_temporary", matchmaking.registered(matchmaking.PROPOSAL))
+        self.assertNotIn("test_temporary", matchmaking.registered(matchmaking.PROPOSAL))
+
+    def test_unknown_strategy(self):
+        """Test that selecting a strategy that was never registered is reported"""
+        common.CONFIG["MATCHMAKING_ALGORITHM"] = "not_a_strategy"
+        with self.assertRaises(matchmaking.UnknownStrategy):
+            matchmaking.check_config()
+
+
+class RosterAggregateTests(unittest.TestCase):
+
+    def test_aggregates_match_teams(self):
+        """Test that the confirmed player counts and lists stay correct as teams join and drop"""
+        rng = random.Random(5)
+        mogi = Mogi(sq_id=1, max_players_per_team=2,
+                    players_per_room=4, buttons=[], mogi_channel=None)
+        for i in range(300):
+            if len(mogi.teams) > 0 and rng.random() < 0.3:
+                team = rng.choice(mogi.teams)
+                if rng.random() < 0.5:
+                    mogi.teams.remove(team)
+                else:
+                    mogi.teams.pop(mogi.teams.index(team))
+            else:
+                mogi.teams.append(Team([Player(None, f"{i} {j}", rng.randint(0, 9000), rng.random() < 0.8)
+                                        for j in range(rng.randint(1, 2))]))
+            confirmed_teams = [t for t in mogi.teams if t.all_registered()]
+            self.assertListEqual(confirmed_teams, mogi.confirmed_teams())
+            self.assertListEqual(common.flatten(
+                [t.players for t in confirmed_teams]), mogi.players_on_confirmed_teams())
+            self.assertEqual(len(confirmed_teams), mogi.num_teams)
+            self.assertEqual(
+                sum(len(t.players) for t in confirmed_teams), mogi.num_players)
+
+    def test_roster_changed_after_confirming(self):
+        """Test that confirming a player on a queued team counts once the Mogi is told about it"""
+        mogi = Mogi(sq_id=1, max_players_per_team=1,
+                    players_per_room=2, buttons=[], mogi_channel=None)
+        player = Player(None, "1", 1000)
+        mogi.teams.append(Team([player]))
+        self.assertEqual(0, mogi.num_players)
+        player.confirmed = True
+        mogi.roster_changed()
+        self.assertEqual(1, mogi.num_players)
+
+
+class MemberIndexTests(unittest.TestCase):
+
+    def test_mogi_lookup_follows_teams(self):
+        """Test that queued players can be looked up by member after joining and not after dropping"""
+        mogi = Mogi(sq_id=1, max_players_per_team=1, players_per_room=12, buttons=[],
+                    mogi_channel=None)
+        members = [SimpleNamespace(id=i) for i in range(3)]
+        players = [Player(m, f"{m.id}", 1000, True) for m in members]
+        teams = [Team([p]) for p in players]
+        for team in teams:
+            mogi.teams.append(team)
+        self.assertIs(teams[1], mogi.check_player(members[1]))
+        self.assertIs(players[1], mogi.get_player(members[1]))
+        mogi.teams.remove(teams[1])
+        self.assertIsNone(mogi.check_player(members[1]))
+        self.assertIs(teams[2], mogi.check_player(members[2]))
+        self.assertIsNone(mogi.check_player(SimpleNamespace(id=10)))
+
+    def test_room_lookup_follows_teams(self):
+        """Test that room lookups are rebuilt when the room's teams change"""
+        members = [SimpleNamespace(id=i) for i in range(4)]
+        players = [Player(m, f"{m.id}", 1000, True) for m in members]
+        room = Room(None, 1, None, [])
+        self.assertIsNone(room.check_player(members[0]))
+        room.teams = [Team([p]) for p in players]
+        self.assertIs(players[3], room.get_player(members[3]))
+        room.teams = [Team(players[0:2]), Team(players[2:4])]
+        self.assertIs(room.teams[1], room.check_player(members[2]))
+
+
+class RoomStatsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.old_bounds = (common.CONFIG["MATCHMAKING_BOTTOM_MMR"],
+                           common.CONFIG["MATCHMAKING_TOP_MMR"])
+        common.set_matchmaking_mmr_bounds(None, None)
+
+    def tearDown(self):
+        common.set_matchmaking_mmr_bounds(*self.old_bounds)
+
+    def test_stats_follow_teams_and_bounds(self):
+        """Test that a room's MMR range and average are recomputed when its teams or the matchmaking bounds change"""
+        room = Room(None, 1, None, [])
+        self.assertEqual((None, None, 0), (room.mmr_low, room.mmr_high, room.avg_mmr))
+        room.teams = [Team([Player(None, f"{rating}", rating)])
+                      for rating in (1000, 2000, 6000)]
+        self.assertEqual((1000, 6000, 3000), (room.mmr_low, room.mmr_high, room.avg_mmr))
+        common.set_matchmaking_mmr_bounds(1500, 5000)
+        self.assertEqual((1500, 5000, 3000), (room.mmr_low, room.mmr_high, room.avg_mmr))
+        room.teams = room.teams[:2]
+        self.assertEqual((1500, 2000, 1500), (room.mmr_low, room.mmr_high, room.avg_mmr))
+
+
+class ScoreLedgerTests(unittest.TestCase):
+
+    def test_latest_score_and_cached_scoreboard(self):
+        """Test that the scoreboard shows each player's latest score and is only re-rendered after a score update"""
+        players = [Player(SimpleNamespace(id=i, mention=f"<@{i}>"), f"Player_{i}", 5000) for i in range(4)]
+        room = Room([Team(players[:2]), Team(players[2:])], 1, None, [])
+        ledger = room.scores
+        ledger.record(1, 80)
+        ledger.record(1, 85)
+        ledger.record(99, 10)
+        self.assertEqual(85, ledger.latest(1))
+        self.assertEqual(0, ledger.latest(2))
+        self.assertEqual(3, len(ledger.updates))
+        scoreboard = ledger.scoreboard(2)
+        self.assertEqual(f"!submit 2 {room.tier}\nPlayer\\_0 0\nPlayer\\_1 85\n\nPlayer\\_2 0\nPlayer\\_3 0\n\n",
+                         scoreboard)
+        self.assertIs(scoreboard, ledger.scoreboard(2))
+        ledger.record(3, 70)
+        self.assertIn("Player\\_3 70\n", ledger.scoreboard(2))
+        room.teams = [Team([players[3]])]
+        self.assertEqual(f"!submit 1 {room.tier}\nPlayer\\_3 70\n", ledger.scoreboard(1))
+
+
+class TierTableTests(unittest.TestCase):
+
+    def tearDown(self):
+        tiers.load_tables(common.CONFIG)
+
+    def test_mkw_player_requirement(self):
+        """Test that a tier with a player requirement falls through to the next tier when the room doesn't meet it"""
+        nine_high = [10000] * 9 + [9500] * 3
+        self.assertEqual("8", tiers.get_tier("mkw", 10500, [10000] * 10 + [9500] * 2))
+        self.assertEqual("7", tiers.get_tier("mkw", 10500, nine_high))
+        self.assertEqual("6", tiers.get_tier("mkw", 10500, [8000] * 12))
+        self.assertEqual("6", tiers.get_tier("mkw", 8999, nine_high))
+        self.assertEqual("0", tiers.get_tier("mkw", 499))
+
+    def test_inclusive_and_offset(self):
+        """Test the boundaries of inclusive tables and tables with an offset"""
+        self.assertEqual("X", tiers.get_tier("mkworld_12", 13000))
+        self.assertEqual("S", tiers.get_tier("mkworld_12", 12999))
+        self.assertEqual("X", tiers.get_tier("mk8dx", 14501))
+        self.assertEqual("S", tiers.get_tier("mk8dx", 14500))
+
+    def test_config_tables(self):
+        """Test that config tables replace the defaults and invalid tables keep the current ones"""
+        tiers.load_tables({"TIER_TABLES": {"mk8dx": {"default": "Low", "inclusive": True,
+                                                      "tiers": [{"tier": "High", "mmr": 5000}]}}})
+        self.assertEqual("High", tiers.get_tier("mk8dx", 5000))
+        self.assertEqual("Low", tiers.get_tier("mk8dx", 4999))
+        with self.assertRaises(tiers.BadTierTable):
+            tiers.load_tables({"TIER_TABLES": {"mk8dx": {"tiers": []}}})
+        self.assertEqual("High", tiers.get_tier("mk8dx", 5000))
+
+
+class PlayerListStreamTests(unittest.TestCase):
+
+    def _parse(self, body: bytes, chunk_size: int) -> dict:
+        ratings = mmr.RatingTable()
+        stream = mmr.PlayerListStream(
+            "players", mmr.Ratings._lounge_player_adder(ratings))
+        for i in range(0, len(body), chunk_size):
+            stream.feed(body[i:i + chunk_size])
+        stream.close()
+        self.assertEqual({"count": 3, "after": [1.5, None]}, stream.fields)
+        return dict(ratings.items())
+
+    def test_chunked_parse(self):
+        """Test that players are parsed the same however the response body is split into chunks"""
+        body = json.dumps({"count": 3, "players": [{"name": "Ünïcode", "discordId": "1", "mmr": 12345},
+                                                   {"name": "Placement", "discordId": "2"},
+                                                   {"name": "No discord", "mmr": 5}],
+                           "after": [1.5, None]}, ensure_ascii=False).encode()
+        expected = {1: (12345, "Ünïcode"),
+                    2: (common.CONFIG["PLACEMENT_PLAYER_MMR"], "Placement")}
+        for chunk_size in (1, 2, 7, len(body)):
+            self.assertEqual(expected, self._parse(body, chunk_size))
+
+    def test_bad_responses(self):
+        """Test that malformed responses and bad players raise BadRatingData"""
+        for body in (b'[]', b'{"players": [{"name": "a"}', b'{"players": null}', b'{"players": []} x',
+                     b'{"players": [{"name": "a", "mmr": "1"}]}', b'{"players": [{"discordId": "1"}]}'):
+            with self.assertRaises(mmr.BadRatingData):
+                self._parse(body, 3)
+
+
+class RatingsPublishTests(unittest.TestCase):
+
+    @staticmethod
+    def _table(players: dict) -> mmr.RatingTable:
+        table = mmr.RatingTable()
+        for discord_id, (rating, name) in players.items():
+            table.add(discord_id, rating, name)
+        return table
+
+    def test_rating_table(self):
+        """Test that a rating table replaces duplicate IDs, skips IDs that aren't numbers and shares unchanged names"""
+        table = self._table({"1": (1000, "One"), "x": (2000, "Bad ID")})
+        table.add("1", 1500, "One")
+        self.assertEqual({1: (1500, "One")}, dict(table.items()))
+        self.assertIsNone(table.get(2))
+        next_table = mmr.RatingTable()
+        next_table.add("1", 1600, "".join(["O", "ne"]), table)
+        self.assertIs(table.get(1)[1], next_table.get(1)[1])
+        with self.assertRaises(mmr.BadPlayerData):
+            table.add("2", 2 ** 40, "Too high")
+
+    def test_publish_swaps_tables(self):
+        """Test that publishing a ratings table swaps it in whole and leaves the previous table untouched"""
+        ratings = mmr.Ratings()
+        ratings.first_run_complete = True
+        ratings._publish(self._table({"1": (1000, "One"), "2": (2000, "Two")}))
+        first = ratings.ratings
+        ratings._publish(self._table({"2": (2500, "Two")}))
+        self.assertEqual({1: (1000, "One"), 2: (2000, "Two")}, dict(first.items()))
+        self.assertIs(first, ratings.previous_ratings)
+        self.assertEqual(2, ratings.generation)
+        self.assertIsNone(ratings.get_rating_from_discord_id(1))
+        self.assertEqual(2500, ratings.get_rating_from_discord_id(2))
+
+
+class RatingsSnapshotTests(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "settings_data", "ratings_snapshot.pkl")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def test_snapshot_round_trip(self):
+        """Test that a saved snapshot is loaded as a ready table with its pull time and validators"""
+        ratings = mmr.Ratings(self.path)
+        ratings._publish(RatingsPublishTests._table({"1": (1000, "One")}))
+        ratings.last_pull = ratings.last_full_pull = datetime.now(timezone.utc) - timedelta(minutes=5)
+        ratings.etag = '"v1"'
+        await ratings.save_snapshot()
+        self.assertEqual([], [name for name in os.listdir(os.path.dirname(self.path)) if name.endswith(".tmp")])
+        loaded = mmr.Ratings(self.path)
+        self.assertTrue(loaded.load_snapshot())
+        self.assertTrue(loaded.first_run_complete)
+        self.assertEqual(1000, loaded.get_rating_from_discord_id(1))
+        self.assertEqual('"v1"', loaded.etag)
+        self.assertGreaterEqual(loaded.age(), timedelta(minutes=5))
+
+    async def test_snapshot_saved_only_after_publish(self):
+        """Test that a pull only saves a snapshot if it published a new table"""
+        ratings = mmr.Ratings(self.path)
+        results = [True, False]
+
+        async def pull():
+            if results.pop(0):
+                ratings._publish(RatingsPublishTests._table({"1": (1000, "One")}))
+            return True
+        with mock.patch.object(common, "SERVER", common.Server.MK8DX), \
+                mock.patch.object(ratings, "_pull_mk8dx_ratings", pull), \
+                mock.patch.object(ratings, "save_snapshot") as save_snapshot:
+            self.assertTrue(await ratings.update_ratings())
+            self.assertTrue(await ratings.update_ratings())
+        self.assertEqual(1, save_snapshot.await_count)
+
+    async def test_stale_snapshot_is_ignored(self):
+        """Test that a snapshot older than the maximum age is not loaded"""
+        ratings = mmr.Ratings(self.path)
+        ratings.last_pull = datetime.now(timezone.utc) - timedelta(days=30)
+        await ratings.save_snapshot()
+        loaded = mmr.Ratings(self.path)
+        self.assertFalse(loaded.load_snapshot())
+        self.assertFalse(loaded.first_run_complete)
+
+
+class RefreshScheduleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.schedule = mmr.RefreshSchedule()
+        self.schedule.lead = timedelta(minutes=3)
+        self.schedule.idle_interval = timedelta(minutes=120)
+        self.schedule.idle_hours = frozenset()
+        self.now = datetime(2024, 8, 1, 12, 0, tzinfo=timezone.utc)
+
+    def test_pull_is_aimed_before_queue_close(self):
+        """Test that a pull is aimed the lead time before a queue closes, once per queue"""
+        queue_close = self.now + timedelta(minutes=20)
+        last_pull = self.now - timedelta(minutes=30)
+        self.assertEqual(queue_close - timedelta(minutes=3), self.schedule.next_refresh(self.now, last_pull, queue_close))
+        last_pull = queue_close - timedelta(minutes=2)
+        self.assertEqual(last_pull + timedelta(minutes=120),
+                         self.schedule.next_refresh(last_pull, last_pull, queue_close))
+        self.assertEqual(self.now, self.schedule.next_refresh(self.now, None, queue_close))
+
+    def test_idle_hours_are_skipped(self):
+        """Test that pulls between queues skip idle hours but pulls before a queue closes don't"""
+        self.schedule.idle_hours = frozenset([14, 15])
+        last_pull = self.now
+        self.assertEqual(datetime(2024, 8, 1, 16, 0, tzinfo=timezone.utc),
+                         self.schedule.next_refresh(self.now, last_pull, None))
+        queue_close = datetime(2024, 8, 1, 14, 30, tzinfo=timezone.utc)
+        self.assertEqual(queue_close - timedelta(minutes=3), self.schedule.next_refresh(self.now, last_pull, queue_close))
+        self.schedule.idle_hours = frozenset(range(24))
+        self.assertIsNone(self.schedule.next_refresh(self.now, last_pull, None))
+
+    def test_failures_back_off(self):
+        """Test that failed pulls are tried again after a jittered wait that doubles up to the maximum"""
+        last_pull = self.now - timedelta(hours=3)
+        for delay in [1, 2, 4, 8, 15, 15]:
+            self.schedule.record_failure(self.now)
+            next_refresh = self.schedule.next_refresh(self.now, last_pull, None)
+            self.assertGreaterEqual(next_refresh, self.now + timedelta(minutes=delay) / 2)
+            self.assertLessEqual(next_refresh, self.now + timedelta(minutes=delay))
+        self.schedule.record_success()
+        self.assertEqual(self.now, self.schedule.next_refresh(self.now, last_pull, None))
+
+
+class RatingsRefreshTests(unittest.IsolatedAsyncioTestCase):
+    """Pulls ratings from a stub of the lounge API served locally"""
+
+    async def asyncSetUp(self):
+        self.players = {"1": 1000, "2": 2000}
+        self.etag = None
+        self.status = 200
+        self.requests = []
+        self.client_ports = []
+        app = web.Application()
+        app.router.add_get("/players", self._handle)
+        app.router.add_get("/api/player", self._handle_player)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/players?game=test"
+        self.old_delta_parameter = common.CONFIG.get("RATINGS_DELTA_PARAMETER")
+        self.old_parse_executor = common.CONFIG.get("RATINGS_PARSE_EXECUTOR")
+        self.old_server, self.old_url = common.SERVER, common.CONFIG["url"]
+        common.SERVER = common.Server.MK8DX
+        common.CONFIG["url"] = f"http://127.0.0.1:{port}"
+        self.ratings = mmr.Ratings()
+
+    async def asyncTearDown(self):
+        common.CONFIG["RATINGS_DELTA_PARAMETER"] = self.old_delta_parameter
+        common.CONFIG["RATINGS_PARSE_EXECUTOR"] = self.old_parse_executor
+        common.SERVER, common.CONFIG["url"] = self.old_server, self.old_url
+        await http_client.close()
+        for name, endpoint in http_client.ENDPOINTS.items():
+            http_client.BREAKERS[name] = http_client.CircuitBreaker(endpoint)
+        await self.runner.cleanup()
+
+    async def _handle(self, request):
+        self.requests.append(request)
+        self.client_ports.append(request.transport.get_extra_info("peername")[1])
+        if self.status != 200:
+            return web.Response(status=self.status)
+        if self.etag is not None and request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304)
+        players = self.players
+        if "since" in request.query:
+            players = {"2": 2500}
+        body = json.dumps({"players": [{"name": f"Player {discord_id}", "discordId": discord_id, "mmr": rating}
+                                       for discord_id, rating in players.items()]})
+        headers = {} if self.etag is None else {"ETag": self.etag}
+        return web.Response(text=body, content_type="application/json", headers=headers)
+
+    async def _handle_player(self, request):
+        self.requests.append(request)
+        discord_id = request.query["discordId"]
+        if discord_id not in self.players:
+            return web.Response(status=404)
+        return web.json_response({"name": f"Player {discord_id}", "discordId": discord_id,
+                                  "mmr": self.players[discord_id]})
+
+    async def _pull(self) -> bool:
+        return await self.ratings._pull_ratings(self.url, "players", 1, mmr.Ratings._lounge_player_adder)
+
+    async def test_conditional_pull(self):
+        """Test that a full pull sends the last ETag and keeps the table when the API answers 304"""
+        self.etag = '"v1"'
+        self.assertTrue(await self._pull())
+        self.assertEqual(mmr.PULL_FULL, self.ratings.last_pull_result)
+        table = self.ratings.ratings
+        self.assertTrue(await self._pull())
+        self.assertEqual('"v1"', self.requests[-1].headers.get("If-None-Match"))
+        self.assertEqual(mmr.PULL_NOT_MODIFIED, self.ratings.last_pull_result)
+        self.assertIs(table, self.ratings.ratings)
+
+    async def test_pull_only_waits_for_publish_lock_to_publish(self):
+        """Test that a pull downloads while the publish lock is held, and only waits for it to swap in the table"""
+        async with self.ratings.publish_lock:
+            pull = asyncio.create_task(self._pull())
+            while not self.requests:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+            self.assertFalse(pull.done())
+            self.assertEqual(0, self.ratings.generation)
+        self.assertTrue(await pull)
+        self.assertEqual(1, self.ratings.generation)
+
+    async def test_circuit_breaker(self):
+        """Test that pulls fail fast after failing enough times in a row, until a request is let through and succeeds"""
+        self.status = 503
+        breaker = http_client.BREAKERS[http_client.RATINGS]
+        for _ in range(breaker.endpoint.failure_threshold):
+            self.assertFalse(await self._pull())
+        self.assertTrue(breaker.is_open)
+        with self.assertRaises(http_client.EndpointUnavailable):
+            await self._pull()
+        self.assertEqual(breaker.endpoint.failure_threshold, len(self.requests))
+        self.status = 200
+        breaker.open_until = 0
+        self.assertTrue(await self._pull())
+        self.assertFalse(breaker.is_open)
+        self.assertEqual((4, 3, 1), (breaker.requests, breaker.failures, breaker.rejected))
+
+    async def test_caller_errors_do_not_affect_breaker(self):
+        """Test that errors raised while the caller handles a response don't count as failed requests"""
+        breaker = http_client.BREAKERS[http_client.RATINGS]
+        for error in (ValueError("Bad body"), aiohttp.ContentTypeError(None, ())):
+            with self.assertRaises(type(error)):
+                async with http_client.request(http_client.RATINGS, "GET", self.url):
+                    raise error
+        self.assertEqual((2, 0, 0), (breaker.requests, breaker.failures, breaker.consecutive_failures))
+
+    async def test_connection_reused(self):
+        """Test that pulls reuse the shared client's connection"""
+        self.assertTrue(await self._pull())
+        self.assertTrue(await self._pull())
+        self.assertEqual(1, len(set(self.client_ports)))
+
+    async def test_unchanged_body_is_not_republished(self):
+        """Test that a full pull identical to the last one is neither parsed nor published again"""
+        self.assertTrue(await self._pull())
+        self.ratings.last_parse_seconds = None
+        self.assertTrue(await self._pull())
+        self.assertEqual(mmr.PULL_UNCHANGED, self.ratings.last_pull_result)
+        self.assertEqual(1, self.ratings.generation)
+        self.assertIsNone(self.ratings.last_parse_seconds)
+        self.players["3"] = 3000
+        self.assertTrue(await self._pull())
+        self.assertEqual(mmr.PULL_FULL, self.ratings.last_pull_result)
+        self.assertEqual(2, self.ratings.generation)
+
+    async def test_missing_players_are_looked_up(self):
+        """Test that players missing from the table are looked up in one coalesced batch and misses are cached"""
+        self.assertTrue(await self._pull())
+        self.ratings.first_run_complete = True
+        self.players["7"] = 7000
+        members = [SimpleNamespace(id=discord_id) for discord_id in (1, 7, 8)]
+        players, late_players = await asyncio.gather(self.ratings.get_rating(members),
+                                                     self.ratings.get_rating(members[1:2]))
+        self.assertEqual([("Player 1", 1000), ("Player 7", 7000)], [(p.lounge_name, p.mmr) for p in players])
+        self.assertEqual(7000, late_players[0].mmr)
+        self.assertEqual(["7", "8"], sorted(r.query["discordId"] for r in self.requests[1:]))
+        self.assertEqual([], await self.ratings.get_rating(members[2:]))
+        self.assertEqual(3, len(self.requests))
+        self.assertEqual(7000, self.ratings.get_rating_from_discord_id(7))
+
+    async def test_cancelled_lookup_batch_releases_callers(self):
+        """Test that players waiting on a batch of lookups that is cancelled before it is sent are treated as not
+        found instead of waiting forever"""
+        self.ratings.first_run_complete = True
+        lookup = asyncio.create_task(self.ratings.look_up_ratings([1]))
+        # Cancel the batch while it waits for more lookups
+        await asyncio.sleep(mmr.LOOKUP_BATCH_SECONDS / 5)
+        self.ratings._lookup_task.cancel()
+        self.assertEqual({}, await asyncio.wait_for(lookup, 1))
+        self.assertEqual([], self.requests)
+
+    async def test_parse_executors(self):
+        """Test that every parse executor publishes the same table"""
+        for parse_executor in mmr.PARSE_EXECUTORS:
+            common.CONFIG["RATINGS_PARSE_EXECUTOR"] = parse_executor
+            ratings = mmr.Ratings()
+            self.assertTrue(await ratings._pull_ratings(self.url, "players", 1,
+                                                        ratings._current_lounge_player_adder()))
+            self.assertEqual({1: (1000, "Player 1"), 2: (2000, "Player 2")}, dict(ratings.ratings.items()))
+            self.assertIsNotNone(ratings.last_parse_seconds)
+            # The next body is read and hashed before it is parsed
+            self.players["3"] = 3000
+            self.assertTrue(await ratings._pull_ratings(self.url, "players", 1,
+                                                        ratings._current_lounge_player_adder()))
+            self.assertEqual(3000, ratings.ratings.get_mmr(3))
+            del self.players["3"]
+            if ratings._executor is not None:
+                ratings._executor.shutdown()
+
+    async def test_delta_pull_merges(self):
+        """Test that a delta pull merges the changed players into the current table"""
+        common.CONFIG["RATINGS_DELTA_PARAMETER"] = "since"
+        self.assertTrue(await self._pull())
+        self.assertTrue(await self._pull())
+        self.assertIn("since", self.requests[-1].query)
+        self.assertEqual(mmr.PULL_DELTA, self.ratings.last_pull_result)
+        self.assertEqual({1: (1000, "Player 1"), 2: (2500, "Player 2")}, dict(self.ratings.ratings.items()))
+
+
+class RoomRegistryTests(unittest.TestCase):
+
+    def _new_mogi(self, registry):
+        return Mogi(sq_id=1, max_players_per_team=1, players_per_room=12, buttons=[],
+                    mogi_channel=None, room_registry=registry)
+
+    def test_rooms_follow_their_channels(self):
+        """Test that rooms can be found by channel id once they get a channel, and not by their old channel"""
+        registry = RoomRegistry()
+        mogi = self._new_mogi(registry)
+        room_1 = Room(None, 1, SimpleNamespace(id=100), [])
+        room_2 = Room(None, 2, None, [])
+        mogi.add_room(room_1)
+        mogi.add_room(room_2)
+        self.assertEqual((mogi, room_1), registry.get(100))
+        self.assertNotIn(200, registry)
+        room_2.channel = SimpleNamespace(id=200)
+        self.assertEqual((mogi, room_2), registry.get(200))
+        self.assertIs(room_2, mogi.get_room_from_channel_id(200))
+        room_2.channel = SimpleNamespace(id=300)
+        self.assertEqual((None, None), registry.get(200))
+        self.assertEqual({100, 300}, mogi.all_room_channel_ids())
+
+    def test_remove_mogi(self):
+        """Test that removing an event only removes its own rooms"""
+        registry = RoomRegistry()
+        old_mogi, new_mogi = self._new_mogi(registry), self._new_mogi(registry)
+        old_mogi.add_room(Room(None, 1, SimpleNamespace(id=100), []))
+        new_mogi.add_room(Room(None, 1, SimpleNamespace(id=200), []))
+        self.assertEqual(frozenset({100, 200}), registry.active_channel_ids)
+        registry.remove_mogi(old_mogi)
+        self.assertNotIn(100, registry)
+        self.assertEqual(new_mogi, registry.get(200)[0])
+        self.assertEqual(frozenset({200}), registry.active_channel_ids)
+
+
 class OneRoomAlgorithmTests(unittest.TestCase):
 
     @classmethod